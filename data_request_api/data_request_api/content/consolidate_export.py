@@ -1,5 +1,13 @@
+import concurrent.futures
+import copy
+import hashlib
+import json
 import re
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from dataclasses import field as dataclass_field
+from typing import Callable, Optional
 
 from data_request_api.utilities.logger import get_logger  # noqa
 
@@ -8,11 +16,88 @@ from .mapping_table import (version_consistency,
                             version_consistency_drop_tables,
                             version_consistency_fields)
 
-# Filtered records
+# Filtered records of the most recent consolidation (kept for inspection only,
+#   map_data itself keeps its state in a ConsolidationContext)
 filtered_records = []
 
 
-def _map_record_id(record, records, keys):
+class ConsolidationContext:
+    """
+    State of a single consolidation of a three-base export (one map_data call).
+
+    Holding the state per call instead of in module globals makes map_data
+    reentrant, so that several exports can be consolidated concurrently.
+
+    Attributes
+    ----------
+    filtered_records : set
+        Record ids removed by the "internal_filters" of the mapping table.
+    filtered_records_per_table : dict
+        Filtered record ids (list, in order of filtering) per one-base table name.
+    record_indexes : dict
+        Hash indexes of the records of linked tables, per (base, table) and key.
+    counters : dict
+        Counters of the consolidation steps, eg. filtered references.
+    """
+
+    def __init__(self):
+        self.filtered_records = set()
+        self.filtered_records_per_table = defaultdict(list)
+        self.record_indexes = defaultdict(dict)
+        self.counters = defaultdict(int)
+
+    def filter_record(self, table, record_id):
+        """Marks a record of the specified table as filtered."""
+        self.filtered_records.add(record_id)
+        self.filtered_records_per_table[table].append(record_id)
+
+    def is_filtered(self, record_id):
+        """Whether the record has been filtered."""
+        try:
+            return record_id in self.filtered_records
+        except TypeError:
+            # Unhashable values (eg. attachments) are no record ids
+            return False
+
+    def get_filtered_records(self):
+        """Returns the list of filtered record ids in order of filtering."""
+        return [rid for rids in self.filtered_records_per_table.values() for rid in rids]
+
+
+def _build_record_index(records, key):
+    """
+    Builds a hash index of the records by the value of the specified key.
+    """
+    index = defaultdict(list)
+    for r, v in records.items():
+        if key in v:
+            try:
+                index[v[key]].append(r)
+            except TypeError:
+                # Unhashable values (eg. lists) can only be matched by a full scan
+                continue
+    return dict(index)
+
+
+def _match_records(records, key, value, index=None):
+    """
+    Identifies the record_ids in list of records whose "key" matches the value.
+
+    If "index" is specified (a dict that is populated on first use with one
+    hash index per key), the records are looked up instead of scanned.
+    """
+    if index is not None:
+        try:
+            if key not in index:
+                index[key] = _build_record_index(records, key)
+            return list(index[key].get(value, []))
+        except TypeError:
+            # Unhashable value - fall back to the full scan
+            pass
+    return [r for r, v in records.items() if key in v and v[key] == value]
+
+
+def _map_record_id(record, records, keys, index=None):
     """
     Identifies a record_id in list of records using key.
     """
@@ -21,14 +106,13 @@ def _map_record_id(record, records, keys):
     #   that matches with "record"
     for key in keys:
         if key in record:
-            recval = record[key]
-            matches = [r for r, v in records.items() if key in v and v[key] == recval]
+            matches = _match_records(records, key, record[key], index)
             if len(matches) == 1:
                 break
     return matches
 
 
-def _map_attribute(attr, records, keys):
+def _map_attribute(attr, records, keys, index=None):
     """
     Identifies a record_id in list of records using key and matching with the attribute value.
     """
@@ -36,7 +120,7 @@ def _map_attribute(attr, records, keys):
     #   that matches with "attr"
     matches = []
     for key in keys:
-        matches.extend([r for r, v in records.items() if key in v and v[key] == attr])
+        matches.extend(_match_records(records, key, attr, index))
         if len(matches) == 1:
             break
     return matches
@@ -91,6 +175,12 @@ def _apply_consistency_fixes(data):
     return data
 
 
+# Tables (one-base) altered by the hard fixes, per version (see _apply_hard_fixes)
+_hard_fix_tables = {
+    "v1.2": ["MIPs", "CMIP6 Table Identifiers (legacy)", "CMIP6 Frequency (legacy)"],
+}
+
+
 def _apply_hard_fixes(data):
     """
     Applies hard-coded fixes to the data request dictionary, such as merging or deletion of records.
@@ -134,16 +224,22 @@ def _apply_hard_fixes(data):
     return data
 
 
-def _filter_references(val, key, table, rid, dtype=None):
+def _filter_references(val, key, table, rid, dtype=None, context=None):
     """
     Filters lists of or strings with comma-separated references to other records.
+
+    The filtered record ids are taken from the ConsolidationContext "context",
+    if none is specified no reference is filtered.
     """
-    global filtered_records
     logger = get_logger()
+    if context is None:
+        context = ConsolidationContext()
+    is_filtered = context.is_filtered
 
     if isinstance(val, list):
-        filtered = [v for v in val if v not in filtered_records]
+        filtered = [v for v in val if not is_filtered(v)]
         if len(filtered) != len(val):
+            context.counters["filtered_references"] += len(val) - len(filtered)
             if filtered == []:
                 if len(val) == 1:
                     logger.warning(
@@ -162,8 +258,9 @@ def _filter_references(val, key, table, rid, dtype=None):
     elif isinstance(val, str) and val.startswith("rec"):
         if "," in val:
             vallist = [v.strip() for v in val.split(",")]
-            filtered = [v for v in vallist if v not in filtered_records]
+            filtered = [v for v in vallist if not is_filtered(v)]
             if len(filtered) != len(vallist):
+                context.counters["filtered_references"] += len(vallist) - len(filtered)
                 if filtered == []:
                     logger.warning(
                         f"'{table}': Filtered all {len(vallist)} references for"
@@ -175,7 +272,8 @@ def _filter_references(val, key, table, rid, dtype=None):
                         f" {len(vallist)} references for '{key}' of record '{rid}'."
                     )
             return _fix_dtype(key, ",".join(filtered), dtype)
-        elif val.strip() in filtered_records:
+        elif is_filtered(val.strip()):
+            context.counters["filtered_references"] += 1
             logger.warning(
                 f"'{table}': Filtered the only reference for '{key}' of record '{rid}'."
             )
@@ -309,7 +407,689 @@ def _fix_dtype(fkey, fval, dtype=None):
         return fval
 
 
-def map_data(data, mapping_table, version, **kwargs):
+# Separator of comma-separated values
+_comma_separator = re.compile(r",\s*")
+
+
+def _split_quoted(value):
+    """
+    Splits a string of comma-separated values, ignoring commas within double quotes.
+
+    Equivalent to splitting with the regular expression ',\\s*(?=(?:[^"]|"[^"]*")*$)'
+    and stripping the double quotes of the resulting values, but linear in the
+    length of the string.
+    """
+    quotes_left = value.count('"')
+    if quotes_left == 0:
+        return _comma_separator.split(value)
+    parts = []
+    # A comma is a separator if it is followed by an even number of double quotes
+    start = 0
+    i = 0
+    n = len(value)
+    while i < n:
+        c = value[i]
+        if c == '"':
+            quotes_left -= 1
+        elif c == "," and quotes_left % 2 == 0:
+            parts.append(value[start:i].strip('"'))
+            # The separator includes any whitespace following the comma
+            i += 1
+            while i < n and value[i].isspace():
+                i += 1
+            start = i
+            continue
+        i += 1
+    parts.append(value[start:].strip('"'))
+    return parts
+
+
+def mapping_table_fingerprint(mapping_table):
+    """
+    Returns a fingerprint (sha256 hexdigest) of the mapping table.
+    """
+    return hashlib.sha256(
+        json.dumps(mapping_table, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _export_schema(data):
+    """
+    Returns a hashable description of the bases and tables of an export.
+    """
+    return tuple(sorted((base, tuple(sorted(data[base]))) for base in data))
+
+
+@dataclass
+class AttributePlan:
+    """
+    Compiled internal mapping of a record attribute (see "internal_mapping").
+    """
+
+    attr: str
+    out_key: str
+    aliases: list
+    base: str
+    table_alias: str
+    split: Callable
+    match: Callable
+    log_multiple: Callable
+
+
+@dataclass
+class TablePlan:
+    """
+    Compiled mapping of a single table of the one-base structure.
+    """
+
+    table: str
+    source_base: str
+    source_table: str
+    record_filter: Optional[Callable]
+    rename: dict
+    drop_keys: frozenset
+    field_dtypes: dict
+    attributes: list = dataclass_field(default_factory=list)
+
+
+@dataclass
+class MappingPlan:
+    """
+    Compiled mapping table for a given export schema.
+    """
+
+    tables: list
+    missing_bases: list
+    missing_tables: list
+
+
+# Compiled mapping plans, per mapping table fingerprint and export schema, the least
+#   recently used ones being dropped beyond _mapping_plans_size plans
+_mapping_plans = OrderedDict()
+_mapping_plans_size = 8
+# Guards the lookups and updates of _mapping_plans by concurrent consolidations
+_mapping_plans_lock = threading.Lock()
+
+
+def _compile_filter(filter_key, filter_val):
+    """
+    Compiles a single "internal_filters" entry into a function of the record,
+    returning the filter result or None if the filter does not apply.
+    """
+    keys = [filter_key] + filter_val["aliases"]
+    operator = filter_val["operator"]
+    values = filter_val.get("values", [])
+
+    def present(record):
+        return [fk for fk in keys if fk in record]
+
+    if operator == "nonempty":
+
+        def apply(record):
+            found = present(record)
+            if not found:
+                return False
+            return any(bool(record[fk]) for fk in found)
+
+    elif operator == "in":
+
+        def apply(record):
+            if not present(record):
+                return False
+            if isinstance(record[filter_key], list):
+                return any(fj in values for fj in record[filter_key])
+            return record[filter_key] in values
+
+    elif operator == "not in":
+
+        def apply(record):
+            if not present(record):
+                return False
+            # Only lists of values are filtered
+            if isinstance(record[filter_key], list):
+                return any(fj not in values for fj in record[filter_key])
+            return None
+
+    else:
+
+        def apply(record):
+            if not present(record):
+                return False
+            return None
+
+    return apply
+
+
+def _compile_record_filter(internal_filters):
+    """
+    Compiles the "internal_filters" of a table into a function of the record,
+    returning whether the record is kept.
+    """
+    if not internal_filters:
+        return None
+    filters = [
+        _compile_filter(filter_key, filter_val)
+        for filter_key, filter_val in internal_filters.items()
+    ]
+
+    def keep(record):
+        for apply in filters:
+            if apply(record) is False:
+                return False
+        return True
+
+    return keep
+
+
+def _raise(exc_type, errmsg):
+    """Returns a function logging and raising the specified error when called."""
+
+    def raise_error(*args, **kwargs):
+        get_logger().error(f"{exc_type.__name__}: {errmsg}")
+        raise exc_type(errmsg)
+
+    return raise_error
+
+
+def _compile_split(table, attr, source_table, operation):
+    """
+    Compiles the internal mapping "operation" into a function returning the
+    list of attribute values (or None if the values cannot be split).
+    """
+    logger = get_logger()
+    if operation == "split":
+
+        def split(attr_vals, record_id):
+            if isinstance(attr_vals, list):
+                errmsg = (
+                    f"Consolidation of {table}@{attr}: Selected 'split' operation"
+                    f" for a list {record_id}:",
+                    attr_vals,
+                )
+                logger.error(f"TypeError: {errmsg}")
+                return None
+            return _split_quoted(attr_vals)
+
+    elif operation == "":
+
+        def split(attr_vals, record_id):
+            if isinstance(attr_vals, str):
+                return [attr_vals]
+            return attr_vals
+
+    else:
+        split = _raise(
+            ValueError,
+            f"Unknown internal mapping operation for attribute '{attr}'"
+            f" ('{source_table}'): '{operation}'",
+        )
+    return split
+
+
+def _compile_match(table, attr, source_base, source_table, intm, table_alias, data):
+    """
+    Compiles the internal mapping "entry_type" into a function returning the
+    matching record_ids of an attribute value, and a function logging the
+    case of several matches.
+    """
+    logger = get_logger()
+    if intm["entry_type"] == "record_id":
+        if not intm["base_copy_of_table"]:
+            match = _raise(
+                ValueError,
+                "A copy of the table in the same base is required if 'entry_type'"
+                " is set to 'record_id', but 'base_copy_of_table' is set to"
+                f" False: '{source_table}' - '{attr}'",
+            )
+        elif intm["base"] not in data:
+            match = _raise(KeyError, f"Base '{intm['base']}' not found in data.")
+        elif intm["base_copy_of_table"] not in data[source_base]:
+            match = _raise(
+                KeyError,
+                f"Table '{intm['base_copy_of_table']}' not found in base '{source_base}'.",
+            )
+        else:
+            base_copy_of_table = intm["base_copy_of_table"]
+            keys = intm["map_by_key"]
+
+            def match(attr_val, data, index):
+                # The record copy in the current base
+                record_copy = data[source_base][base_copy_of_table]["records"][attr_val]
+                # The entire list of records in the base of origin
+                recordlist = data[intm["base"]][table_alias]["records"]
+                return _map_record_id(record_copy, recordlist, keys, index)
+
+        def log_multiple(attr_val, matches):
+            logger.warning(
+                f"Consolidation of {table}@{table_alias}:"
+                f" Multiple matching records found for attribute '{attr}' with"
+                f" value '{attr_val}': {matches}. Using first match."
+            )
+
+    elif intm["entry_type"] == "name":
+        keys = (
+            [intm["map_by_key"]]
+            if isinstance(intm["map_by_key"], str)
+            else intm["map_by_key"]
+        )
+
+        def match(attr_val, data, index):
+            return _map_attribute(
+                attr_val, data[intm["base"]][table_alias]["records"], keys, index
+            )
+
+        def log_multiple(attr_val, matches):
+            logger.debug(
+                "Consolidation of"
+                f" {table}@{table_alias}: Multiple matching records found"
+                f" for attribute '{attr}' with value '{attr_val}': {matches}"
+            )
+
+    else:
+        match = _raise(
+            ValueError,
+            f"Unknown 'entry_type' specified for attribute '{attr}'"
+            f" ('{source_table}'): '{intm['entry_type']}'",
+        )
+        log_multiple = None
+    return match, log_multiple
+
+
+def compile_mapping_plan(mapping_table, data):
+    """
+    Compiles the mapping table into a plan for the bases and tables available in the data.
+
+    The plan resolves the table aliases, the attribute aliases and the linked tables
+    once and turns the "internal_filters" and "internal_mapping" settings into
+    functions, so that only the per-record work remains when applying it.
+    The most recently used plans are cached per mapping table and export schema.
+
+    Parameters
+    ----------
+    mapping_table : dict
+        The mapping table to apply to map to one base.
+    data : dict
+        Three-base Airtable export.
+
+    Returns
+    -------
+    MappingPlan
+        The compiled mapping plan.
+
+    Raises
+    ------
+    ValueError
+        If none of the source tables of a linked table exist in the data.
+    """
+    cache_key = (mapping_table_fingerprint(mapping_table), _export_schema(data))
+    with _mapping_plans_lock:
+        if cache_key in _mapping_plans:
+            _mapping_plans.move_to_end(cache_key)
+            return _mapping_plans[cache_key]
+
+    logger = get_logger()
+    # The plan must not change along with the mapping table it was compiled from
+    mapping_table = copy.deepcopy(mapping_table)
+    tables = []
+    missing_bases = []
+    missing_tables = []
+    for table, mapinfo in mapping_table.items():
+        source_base = mapinfo["source_base"]
+        if source_base not in data:
+            missing_bases.append(source_base)
+            continue
+        source_tables = [st for st in mapinfo["source_table"] if st in data[source_base]]
+        if not source_tables:
+            missing_tables.append(mapinfo["source_table"][0])
+            continue
+        source_table = source_tables[0]
+        table_plan = TablePlan(
+            table=table,
+            source_base=source_base,
+            source_table=source_table,
+            record_filter=(
+                _compile_record_filter(mapinfo["internal_filters"])
+                if "internal_filters" in mapinfo
+                else None
+            ),
+            rename=mapinfo["internal_consistency"],
+            drop_keys=frozenset(mapinfo["drop_keys"]),
+            field_dtypes=mapinfo["field_dtypes"],
+        )
+        intm = mapinfo["internal_mapping"]
+        for attr in intm.keys():
+            intm_table = [
+                tn
+                for tn in mapping_table.keys()
+                if tn in mapping_table[tn]["source_table"]
+                and tn == intm[attr]["table"]
+            ][0]
+            intm_table_alias = [
+                tn
+                for tn in mapping_table[intm_table]["source_table"]
+                if tn in data[intm[attr]["base"]]
+            ]
+            try:
+                intm_table_alias = intm_table_alias[0]
+            except IndexError:
+                errmsg = f"None of the following tables exist in the data: {mapping_table[intm[attr]['table']]['source_table']}."
+                logger.error(errmsg)
+                raise ValueError(errmsg)
+            match, log_multiple = _compile_match(
+                table, attr, source_base, source_table, intm[attr], intm_table_alias, data
+            )
+            table_plan.attributes.append(
+                AttributePlan(
+                    attr=attr,
+                    out_key=mapinfo["internal_consistency"].get(attr, attr),
+                    aliases=[
+                        a
+                        for a in mapinfo["internal_consistency"].keys()
+                        if mapinfo["internal_consistency"][a] == attr
+                    ],
+                    base=intm[attr]["base"],
+                    table_alias=intm_table_alias,
+                    split=_compile_split(table, attr, source_table, intm[attr]["operation"]),
+                    match=match,
+                    log_multiple=log_multiple,
+                )
+            )
+        tables.append(table_plan)
+
+    plan = MappingPlan(tables=tables, missing_bases=missing_bases, missing_tables=missing_tables)
+    # The plan is compiled without holding the lock, a plan compiled meanwhile by another
+    #   thread for the same key is identical and replaced
+    with _mapping_plans_lock:
+        _mapping_plans[cache_key] = plan
+        _mapping_plans.move_to_end(cache_key)
+        while len(_mapping_plans) > _mapping_plans_size:
+            _mapping_plans.popitem(last=False)
+    return plan
+
+
+def get_required_source_tables(mapping_table, data, tables, version):
+    """
+    Returns the source tables of the three-base export required to consolidate the
+    specified one-base tables.
+
+    These are the source tables of the one-base tables, the tables their attributes are
+    mapped to ("internal_mapping"), the tables their attributes link to (required to
+    filter the references) and the tables altered by the hard fixes of the version.
+    The records of the other tables can be left out of the export to consolidate.
+
+    Parameters
+    ----------
+    mapping_table : dict
+        The mapping table to apply to map to one base.
+    data : dict
+        Three-base Airtable export. Only the table metadata (ids, fields) is read,
+        the records may be missing.
+    tables : list
+        The one-base tables to consolidate.
+    version : str
+        The version tag of the export.
+
+    Returns
+    -------
+    set
+        The required source tables as (base, table) tuples.
+    """
+
+    def source_table(table, base=None):
+        # The alias of the one-base table existing in the specified (or its source) base
+        if table not in mapping_table:
+            return None
+        base = base or mapping_table[table]["source_base"]
+        aliases = [st for st in mapping_table[table]["source_table"] if st in data.get(base, {})]
+        return (base, aliases[0]) if aliases else None
+
+    required = set()
+    for table in set(tables) | set(_hard_fix_tables.get(version, [])):
+        source = source_table(table)
+        if source is None:
+            continue
+        source_base, source_name = source
+        required.add(source)
+        for intm in mapping_table[table]["internal_mapping"].values():
+            required.add(source_table(intm["table"]))
+            required.add(source_table(intm["table"], base=intm["base"]))
+            if intm["base_copy_of_table"] in data[source_base]:
+                required.add((source_base, intm["base_copy_of_table"]))
+        table_ids = {
+            source_info["id"]: name
+            for name, source_info in data[source_base].items()
+            if isinstance(source_info, dict) and "id" in source_info
+        }
+        for field in data[source_base][source_name].get("fields", {}).values():
+            if field.get("linked_table_id") in table_ids:
+                required.add((source_base, table_ids[field["linked_table_id"]]))
+    required.discard(None)
+    return required
+
+
+def _apply_filter_plan(plan, data, context):
+    """
+    Applies the compiled "internal_filters" of all tables and registers the
+    filtered records in the context.
+    """
+    logger = get_logger()
+    for table_plan in plan.tables:
+        keep = table_plan.record_filter
+        if keep is None:
+            continue
+        for record_id, record in data[table_plan.source_base][table_plan.source_table][
+            "records"
+        ].items():
+            if not keep(record):
+                logger.debug(
+                    f"Filtered record '{record_id}'"
+                    f" {'(' + record['name'] + ')' if 'name' in record else ''}"
+                    f" from '{table_plan.table}'."
+                )
+                context.filter_record(table_plan.table, record_id)
+
+
+def _apply_table_plan(table_plan, data, context):
+    """
+    Maps a single table to the one-base structure using its compiled plan.
+    """
+    logger = get_logger()
+    table = table_plan.table
+    rename = table_plan.rename
+    drop_keys = table_plan.drop_keys
+    field_dtypes = table_plan.field_dtypes
+    is_filtered = context.is_filtered
+    source = data[table_plan.source_base][table_plan.source_table]
+    logger.debug(
+        f"Mapping '{table_plan.source_base}' : '{table_plan.source_table}' -> '{table}'"
+    )
+
+    # Copy the selected data to the one-base structure
+    # - skip filtered records
+    # - rename record attributes according to "internal_consistency" settings
+    # - filter references to records for fields that are not
+    #   internally mapped below
+    records = {}
+    for record_id, record in source["records"].items():
+        if is_filtered(record_id):
+            continue
+        mapped_record = {}
+        for reckey, recvalue in record.items():
+            if reckey in drop_keys:
+                continue
+            out_key = rename.get(reckey, reckey)
+            mapped_record[out_key] = _filter_references(
+                recvalue, reckey, table, record_id, field_dtypes.get(out_key, None), context
+            )
+        records[record_id] = mapped_record
+    mapped_table = {**source, "records": records}
+
+    # Map the record attributes pointing to records of other tables
+    for attr_plan in table_plan.attributes:
+        attr = attr_plan.attr
+        index = context.record_indexes[(attr_plan.base, attr_plan.table_alias)]
+        for record_id, record in source["records"].items():
+            if is_filtered(record_id):
+                continue
+            attr_vals = record.get(attr)
+            if attr_vals is None or attr_vals == "" or attr_vals == []:
+                # Attribute name not found for record, but might have a different name
+                #  in another export type or release version
+                logger.debug(
+                    f"{table}: Attribute '{attr}' not found for record '{record_id}'."
+                )
+                for a in attr_plan.aliases:
+                    if a in record:
+                        attr_vals = record[a]
+                        logger.debug(
+                            f"{table}: Using attribute '{a}' instead for record '{record_id}'."
+                        )
+                        break
+                else:
+                    continue
+
+            # Get list of record-keys of the attribute (eg. "Variables")
+            #   that is connected to the current record of the "source_table
+            #   (eg. "Variable Groups") by the specified "operation"
+            attr_vals = attr_plan.split(attr_vals, record_id)
+            if attr_vals is None:
+                continue
+
+            # Get mapped record_ids for this list of record-keys
+            recordIDs_new = []
+            for attr_val in attr_vals:
+                recordID_new = attr_plan.match(attr_val, data, index)
+                recordID_filtered = [r for r in recordID_new if not is_filtered(r)]
+                if len(recordID_filtered) == 0:
+                    if len(recordID_new) == 0:
+                        logger.debug(
+                            f"Consolidation of {table}@{attr_plan.table_alias}: No matching"
+                            f" record found for attribute '{attr}' with value '{attr_val}'."
+                        )
+                else:
+                    if len(recordID_filtered) > 1:
+                        attr_plan.log_multiple(attr_val, recordID_new)
+                    recordIDs_new.append(recordID_filtered[0])
+            context.counters["mapped_links"] += len(recordIDs_new)
+            if not recordIDs_new:
+                context.counters["unmapped_attributes"] += 1
+                logger.error(
+                    f"{table} (record '{record_id}'): For attribute"
+                    f" '{attr}' no records could be mapped."
+                )
+                # This case can actually happen for the 'Coordinate and Dimension' table
+            # Remove duplicates, keeping the order (independent of hash randomization)
+            records[record_id][attr_plan.out_key] = list(dict.fromkeys(recordIDs_new))
+    return mapped_table
+
+
+def _check_missing(missing_bases, missing_tables):
+    """
+    Raises an error for missing bases and warns about missing tables.
+    """
+    logger = get_logger()
+    if len(missing_bases) > 0:
+        errmsg = (
+            "Encountered missing bases when consolidating the data:"
+            f" {set(missing_bases)}"
+        )
+        logger.critical(errmsg)
+        raise KeyError(errmsg)
+    if len(missing_tables) > 0:
+        logger.warning(
+            "Encountered missing tables when consolidating the data (not"
+            f" necessarily problematic): {missing_tables}"
+        )
+
+
+# State of the worker processes of a parallel consolidation (see _map_tables_parallel)
+_worker_state = {}
+
+
+def _init_worker(data, mapping_table, filtered_records):
+    """
+    Initializes a worker process of a parallel consolidation.
+    """
+    _worker_state["data"] = data
+    _worker_state["plan"] = compile_mapping_plan(mapping_table, data)
+    _worker_state["filtered_records"] = filtered_records
+
+
+def _map_table_worker(table):
+    """
+    Maps a single table in a worker process. Returns the table name, the mapped
+    table and the counters of the mapping.
+    """
+    plan = _worker_state["plan"]
+    context = ConsolidationContext()
+    context.filtered_records = _worker_state["filtered_records"]
+    table_plan = next(tp for tp in plan.tables if tp.table == table)
+    mapped_table = _apply_table_plan(table_plan, _worker_state["data"], context)
+    return table, mapped_table, dict(context.counters)
+
+
+def _map_tables_parallel(table_plans, data, mapping_table, context, workers):
+    """
+    Maps the tables of the compiled plan over a pool of worker processes.
+
+    The records are filtered beforehand (in this process), the workers only
+    read the filtered records. The counters of the workers are merged into the
+    context. Returns the mapped tables per one-base table name.
+    """
+    mapped_tables = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(workers, len(table_plans)),
+        initializer=_init_worker,
+        initargs=(data, mapping_table, context.filtered_records),
+    ) as executor:
+        for table, mapped_table, counters in executor.map(
+            _map_table_worker, [table_plan.table for table_plan in table_plans]
+        ):
+            mapped_tables[table] = mapped_table
+            for key, count in counters.items():
+                context.counters[key] += count
+    return mapped_tables
+
+
+def _map_data_compiled(data, mapping_table, version, context, workers=None, tables=None):
+    """
+    Maps three-base data to the one-base structure using the compiled mapping plan.
+    The tables are mapped in parallel if more than one worker is requested.
+    If tables are specified, the other tables are included without records.
+    """
+    logger = get_logger()
+    plan = compile_mapping_plan(mapping_table, data)
+    _check_missing(plan.missing_bases, plan.missing_tables)
+    mapped_data = {"Data Request": {"version": version}}
+
+    # Get filtered records
+    _apply_filter_plan(plan, data, context)
+    for key in context.filtered_records_per_table:
+        logger.debug(
+            f"Filtered {len(context.filtered_records_per_table[key])} records for '{key}'."
+        )
+    logger.debug(f"Filtered {len(context.filtered_records)} records in total.")
+
+    # Perform mapping in case of three-base structure
+    table_plans = [tp for tp in plan.tables if tables is None or tp.table in tables]
+    if workers is not None and workers > 1 and len(table_plans) > 1:
+        mapped_tables = _map_tables_parallel(table_plans, data, mapping_table, context, workers)
+    else:
+        mapped_tables = {
+            table_plan.table: _apply_table_plan(table_plan, data, context)
+            for table_plan in table_plans
+        }
+    # Merge in the order of the mapping table, independent of the order of completion
+    for table_plan in plan.tables:
+        if table_plan.table in mapped_tables:
+            mapped_data["Data Request"][table_plan.table] = mapped_tables[table_plan.table]
+        else:
+            source = data[table_plan.source_base][table_plan.source_table]
+            mapped_data["Data Request"][table_plan.table] = {**source, "records": {}}
+    return mapped_data
+
+
+def map_data(data, mapping_table, version, context=None, workers=None, tables=None, **kwargs):
     """
     Maps the data to the one-base structure using the mapping table.
 
@@ -321,6 +1101,18 @@ def map_data(data, mapping_table, version, **kwargs):
         The mapping table to apply to map to one base.
     version : str
         The version tag of the exported Data Request Content dictionary.
+    context : ConsolidationContext, optional
+        The state of the consolidation, holding eg. the filtered records.
+        A new one is created if not specified.
+    workers : int, optional
+        Number of worker processes mapping the tables in parallel. The result
+        is identical to the serial mapping. Defaults to None, ie. the tables
+        are mapped serially.
+    tables : list, optional
+        Names of the one-base tables to map. The other tables are included
+        without records, so that their records can be left out of the data,
+        except for the ones required to map the specified tables (see
+        get_required_source_tables). Defaults to None, ie. all tables are mapped.
 
     Returns
     -------
@@ -332,389 +1124,21 @@ def map_data(data, mapping_table, version, **kwargs):
         Returns the input dict if the data is already one-base.
     """
     logger = get_logger()
-    missing_bases = []
-    missing_tables = []
-    mapped_data = {"Data Request": {}}
-
     # Check if data is already one-base
     if len(data.keys()) in [3, 4]:
-        # Set version
-        mapped_data["Data Request"]["version"] = version
-
-        # Reset filtered records
+        if context is None:
+            context = ConsolidationContext()
+        if tables is not None:
+            # The hard fixes alter further tables
+            tables = set(tables) | set(_hard_fix_tables.get(version, []))
+        mapped_data = _map_data_compiled(
+            data, mapping_table, version, context, workers=workers, tables=tables
+        )
+        for key, count in context.counters.items():
+            logger.debug(f"Consolidation: {count} {key.replace('_', ' ')}.")
+        # Expose the filtered records of the most recent consolidation
         global filtered_records
-        if filtered_records:
-            filtered_records = []
-        filtered_records_dict = dict()
-
-        # Get filtered records
-        for table, mapinfo in mapping_table.items():
-            if mapinfo["source_base"] in data and any(
-                [st in data[mapinfo["source_base"]] for st in mapinfo["source_table"]]
-            ):
-                source_table = [
-                    st
-                    for st in mapinfo["source_table"]
-                    if st in data[mapinfo["source_base"]]
-                ][0]
-                if "internal_filters" in mapinfo:
-                    for record_id, record in data[mapinfo["source_base"]][source_table][
-                        "records"
-                    ].items():
-                        filter_results = []
-                        for filter_key, filter_val in mapinfo[
-                            "internal_filters"
-                        ].items():
-                            if all(
-                                [
-                                    filter_alias not in record
-                                    for filter_alias in [filter_key]
-                                    + filter_val["aliases"]
-                                ]
-                            ):
-                                filter_results.append(False)
-                            elif filter_val["operator"] == "nonempty":
-                                filter_results.append(
-                                    any(
-                                        [
-                                            bool(record[fk])
-                                            for fk in [filter_key]
-                                            + filter_val["aliases"]
-                                            if fk in record
-                                        ]
-                                    )
-                                )
-                            elif filter_val["operator"] == "in":
-                                for fk in [filter_key] + filter_val["aliases"]:
-                                    if fk in record:
-                                        if isinstance(record[filter_key], list):
-                                            filter_results.append(
-                                                any(
-                                                    fj in filter_val["values"]
-                                                    for fj in record[filter_key]
-                                                )
-                                            )
-                                            break
-                                        else:
-                                            filter_results.append(
-                                                record[filter_key]
-                                                in filter_val["values"]
-                                            )
-                            elif filter_val["operator"] == "not in":
-                                for fk in [filter_key] + filter_val["aliases"]:
-                                    if fk in record:
-                                        if isinstance(record[filter_key], list):
-                                            filter_results.append(
-                                                any(
-                                                    fj not in filter_val["values"]
-                                                    for fj in record[filter_key]
-                                                )
-                                            )
-                                        break
-                                else:
-                                    filter_results.append(
-                                        record[filter_key] not in filter_val["values"]
-                                    )
-                        if not all(filter_results):
-                            logger.debug(
-                                f"Filtered record '{record_id}'"
-                                f" {'(' + record['name'] + ')' if 'name' in record else ''}"
-                                f" from '{table}'."
-                            )
-                            filtered_records.append(record_id)
-                            if table in filtered_records_dict:
-                                filtered_records_dict[table].append(record_id)
-                            else:
-                                filtered_records_dict[table] = [record_id]
-        for key in filtered_records_dict:
-            logger.debug(
-                f"Filtered {len(filtered_records_dict[key])} records for '{key}'."
-            )
-        logger.debug(f"Filtered {len(filtered_records)} records in total.")
-
-        # Perform mapping in case of three-base structure
-        for table, mapinfo in mapping_table.items():
-            intm = mapinfo["internal_mapping"]
-            if mapinfo["source_base"] in data and any(
-                [st in data[mapinfo["source_base"]] for st in mapinfo["source_table"]]
-            ):
-                # Copy the selected data to the one-base structure
-                # - skip filtered records
-                # - rename record attributes according to
-                #   "internal_consistency" settings
-                # - filter references to records for fields that are not
-                #   internally mapped below
-                source_table = [
-                    st
-                    for st in mapinfo["source_table"]
-                    if st in data[mapinfo["source_base"]]
-                ][0]
-                logger.debug(
-                    f"Mapping '{mapinfo['source_base']}' : '{source_table}' -> '{table}'"
-                )
-                mapped_data["Data Request"][table] = {
-                    **data[mapinfo["source_base"]][source_table],
-                    "records": {
-                        record_id: {
-                            mapinfo["internal_consistency"].get(
-                                reckey, reckey
-                            ): _filter_references(
-                                recvalue,
-                                reckey,
-                                table,
-                                record_id,
-                                mapinfo["field_dtypes"].get(
-                                    mapinfo["internal_consistency"].get(reckey, reckey),
-                                    None,
-                                ),
-                            )
-                            for reckey, recvalue in record.items()
-                            if reckey not in mapinfo["drop_keys"]
-                        }
-                        for record_id, record in data[mapinfo["source_base"]][
-                            source_table
-                        ]["records"].items()
-                        if record_id not in filtered_records
-                    },
-                }
-
-                # If record attributes require mapping
-                if intm != {}:
-                    # for each attribute that requires mapping
-                    for attr in intm.keys():
-                        intm_table = [
-                            tn
-                            for tn in mapping_table.keys()
-                            if tn in mapping_table[tn]["source_table"]
-                            and tn == intm[attr]["table"]
-                        ][0]
-                        intm_table_alias = [
-                            tn
-                            for tn in mapping_table[intm_table]["source_table"]
-                            if tn in data[intm[attr]["base"]]
-                        ]
-                        try:
-                            intm_table_alias = intm_table_alias[0]
-                        except IndexError:
-                            errmsg = f"None of the following tables exist in the data: {mapping_table[intm[attr]['table']]['source_table']}."
-                            logger.error(errmsg)
-                            raise ValueError(errmsg)
-
-                        for record_id, record in data[mapinfo["source_base"]][
-                            source_table
-                        ]["records"].items():
-                            if record_id in filtered_records:
-                                continue
-                            elif (
-                                attr not in record
-                                or record[attr] is None
-                                or record[attr] == ""
-                                or record[attr] == []
-                            ):
-                                # Attribute name not found for record, but might have a different name
-                                #  in another export type or release version
-                                logger.debug(
-                                    f"{table}: Attribute '{attr}' not found for record '{record_id}'."
-                                )
-                                attr_aliases = [
-                                    a
-                                    for a in mapinfo["internal_consistency"].keys()
-                                    if mapinfo["internal_consistency"][a] == attr
-                                ]
-                                attr_alias_found = False
-                                for a in attr_aliases:
-                                    if a in record:
-                                        attr_vals = record[a]
-                                        attr_alias_found = True
-                                        logger.debug(
-                                            f"{table}: Using attribute '{a}' instead for record '{record_id}'."
-                                        )
-                                        break
-                                if not attr_alias_found:
-                                    continue
-                            else:
-                                attr_vals = record[attr]
-
-                            # Get list of record-keys of the attribute (eg. "Variables")
-                            #   that is connected to the current record of the "source_table
-                            #   (eg. "Variable Groups") by the specified "operation"
-                            if intm[attr]["operation"] == "split":
-                                if isinstance(attr_vals, list):
-                                    errmsg = (
-                                        f"Consolidation of {table}@{attr}: Selected 'split' operation"
-                                        f" for a list {record_id}:",
-                                        attr_vals,
-                                    )
-                                    logger.error(f"TypeError: {errmsg}")
-                                    continue
-                                    # raise TypeError({errmsg})
-                                else:
-                                    attr_vals = list(
-                                        map(
-                                            lambda x: x.strip('"'),
-                                            re.split(
-                                                r',\s*(?=(?:[^"]|"[^"]*")*$)', attr_vals
-                                            ),
-                                        )
-                                    )
-                            elif intm[attr]["operation"] == "":
-                                if isinstance(attr_vals, str):
-                                    attr_vals = [attr_vals]
-                            else:
-                                errmsg = (
-                                    f"Unknown internal mapping operation for attribute '{attr}'"
-                                    f" ('{source_table}'): '{intm[attr]['operation']}'"
-                                )
-                                logger.error(f"ValueError: {errmsg}")
-                                raise ValueError(errmsg)
-
-                            # Get mapped record_ids for this list of record-keys
-                            # entry_type - single record_id or list of record_ids
-                            # - map by record_id
-                            if intm[attr]["entry_type"] == "record_id":
-                                if not intm[attr]["base_copy_of_table"]:
-                                    errmsg = (
-                                        "A copy of the table in the same base is required if 'entry_type'"
-                                        " is set to 'record_id', but 'base_copy_of_table' is set to"
-                                        f" False: '{source_table}' - '{attr}'"
-                                    )
-                                    logger.error(f"ValueError: {errmsg}")
-                                    raise ValueError(errmsg)
-                                elif not intm[attr]["base"] in data:
-                                    errmsg = f"Base '{intm[attr]['base']}' not found in data."
-                                    logger.error(f"KeyError: {errmsg}")
-                                    raise KeyError(errmsg)
-                                elif (
-                                    intm[attr]["base_copy_of_table"]
-                                    not in data[mapinfo["source_base"]]
-                                ):
-                                    errmsg = f"Table '{intm[attr]['base_copy_of_table']}' not found in base '{mapinfo['source_base']}'."
-                                    logger.error(f"KeyError: {errmsg}")
-                                    raise KeyError(errmsg)
-
-                                recordIDs_new = []
-                                for attr_val in attr_vals:
-                                    # The record copy in the current base
-                                    record_copy = data[mapinfo["source_base"]][
-                                        intm[attr]["base_copy_of_table"]
-                                    ]["records"][attr_val]
-                                    # The entire list of records in the base of origin
-                                    recordlist = data[intm[attr]["base"]][
-                                        intm_table_alias
-                                    ]["records"]
-                                    recordID_new = _map_record_id(
-                                        record_copy,
-                                        recordlist,
-                                        intm[attr]["map_by_key"],
-                                    )
-                                    recordID_filtered = [
-                                        r
-                                        for r in recordID_new
-                                        if r not in filtered_records
-                                    ]
-                                    if len(recordID_filtered) == 0:
-                                        if len(recordID_new) == 0:
-                                            logger.debug(
-                                                f"Consolidation of {table}@{intm_table_alias}: No matching"
-                                                f" record found for attribute '{attr}' with value '{attr_val}'."
-                                            )
-                                    elif len(recordID_filtered) > 1:
-                                        logger.warning(
-                                            f"Consolidation of {table}@{intm_table_alias}:"
-                                            f" Multiple matching records found for attribute '{attr}' with"
-                                            f" value '{attr_val}': {recordID_new}. Using first match."
-                                        )
-                                        recordIDs_new.append(recordID_filtered[0])
-                                    else:
-                                        recordIDs_new.append(recordID_filtered[0])
-
-                            # entry_type - name (eg. unique label or similar)
-                            # - map by attribute value
-                            elif intm[attr]["entry_type"] == "name":
-                                recordIDs_new = []
-                                for attr_val in attr_vals:
-                                    recordID_new = _map_attribute(
-                                        attr_val,
-                                        data[intm[attr]["base"]][intm_table_alias][
-                                            "records"
-                                        ],
-                                        (
-                                            [intm[attr]["map_by_key"]]
-                                            if isinstance(intm[attr]["map_by_key"], str)
-                                            else intm[attr]["map_by_key"]
-                                        ),
-                                    )
-                                    recordID_filtered = [
-                                        r
-                                        for r in recordID_new
-                                        if r not in filtered_records
-                                    ]
-                                    if len(recordID_filtered) == 0:
-                                        if len(recordID_new) == 0:
-                                            logger.debug(
-                                                f"Consolidation of {table}@{intm_table_alias}: No matching"
-                                                f" record found for attribute '{attr}' with value '{attr_val}'."
-                                            )
-                                    elif len(recordID_filtered) > 1:
-                                        logger.debug(
-                                            "Consolidation of"
-                                            f" {table}@{intm_table_alias}: Multiple matching records found"
-                                            f" for attribute '{attr}' with value '{attr_val}': {recordID_new}"
-                                        )
-                                        recordIDs_new.append(recordID_filtered[0])
-                                    else:
-                                        recordIDs_new.append(recordID_filtered[0])
-                            else:
-                                errmsg = (
-                                    f"Unknown 'entry_type' specified for attribute '{attr}'"
-                                    f" ('{source_table}'): '{intm[attr]['entry_type']}'"
-                                )
-                                logger.error(f"ValueError: {errmsg}")
-                                raise ValueError(errmsg)
-                            if not recordIDs_new:
-                                errmsg = (
-                                    f"{table} (record '{record_id}'): For attribute"
-                                    f" '{attr}' no records could be mapped."
-                                )
-                                logger.error(errmsg)
-                                # This case can actually happen for the 'Coordinate and Dimension' table
-                                # raise KeyError(errmsg)
-                            try:
-                                mapped_data["Data Request"][table]["records"][
-                                    record_id
-                                ][
-                                    mapinfo["internal_consistency"].get(attr, attr)
-                                ] = list(
-                                    set(recordIDs_new)
-                                )
-                            except KeyError:
-                                logger.debug(
-                                    f"Consolidation of {table}@{intm_table_alias}:"
-                                    f" '{record_id}' not found when adding"
-                                    f" Attribute '{attr}': {recordIDs_new}"
-                                )
-            else:
-                if mapinfo["source_base"] not in data:
-                    missing_bases.append(mapinfo["source_base"])
-                elif all(
-                    [
-                        st not in data[mapinfo["source_base"]]
-                        for st in mapinfo["source_table"]
-                    ]
-                ):
-                    missing_tables.append(mapinfo["source_table"][0])
-        if len(missing_bases) > 0:
-            errmsg = (
-                "Encountered missing bases when consolidating the data:"
-                f" {set(missing_bases)}"
-            )
-            logger.critical(errmsg)
-            raise KeyError(errmsg)
-        if len(missing_tables) > 0:
-            logger.warning(
-                "Encountered missing tables when consolidating the data (not"
-                f" necessarily problematic): {missing_tables}"
-            )
+        filtered_records = context.get_filtered_records()
         return _apply_hard_fixes(mapped_data)
     # Return the data if it is already one-base
     elif len(data.keys()) == 1:
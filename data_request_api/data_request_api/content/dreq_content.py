@@ -1,31 +1,59 @@
 #!/usr/bin/env python
 
 import atexit
+import concurrent.futures
+import hashlib
+import io
 import json
 import os
+import pickle
 import re
+import tarfile
 import time
 import warnings
-from filecmp import cmp
-from shutil import move
-
-import pooch
-import requests
-from bs4 import BeautifulSoup
+from collections import OrderedDict
 
 import data_request_api.utilities.config as dreqcfg
+from data_request_api import version as api_version
 from data_request_api.content import consolidate_export as ce
 from data_request_api.content.mapping_table import mapping_table
 from data_request_api.utilities.decorators import append_kwargs_from_config
 from data_request_api.utilities.logger import get_logger  # noqa
+from data_request_api.utilities.tools import (COMPRESSION_SUFFIXES, compress_file, file_lock, files_equal,
+                                              find_file, get_compression, open_file, remove_lock,
+                                              strip_compression_suffix, temp_path)
 
-# Suppress pooch info output
-pooch.get_logger().setLevel("WARNING")
+# The network and HTML parsing dependencies (requests, bs4, pooch) are imported on the
+#  online code paths only, sparing their import time to offline and cached runs
 
 # File names of Airtable exports in JSON format
 _json_raw = "dreq_raw_export.json"
 _json_release = "dreq_release_export.json"
 
+# Suffix of the cached consolidated content, stored next to the export
+#  (eg. "dreq_raw_export.consolidated.json" for "dreq_raw_export.json")
+_consolidated_suffix = ".consolidated.json"
+
+# Format of the cached consolidated content - to be increased when it changes
+_consolidated_format = 2
+
+# Suffix of the HTTP validators (ETag, Last-Modified) of "dev" and branch exports,
+#  stored next to the export (eg. "dreq_raw_export.http.json" for "dreq_raw_export.json")
+_validators_suffix = ".http.json"
+
+# File name of the version index (lists of tags and branches) in the cache directory
+_version_index = "versions.json"
+
+# File name of the access index (last access time of the cached files) in the cache directory
+_access_index = "access.json"
+
+# File name of the manifest of the cached versions (exports and files, with their sha256) in the
+#  cache directory - also stored at the root of the offline bundles (see pack, unpack)
+_cache_manifest = "manifest.json"
+
+# Format of the manifest - to be increased when it changes
+_manifest_format = 1
+
 # Base URL template for fetching Dreq content json files from GitHub
 # _github_org = "WCRP-CMIP"
 _github_org = "CMIP-Data-Request"
@@ -69,6 +97,19 @@ except KeyError:
 
 _dreq_content_loaded = {}
 
+# In-memory LRU cache of loaded content, keyed by (version, export, consolidate[, tables])
+#  - see load and the config keys "memory_cache_size" and "memory_cache_max_mb"
+_loaded_content = OrderedDict()
+
+# JSON tokenization of the table-selective loader, reading the exports in chunks (see _JsonStream)
+_json_chunk_size = 1024**2
+_json_whitespace = re.compile(rb"[ \t\n\r]*")
+# A string (its closing quote captured, missing if the string continues in the next chunk)
+_json_string = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*("?)', re.DOTALL)
+# Anything up to the next brace or bracket, or string continuing in the next chunk
+_json_nested = re.compile(rb'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*', re.DOTALL)
+_json_scalar = re.compile(rb"[^ \t\n\r,:\[\]{}\"]*")
+
 # Internal flag used to determine whether a warning on API version can be issued
 # (Purpose is to prevent the warning being issued more than once per session)
 _CHECK_API_VERSION = True
@@ -113,7 +154,7 @@ def get_cached(**kwargs):
     Returns
     -------
     list
-        The list of cached versions.
+        The list of cached versions (with uncompressed or compressed export).
 
     Raises
     ------
@@ -130,7 +171,7 @@ def get_cached(**kwargs):
             elif kwargs["export"] == "release":
                 json_export = _json_release
         local_versions = [
-            name for name in os.listdir(_dreq_res) if os.path.isfile(os.path.join(_dreq_res, name, json_export))
+            name for name in os.listdir(_dreq_res) if find_file(os.path.join(_dreq_res, name, json_export))
         ]
     return local_versions
 
@@ -162,6 +203,8 @@ def _send_api_request(api_url, page_url="", target="tags"):
     Warning
         If an exception occurs when retrieving the list of tags or branches.
     """
+    import requests
+
     # Request the list of tags or branches via the GitHub API
     global _fallback_status_codes
     results = []
@@ -221,6 +264,9 @@ def _send_html_request(page_url, target="tags"):
         Making use of the pagination mechanism of GitHub could only be tested for tags
         so might not work for branches.
     """
+    import requests
+    from bs4 import BeautifulSoup
+
     # Request the list of tags or (active) branches via the GitHub Page
     results = []
     addon = ""
@@ -268,6 +314,83 @@ def _send_html_request(page_url, target="tags"):
     return results
 
 
+def _read_version_index():
+    """Read the version index (lists of tags and branches) from the cache directory.
+
+    Returns
+    -------
+    dict
+        The lists of versions and the time of their retrieval per target ('tags',
+        'branches'), eg. {'tags': {'versions': ['v1.0', ...], 'retrieved': 1700000000.0}}.
+        Empty if no (valid) version index exists.
+    """
+    index_path = os.path.join(_dreq_res, _version_index)
+    if not os.path.isfile(index_path):
+        return {}
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except ValueError:
+        return {}
+    if not isinstance(index, dict):
+        return {}
+    return {
+        target: entry
+        for target, entry in index.items()
+        if isinstance(entry, dict) and isinstance(entry.get("versions"), list)
+        and isinstance(entry.get("retrieved"), (int, float))
+    }
+
+
+def _write_version_index(target, target_versions):
+    """Update the list of versions of the specified target in the version index.
+
+    Parameters
+    ----------
+    target : str
+        The target, either 'tags' or 'branches'.
+    target_versions : list
+        The list of tags or branches.
+    """
+    logger = get_logger()
+    index_path = os.path.join(_dreq_res, _version_index)
+    try:
+        # Lock the read-modify-write, so that concurrent updates of the other target are kept
+        with file_lock(index_path):
+            index = _read_version_index()
+            index[target] = {"versions": list(target_versions), "retrieved": time.time()}
+            _write_json_atomic(index_path, index)
+    except OSError as e:
+        logger.warning(f"Could not update the version index '{index_path}': {e}")
+
+
+def _write_json_atomic(path, content):
+    """Write the content to the JSON file, replacing it atomically.
+
+    Parameters
+    ----------
+    path : str
+        The path of the JSON file.
+    content : dict
+        The content to write.
+
+    Raises
+    ------
+    OSError
+        If the file cannot be written.
+    """
+    # Write to a temporary file first, so that readers never see a partially written file
+    path_temp = temp_path(path)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path_temp, "w") as f:
+            json.dump(content, f, indent=2)
+        os.replace(path_temp, path)
+    finally:
+        if os.path.exists(path_temp):
+            os.remove(path_temp)
+
+
 @append_kwargs_from_config
 def get_versions(target="tags", **kwargs):
     """Fetch list of tags from the GitHub repository using the GitHub API.
@@ -284,7 +407,14 @@ def get_versions(target="tags", **kwargs):
         and is included in the list of tags.
     **kwargs
         offline : bool, optional
-            Whether to disable online requests / retrievals. Defaults to False.
+            Whether to disable online requests / retrievals, in which case the versions
+            listed in the cache manifest are returned. Defaults to False.
+        export : {'raw', 'release'}, optional
+            Export type the versions returned in offline mode are cached with.
+            Defaults to 'release'.
+        version_index_ttl : int, optional
+            Time (in seconds) during which the list of tags or branches persisted in
+            the version index of the cache directory is used without a new request.
 
     Returns
     -------
@@ -299,23 +429,45 @@ def get_versions(target="tags", **kwargs):
     global versions
     global _versions_retrieved_last
     global _CHECK_API_VERSION
+    logger = get_logger()
 
     if target not in ["tags", "branches"]:
         raise ValueError("target must be 'tags' or 'branches'.")
 
     if "offline" in kwargs and kwargs["offline"]:
-        lversions = get_cached(**kwargs)
+        manifest = _read_cache_manifest()
+        if manifest is None:
+            # No cache manifest (eg. cache directory copied by hand): scan the cache directory
+            lversions = get_cached(**kwargs)
+        else:
+            lversions = [lv for lv in manifest if _get_manifest_export(manifest, lv, kwargs.get("export", "release"))]
         if target == "tags":
             versions[target] = [lv for lv in lversions if lv == "dev" or _parse_version(lv) != (0, 0, 0, "", 0)]
         else:
             versions[target] = [lv for lv in lversions if lv != "dev" and _parse_version(lv) == (0, 0, 0, "", 0)]
+        # The locally cached versions must not be taken for the versions available online
+        _versions_retrieved_last[target] = 0
     else:
-        # Retrieve the list of tags or branches from the GitHub API
-        if not versions[target] or _versions_retrieved_last[target] - time.time() > 60 * 60:
-            versions[target] = _send_api_request(REPO_API_URL, REPO_PAGE_URL, target)
-
-            # Update the last time the tags/branches were retrieved
-            _versions_retrieved_last[target] = time.time()
+        ttl = kwargs.get("version_index_ttl", 3600)
+        if not versions[target] or time.time() - _versions_retrieved_last[target] > ttl:
+            # Use the version index persisted by a previous session unless outdated
+            index_entry = _read_version_index().get(target, {})
+            if index_entry and time.time() - index_entry["retrieved"] <= ttl:
+                versions[target] = list(index_entry["versions"])
+                _versions_retrieved_last[target] = index_entry["retrieved"]
+            else:
+                # Retrieve the list of tags or branches from the GitHub API
+                results = _send_api_request(REPO_API_URL, REPO_PAGE_URL, target)
+                if results:
+                    _write_version_index(target, results)
+                elif index_entry:
+                    # Fall back to the outdated version index if the retrieval failed
+                    logger.warning(f"Using the outdated list of '{target}' of the version index.")
+                    results = list(index_entry["versions"])
+                versions[target] = results
+
+                # Update the last time the tags/branches were retrieved
+                _versions_retrieved_last[target] = time.time()
 
         if target == "tags" and "dev" not in versions[target]:
             versions[target].append("dev")
@@ -371,11 +523,20 @@ def retrieve(version="latest_stable", **kwargs):
             Export type. Defaults to 'release'.
         offline : bool, optional
             Whether to disable online requests / retrievals. Defaults to False.
+        threads : int, optional
+            Number of threads retrieving several versions (eg. 'all') concurrently.
+            Defaults to 1, ie. the versions are retrieved one after another.
+        cache_compression : {'none', 'gzip', 'zstd'}, optional
+            Compression of newly retrieved exports. Exports cached with a different
+            compression are used as they are.
+        cache_budget_mb : int, optional
+            Size budget of the cache directory in MB (0 for no limit). Least recently
+            used files are evicted when exceeded (see evict).
 
     Returns
     -------
     dict
-        The path to the retrieved JSON file.
+        The path to the retrieved JSON file (with compression suffix if compressed).
 
     Raises
     ------
@@ -386,7 +547,8 @@ def retrieve(version="latest_stable", **kwargs):
     Warning
         If the known kwargs have an invalid value.
     Warning
-        If the specified version could not be downloaded or (if applicable) updated.
+        If the specified version(s) could not be downloaded or (if applicable) updated
+        (a single warning listing all failed versions).
     """
     logger = get_logger()
     if version == "latest":
@@ -408,85 +570,44 @@ def retrieve(version="latest_stable", **kwargs):
     elif version in ["v1.0alpha"] and "export" in kwargs and kwargs["export"] == "raw":
         warnings.warn(f"For version '{version}' no raw export exists. Defaulting to release export.")
 
+    # Retrieve the versions, concurrently if requested
+    threads = kwargs.get("threads", 1)
     json_paths = dict()
-    for version in versions:
-        # Define the path for storing the dreq.json in the installation directory
-        #  Store it as path_to_api/content/dreq_res/version/{_json_raw/release}
-        retrieve_to_dir = os.path.join(_dreq_res, version)
-        # Decide whether to download release or raw json file
-        if "export" in kwargs:
-            if kwargs["export"] == "release" or version == "v1.0alpha":
-                json_export = _json_release
-            elif kwargs["export"] == "raw":
-                json_export = _json_raw
-        elif _version_pattern.match(version):
-            json_export = _json_release
-        else:
-            json_export = _json_raw
-        json_path = os.path.join(retrieve_to_dir, json_export)
-
-        if "offline" in kwargs and kwargs["offline"]:
-            if os.path.isfile(json_path):
+    errors = dict()
+    if threads > 1 and len(versions) > 1:
+        # Fetch the list of tags once, rather than from every thread
+        tags = None if "offline" in kwargs and kwargs["offline"] else get_versions()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {
+                executor.submit(_retrieve_version, version, tags=tags, **kwargs): version
+                for version in versions
+            }
+            for n, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                version = futures[future]
+                json_path, error = future.result()
+                logger.info(f"Retrieval {n}/{len(versions)}: version '{version}' {'failed' if error else 'done'}.")
+                if json_path:
+                    json_paths[version] = json_path
+                if error:
+                    errors[version] = error
+        # Keep the order of the requested versions
+        json_paths = {version: json_paths[version] for version in versions if version in json_paths}
+    else:
+        for version in versions:
+            json_path, error = _retrieve_version(version, **kwargs)
+            if json_path:
                 json_paths[version] = json_path
-        else:
-            os.makedirs(retrieve_to_dir, exist_ok=True)
-
-            # If not already cached download with POOCH
-            if not os.path.isfile(json_path):
-                # Download with pooch - use "main" branch for "dev"
-                try:
-                    if version == "dev":
-                        url = REPO_RAW_URL_DEV.format(
-                            version=_dev_branch, _json_export=json_export, _github_org=_github_org)
-                    elif version not in get_versions():
-                        url = REPO_RAW_URL.format(
-                            version=version, _json_export=json_export, _github_org=_github_org, target="heads")
-                    else:
-                        url = REPO_RAW_URL.format(
-                            version=version, _json_export=json_export, _github_org=_github_org, target="tags")
-                    json_path = pooch.retrieve(
-                        path=retrieve_to_dir,
-                        url=url,
-                        known_hash=None,
-                        fname=json_export,
-                    )
-                except Exception as e:
-                    warnings.warn(f"Could not retrieve version '{version}': {e}")
-                    continue
-                logger.info(f"Retrieved version '{version}'.")
-
-            # or if the version is "dev" or a branch rather than a tag
-            elif version == "dev" or version not in get_versions():
-                # Download with pooch to temporary file and compare to cached version
-                json_path_temp = json_path + ".tmp"
-                try:
-                    # Delete temp file if it exists
-                    if os.path.exists(json_path_temp):
-                        os.remove(json_path_temp)
-                    # Retrieve
-                    if version == "dev":
-                        url = REPO_RAW_URL_DEV.format(
-                            version=_dev_branch, _json_export=json_export, _github_org=_github_org)
-                    else:
-                        url = REPO_RAW_URL.format(
-                            version=version, _json_export=json_export, _github_org=_github_org, target="heads")
-                    json_path_temp = pooch.retrieve(
-                        path=retrieve_to_dir,
-                        url=url,
-                        known_hash=None,
-                        fname=json_export + ".tmp",
-                    )
-                    # Compare files
-                    if not cmp(json_path, json_path_temp, shallow=False):
-                        move(json_path_temp, json_path)
-                        logger.info(f"Updated version '{version}'.")
-                    else:
-                        os.remove(json_path_temp)
-                except Exception as e:
-                    warnings.warn(f"Potential update for version '{version}' failed: {e}")
-
-            # Store the path to the dreq.json in the json_paths dictionary
-            json_paths[version] = json_path
+            if error:
+                errors[version] = error
+
+    # Report all failed retrievals / updates at once
+    if len(errors) == 1:
+        warnings.warn(next(iter(errors.values())))
+    elif errors:
+        warnings.warn(
+            f"Retrieval failed for {len(errors)} version(s):\n"
+            + "\n".join(f"  - {errors[version]}" for version in versions if version in errors)
+        )
 
     # Capture no correct export found for cached versions (offline mode)
     if not json_paths or json_paths == {}:
@@ -494,9 +615,252 @@ def retrieve(version="latest_stable", **kwargs):
             "The version(s) you requested are not cached. Please deactivate offline mode and try again."
         )
 
+    # Keep the cache directory within its budget
+    record_cache_access(list(json_paths.values()), **kwargs)
+
     return json_paths
 
 
+def _validators_path(json_path):
+    """Return the path of the HTTP validators (ETag, Last-Modified) of the specified export."""
+    return os.path.splitext(strip_compression_suffix(json_path))[0] + _validators_suffix
+
+
+def _conditional_download(url, json_path, compression="none", checked_after=None):
+    """Download the file unless it is unchanged since the last download.
+
+    The ETag and Last-Modified headers of the response are stored next to the
+    downloaded file and sent with the next request (If-None-Match, If-Modified-Since),
+    so that an unchanged file is not transferred again (304 Not Modified).
+    The validators are only used as long as the local file is the downloaded one.
+    The caller is expected to hold the lock of the file (see file_lock).
+
+    Parameters
+    ----------
+    url : str
+        The URL of the file.
+    json_path : str
+        The path (without compression suffix) to download the file to.
+    compression : {'none', 'gzip', 'zstd'}, optional
+        The compression of the downloaded file. Defaults to 'none'.
+    checked_after : float, optional
+        If the file was checked against the server after this time (eg. by another
+        process while waiting for the lock), it is used without any request.
+
+    Returns
+    -------
+    tuple
+        The path to the (possibly compressed) file, and whether the file was downloaded
+        and differs from the previously cached one.
+
+    Raises
+    ------
+    requests.exceptions.RequestException
+        If the request fails.
+    """
+    cached_path = find_file(json_path)
+    validators_path = _validators_path(json_path)
+    validators = {}
+    if cached_path and os.path.isfile(validators_path):
+        try:
+            with open(validators_path) as f:
+                validators = json.load(f)
+        except ValueError:
+            validators = {}
+        stat = os.stat(cached_path)
+        if validators.get("url") != url or validators.get("file") != [cached_path, stat.st_size, stat.st_mtime_ns]:
+            validators = {}
+    if checked_after is not None and validators.get("checked", 0) >= checked_after:
+        return cached_path, False
+
+    import requests
+
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    response = requests.get(url, headers=headers, stream=True, timeout=60)
+    if response.status_code == 304:
+        validators["checked"] = time.time()
+        _write_json_atomic(validators_path, validators)
+        return cached_path, False
+    response.raise_for_status()
+
+    # Download to temporary file and compare to cached version
+    json_path_temp = temp_path(json_path)
+    try:
+        with open(json_path_temp, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1024**2):
+                f.write(chunk)
+        updated = cached_path is None or not files_equal(cached_path, json_path_temp)
+        if updated:
+            os.replace(json_path_temp, json_path)
+            path = compress_file(json_path, compression)
+            # Remove the previously cached file if compressed differently
+            if cached_path and cached_path != path:
+                os.remove(cached_path)
+        else:
+            path = cached_path
+    finally:
+        if os.path.exists(json_path_temp):
+            os.remove(json_path_temp)
+
+    # Store the validators of the downloaded file
+    stat = os.stat(path)
+    validators = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "file": [path, stat.st_size, stat.st_mtime_ns],
+        "checked": time.time(),
+    }
+    _write_json_atomic(validators_path, validators)
+    return path, updated
+
+
+def _retrieve_version(version, tags=None, **kwargs):
+    """Retrieve the JSON file for a single version (see retrieve).
+
+    Parameters
+    ----------
+    version: str
+        The version to retrieve, eg. 'dev' or '1.0.0'.
+    tags: list, optional
+        The list of tags (see get_versions). Fetched if not specified.
+    **kwargs
+        export : {'raw', 'release'}, optional
+            Export type.
+        offline : bool, optional
+            Whether to disable online requests / retrievals.
+
+    Returns
+    -------
+    tuple
+        The path to the retrieved JSON file (or None if not available)
+        and the error message (or None if retrieved / updated successfully).
+    """
+    logger = get_logger()
+
+    # Define the path for storing the dreq.json in the installation directory
+    #  Store it as path_to_api/content/dreq_res/version/{_json_raw/release}
+    retrieve_to_dir = os.path.join(_dreq_res, version)
+    # Decide whether to download release or raw json file
+    if "export" in kwargs:
+        if kwargs["export"] == "release" or version == "v1.0alpha":
+            json_export = _json_release
+        elif kwargs["export"] == "raw":
+            json_export = _json_raw
+    elif _version_pattern.match(version):
+        json_export = _json_release
+    else:
+        json_export = _json_raw
+    json_path = os.path.join(retrieve_to_dir, json_export)
+
+    if "offline" in kwargs and kwargs["offline"]:
+        manifest = _read_cache_manifest()
+        export = "raw" if json_export == _json_raw else "release"
+        if manifest is not None and _get_manifest_export(manifest, version, export):
+            return _get_manifest_export(manifest, version, export), None
+        return find_file(json_path), None
+
+    os.makedirs(retrieve_to_dir, exist_ok=True)
+
+    # Define the URL - use "main" branch for "dev"
+    is_branch = version == "dev" or version not in (get_versions() if tags is None else tags)
+    if version == "dev":
+        url = REPO_RAW_URL_DEV.format(
+            version=_dev_branch, _json_export=json_export, _github_org=_github_org)
+    elif is_branch:
+        url = REPO_RAW_URL.format(
+            version=version, _json_export=json_export, _github_org=_github_org, target="heads")
+    else:
+        url = REPO_RAW_URL.format(
+            version=version, _json_export=json_export, _github_org=_github_org, target="tags")
+
+    # Compression of newly downloaded exports
+    compression = get_compression(kwargs.get("cache_compression", "none"))
+
+    # Only one process / thread downloads the export at a time, the others
+    #  wait for it and reuse its result
+    waiting_since = time.time()
+    with file_lock(json_path):
+        return _retrieve_version_locked(
+            version, url, json_path, is_branch, compression, waiting_since)
+
+
+def _retrieve_version_locked(version, url, json_path, is_branch, compression, waiting_since):
+    """Retrieve the JSON file for a single version while holding its lock (see _retrieve_version).
+
+    Parameters
+    ----------
+    version : str
+        The version to retrieve.
+    url : str
+        The URL of the export.
+    json_path : str
+        The path (without compression suffix) of the export.
+    is_branch : bool
+        Whether the version is 'dev' or a branch, whose content may change.
+    compression : {'none', 'gzip', 'zstd'}
+        The compression of newly downloaded exports.
+    waiting_since : float
+        The time the lock was requested. Exports of branches checked since then
+        (by the process / thread that held the lock) are not checked again.
+
+    Returns
+    -------
+    tuple
+        The path to the retrieved JSON file (or None if not available)
+        and the error message (or None if retrieved / updated successfully).
+    """
+    logger = get_logger()
+    retrieve_to_dir, json_export = os.path.split(json_path)
+    # The cached export (uncompressed or compressed), if any
+    cached_path = find_file(json_path)
+
+    # The content of tags does not change - if not already cached download with POOCH
+    if not is_branch:
+        if cached_path:
+            return cached_path, None
+        try:
+            import pooch
+
+            # Suppress pooch info output
+            pooch.get_logger().setLevel("WARNING")
+            json_path = pooch.retrieve(
+                path=retrieve_to_dir,
+                url=url,
+                known_hash=None,
+                fname=json_export,
+            )
+            json_path = compress_file(json_path, compression)
+        except Exception as e:
+            return None, f"Could not retrieve version '{version}': {e}"
+        logger.info(f"Retrieved version '{version}'.")
+        _update_cache_manifest(added={json_path: _file_info(json_path)})
+        return json_path, None
+
+    # The content of "dev" and branches may change - download it unless it is
+    #  unchanged since the last download (conditional request)
+    try:
+        json_path, updated = _conditional_download(url, json_path, compression, checked_after=waiting_since)
+    except Exception as e:
+        if cached_path:
+            return cached_path, f"Potential update for version '{version}' failed: {e}"
+        return None, f"Could not retrieve version '{version}': {e}"
+    if not cached_path:
+        logger.info(f"Retrieved version '{version}'.")
+    elif updated:
+        logger.info(f"Updated version '{version}'.")
+    if updated:
+        _update_cache_manifest(
+            added={json_path: _file_info(json_path)},
+            removed=[cached_path] if cached_path and cached_path != json_path else [],
+        )
+    return json_path, None
+
+
 @append_kwargs_from_config
 def delete(version="all", keep_latest=False, **kwargs):
     """Delete one or all cached versions with option to keep latest versions.
@@ -562,14 +926,534 @@ def delete(version="all", keep_latest=False, **kwargs):
         cached_files = [os.path.join(_dreq_res, v, _json_raw) for v in local_versions]
     elif kwargs["export"] == "release":
         cached_files = [os.path.join(_dreq_res, v, _json_release) for v in local_versions]
+    # ... including compressed exports, the cached consolidated content and HTTP validators
+    cached_files += [f + suffix for f in cached_files for suffix in COMPRESSION_SUFFIXES.values()] + [
+        _consolidated_cache_path(f) for f in cached_files] + [_validators_path(f) for f in cached_files]
 
     # Delete files
+    deleted = []
     for f in cached_files:
         if os.path.isfile(f):
             if "dryrun" in kwargs and kwargs["dryrun"]:
                 logger.info(f"Dryrun: would delete '{f}'.")
             else:
-                os.remove(f)
+                with file_lock(f):
+                    os.remove(f)
+                    remove_lock(f)
+                deleted.append(f)
+    if deleted:
+        _update_cache_manifest(removed=deleted)
+
+
+def _file_info(path):
+    """Return the sha256 (hex digest) and size of the specified file, as listed in the manifest."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            sha256.update(chunk)
+    return {"sha256": sha256.hexdigest(), "size": os.path.getsize(path)}
+
+
+def _manifest_version_entry(files):
+    """Return the manifest entry of a version from the info of its files.
+
+    Parameters
+    ----------
+    files : dict
+        The sha256 and size per file name (see _file_info).
+
+    Returns
+    -------
+    dict
+        The file name per export type ('raw', 'release') and the info per file name,
+        eg. {'exports': {'release': 'dreq_release_export.json.gz'}, 'files': {...}}.
+    """
+    exports = {}
+    for filename in sorted(files):
+        for export, json_export in [("raw", _json_raw), ("release", _json_release)]:
+            if strip_compression_suffix(filename) == json_export:
+                exports[export] = filename
+    return {"exports": exports, "files": files}
+
+
+def _get_manifest_export(manifest, version, export):
+    """Return the path of the export of the version listed in the manifest.
+
+    Parameters
+    ----------
+    manifest : dict
+        The entries per version of the cache manifest (see _read_cache_manifest).
+    version : str
+        The version.
+    export : {'raw', 'release'}
+        Export type.
+
+    Returns
+    -------
+    str or None
+        The path of the cached export, or None if not listed or not cached anymore.
+    """
+    filename = manifest.get(version, {}).get("exports", {}).get(export)
+    if filename is None:
+        return None
+    path = os.path.join(_dreq_res, version, filename)
+    return path if os.path.isfile(path) else None
+
+
+def _read_cache_manifest():
+    """Read the cache manifest (exports and files of the cached versions).
+
+    Returns
+    -------
+    dict or None
+        The entries per version (see _manifest_version_entry), or None if no (valid)
+        cache manifest exists.
+    """
+    manifest_path = os.path.join(_dreq_res, _cache_manifest)
+    if not os.path.isfile(manifest_path):
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except ValueError:
+        return None
+    if (
+        not isinstance(manifest, dict) or manifest.get("format") != _manifest_format
+        or not isinstance(manifest.get("versions"), dict)
+    ):
+        return None
+    return manifest["versions"]
+
+
+def _update_cache_manifest(added=None, removed=()):
+    """Record added / removed files of cached versions in the cache manifest.
+
+    The cache manifest is created with the cached exports if it does not exist yet.
+
+    Parameters
+    ----------
+    added : dict, optional
+        The info (see _file_info) per path of the added files.
+    removed : list, optional
+        Paths of the removed files.
+    """
+    logger = get_logger()
+    manifest_path = os.path.join(_dreq_res, _cache_manifest)
+
+    def version_and_filename(path):
+        parts = os.path.relpath(path, _dreq_res).split(os.sep)
+        return parts if len(parts) == 2 and parts[0] != os.pardir else (None, None)
+
+    try:
+        # Lock the read-modify-write, so that concurrent updates are kept
+        with file_lock(manifest_path):
+            manifest = _read_cache_manifest()
+            added = dict(added or {})
+            if manifest is None:
+                manifest = {}
+                for export, json_export in [("raw", _json_raw), ("release", _json_release)]:
+                    for version in get_cached(export=export):
+                        path = find_file(os.path.join(_dreq_res, version, json_export))
+                        if path not in added:
+                            added[path] = _file_info(path)
+            files = {version: dict(entry.get("files", {})) for version, entry in manifest.items()}
+            for path, info in added.items():
+                version, filename = version_and_filename(path)
+                if version:
+                    files.setdefault(version, {})[filename] = info
+            for path in removed:
+                version, filename = version_and_filename(path)
+                files.get(version, {}).pop(filename, None)
+            manifest = {version: _manifest_version_entry(vfiles) for version, vfiles in sorted(files.items()) if vfiles}
+            _write_json_atomic(manifest_path, {"format": _manifest_format, "versions": manifest})
+    except OSError as e:
+        logger.warning(f"Could not update the cache manifest '{manifest_path}': {e}")
+
+
+def _is_bundled(filename):
+    """Return whether a cached file is part of the offline bundles (see pack, unpack).
+
+    Only JSON files are bundled (exports and transformed content). The consolidated content
+    is regenerated locally, and the HTTP validators are only valid for the cache holding them.
+    """
+    base = strip_compression_suffix(filename)
+    return (
+        base.endswith(".json") and not base.endswith(_consolidated_suffix)
+        and not base.endswith(_validators_suffix)
+    )
+
+
+@append_kwargs_from_config
+def pack(archive, version="all", **kwargs):
+    """Pack cached versions into an offline bundle, eg. for machines without internet access (see unpack).
+
+    The bundle is a tar archive holding the cached JSON files of the versions (raw and
+    release exports, transformed content) and a manifest listing the exports and files
+    of each version with their sha256. The cached consolidated content is not packed,
+    but regenerated when unpacking.
+
+    Parameters
+    ----------
+    archive : str
+        The path of the archive. Compressed according to its extension ('.tar.gz' or '.tgz',
+        '.tar.bz2', '.tar.xz'), uncompressed otherwise.
+    version : str or list, optional
+        The version(s) to pack, or 'all' for all cached versions (default is 'all').
+
+    Returns
+    -------
+    list
+        The packed versions.
+
+    Raises
+    ------
+    ValueError
+        If a specified version is not cached.
+    """
+    logger = get_logger()
+    cached = sorted(set(get_cached(**{**kwargs, "export": "raw"}) + get_cached(**{**kwargs, "export": "release"})))
+    if version == "all":
+        versions = cached
+    else:
+        versions = [version] if isinstance(version, str) else list(version)
+        for v in versions:
+            if v not in cached:
+                raise ValueError(f"Version '{v}' not found.")
+
+    if archive.endswith((".tar.gz", ".tgz")):
+        mode = "w:gz"
+    elif archive.endswith(".tar.bz2"):
+        mode = "w:bz2"
+    elif archive.endswith(".tar.xz"):
+        mode = "w:xz"
+    else:
+        mode = "w"
+    manifest = {}
+    archive_temp = temp_path(archive)
+    try:
+        with tarfile.open(archive_temp, mode) as tar:
+            for v in versions:
+                files = {}
+                for filename in sorted(os.listdir(os.path.join(_dreq_res, v))):
+                    path = os.path.join(_dreq_res, v, filename)
+                    if not os.path.isfile(path) or not _is_bundled(filename):
+                        continue
+                    # Hash and stream a consistent copy of files possibly being written
+                    with file_lock(path):
+                        files[filename] = _file_info(path)
+                        info = tarfile.TarInfo(f"{v}/{filename}")
+                        info.size = files[filename]["size"]
+                        info.mtime = time.time()
+                        with open(path, "rb") as f:
+                            tar.addfile(info, f)
+                manifest[v] = _manifest_version_entry(files)
+            # The manifest comes last, once the files and their sha256 are known
+            content = json.dumps(
+                {"format": _manifest_format, "api_version": api_version, "created": time.time(), "versions": manifest},
+                indent=2,
+            ).encode()
+            info = tarfile.TarInfo(_cache_manifest)
+            info.size = len(content)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(content))
+        os.replace(archive_temp, archive)
+    finally:
+        if os.path.exists(archive_temp):
+            os.remove(archive_temp)
+    logger.info(f"Packed version(s) {versions} into '{archive}'.")
+    return versions
+
+
+@append_kwargs_from_config
+def unpack(archive, **kwargs):
+    """Unpack an offline bundle (see pack) into the cache directory.
+
+    The files are verified against the sha256 listed in the manifest of the bundle and
+    recorded in the cache manifest, read by offline retrievals (see retrieve, get_versions).
+    Cached files of the unpacked versions are replaced. Files of the bundle that are not
+    bundled by pack (eg. consolidated content) are skipped. The consolidated content of the
+    unpacked exports is regenerated locally.
+
+    Parameters
+    ----------
+    archive : str
+        The path of the archive.
+    **kwargs
+        consolidate : bool, optional
+            Whether to consolidate the unpacked exports. Defaults to the config value.
+        cache_consolidated : bool, optional
+            Whether to cache the consolidated content. Consolidation is skipped
+            otherwise. Defaults to True.
+
+    Returns
+    -------
+    list
+        The unpacked versions.
+
+    Raises
+    ------
+    ValueError
+        If the archive is not a valid offline bundle or one of its files does not match
+        its sha256.
+    """
+    logger = get_logger()
+    with tarfile.open(archive, "r:*") as tar:
+        try:
+            manifest = json.load(tar.extractfile(_cache_manifest))
+            if manifest.get("format") != _manifest_format:
+                raise ValueError(f"unsupported format {manifest.get('format')}")
+            versions = manifest["versions"]
+        except (KeyError, ValueError, AttributeError) as e:
+            raise ValueError(f"'{archive}' is not a valid offline bundle: {e}")
+        added = {}
+        removed = []
+        for version, entry in versions.items():
+            for filename, info in entry["files"].items():
+                # Do not write outside of the version directory
+                if any(name in ["", os.curdir, os.pardir] or "/" in name or os.sep in name
+                       for name in [version, filename]):
+                    raise ValueError(f"Invalid file '{version}/{filename}' in '{archive}'.")
+                # Only install files that are read as data, never eg. pickled content
+                if not _is_bundled(filename):
+                    logger.warning(f"Skipping file '{version}/{filename}' of '{archive}', not part of offline bundles.")
+                    continue
+                try:
+                    member = tar.getmember(f"{version}/{filename}")
+                except KeyError:
+                    raise ValueError(f"File '{version}/{filename}' is missing from '{archive}'.")
+                if not member.isfile():
+                    raise ValueError(f"Invalid file '{version}/{filename}' in '{archive}'.")
+                path = os.path.join(_dreq_res, version, filename)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with file_lock(path):
+                    path_temp = temp_path(path)
+                    try:
+                        sha256 = hashlib.sha256()
+                        with tar.extractfile(member) as fsrc, open(path_temp, "wb") as fdst:
+                            for chunk in iter(lambda: fsrc.read(1024**2), b""):
+                                sha256.update(chunk)
+                                fdst.write(chunk)
+                        if sha256.hexdigest() != info["sha256"]:
+                            raise ValueError(f"File '{version}/{filename}' of '{archive}' does not match its sha256.")
+                        os.replace(path_temp, path)
+                    finally:
+                        if os.path.exists(path_temp):
+                            os.remove(path_temp)
+                    # Remove the cached file if stored with a different compression
+                    base = strip_compression_suffix(path)
+                    for other in [base] + [base + suffix for suffix in COMPRESSION_SUFFIXES.values()]:
+                        if os.path.basename(other) not in entry["files"] and os.path.isfile(other):
+                            os.remove(other)
+                            removed.append(other)
+                added[path] = {"sha256": info["sha256"], "size": info["size"]}
+    _update_cache_manifest(added=added, removed=removed)
+    if kwargs.get("consolidate", True) and kwargs.get("cache_consolidated", True):
+        _consolidate_unpacked(added, **kwargs)
+    logger.info(f"Unpacked version(s) {list(versions)} from '{archive}'.")
+    return list(versions)
+
+
+def _consolidate_unpacked(paths, **kwargs):
+    """Regenerate the cached consolidated content of the unpacked exports (see unpack).
+
+    Parameters
+    ----------
+    paths : list
+        Paths of the unpacked files.
+    **kwargs
+        Passed on to _consolidate.
+    """
+    logger = get_logger()
+    for path in paths:
+        export = strip_compression_suffix(os.path.basename(path))
+        version = os.path.basename(os.path.dirname(path))
+        if export not in [_json_raw, _json_release]:
+            continue
+        # Consolidation is not supported for raw exports of versions < v1.2 (see load)
+        if export == _json_raw and _parse_version(version) < _parse_version("v1.2") and version != "dev":
+            continue
+        try:
+            _consolidate(path, version, **kwargs)
+        except Exception as e:
+            logger.warning(f"Could not consolidate the unpacked export '{path}': {e}")
+
+
+def _read_access_index():
+    """Read the access index (last access time per cached file, relative to the cache directory).
+
+    Returns
+    -------
+    dict
+        The last access time per cached file. Empty if no (valid) access index exists.
+    """
+    index_path = os.path.join(_dreq_res, _access_index)
+    if not os.path.isfile(index_path):
+        return {}
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except ValueError:
+        return {}
+    if not isinstance(index, dict):
+        return {}
+    return {path: accessed for path, accessed in index.items() if isinstance(accessed, (int, float))}
+
+
+def _update_access_index(accessed=(), evicted=()):
+    """Record the access / eviction of cached files in the access index.
+
+    Parameters
+    ----------
+    accessed : list, optional
+        Paths of the accessed files.
+    evicted : list, optional
+        Paths of the evicted files.
+    """
+    logger = get_logger()
+    index_path = os.path.join(_dreq_res, _access_index)
+    try:
+        # Lock the read-modify-write, so that concurrent updates are kept
+        with file_lock(index_path):
+            index = _read_access_index()
+            now = time.time()
+            for path in accessed:
+                index[os.path.relpath(path, _dreq_res)] = now
+            for path in evicted:
+                index.pop(os.path.relpath(path, _dreq_res), None)
+            _write_json_atomic(index_path, index)
+    except OSError as e:
+        logger.warning(f"Could not update the access index '{index_path}': {e}")
+
+
+def _get_cached_artifacts():
+    """List the cached artifacts (exports, consolidated and transformed content).
+
+    The HTTP validators of an export are counted as part of the export.
+
+    Returns
+    -------
+    list
+        Tuples of path, size (bytes) and last access time of the artifacts, least
+        recently used first. The last access time defaults to the modification time.
+    """
+    access = _read_access_index()
+    artifacts = []
+    if not os.path.isdir(_dreq_res):
+        return artifacts
+    for name in sorted(os.listdir(_dreq_res)):
+        version_dir = os.path.join(_dreq_res, name)
+        if not os.path.isdir(version_dir):
+            continue
+        for filename in sorted(os.listdir(version_dir)):
+            path = os.path.join(version_dir, filename)
+            # Skip temporary files (possibly being written), lock files and the HTTP validators
+            if (
+                not os.path.isfile(path) or ".tmp" in filename or filename.endswith(".lock")
+                or filename.endswith(_validators_suffix)
+            ):
+                continue
+            size = os.path.getsize(path)
+            if strip_compression_suffix(filename) in [_json_raw, _json_release] and os.path.isfile(
+                _validators_path(path)
+            ):
+                size += os.path.getsize(_validators_path(path))
+            accessed = access.get(os.path.relpath(path, _dreq_res), os.path.getmtime(path))
+            artifacts.append((path, size, accessed))
+    return sorted(artifacts, key=lambda artifact: artifact[2])
+
+
+@append_kwargs_from_config
+def evict(keep=None, **kwargs):
+    """Evict the least recently used cached artifacts to keep the cache directory within budget.
+
+    The cached artifacts are the exports (raw, release), the cached consolidated content
+    and the transformed content (DR, VS) of each version. Artifacts locked by another
+    process / thread (eg. being downloaded or written) are not evicted.
+
+    Parameters
+    ----------
+    keep : list, optional
+        Paths of files not to evict (eg. the ones currently in use).
+    **kwargs
+        cache_budget_mb : int, optional
+            Size budget of the cache directory in MB (0 for no limit).
+            Defaults to the config value.
+        dryrun : bool, optional
+            Whether to only list the files that would be evicted instead of actually
+            evicting them. Defaults to False.
+
+    Returns
+    -------
+    list
+        The paths of the evicted files (or, if dryrun, of the files that would be evicted).
+    """
+    logger = get_logger()
+    budget = kwargs.get("cache_budget_mb", 0) * 1024**2
+    if budget <= 0:
+        return []
+    keep = {os.path.abspath(path) for path in (keep or []) if path}
+    artifacts = _get_cached_artifacts()
+    total = sum(size for _, size, _ in artifacts)
+    evicted = []
+    evicted_validators = []
+    for path, size, accessed in artifacts:
+        if total <= budget:
+            break
+        if os.path.abspath(path) in keep:
+            continue
+        if "dryrun" in kwargs and kwargs["dryrun"]:
+            logger.info(
+                f"Dryrun: would evict '{path}' ({size / 1024**2:.1f} MB,"
+                f" last accessed {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(accessed))})."
+            )
+        else:
+            with file_lock(path, blocking=False) as locked:
+                if not locked or not os.path.isfile(path):
+                    logger.debug(f"Skipping eviction of '{path}' in use.")
+                    continue
+                logger.info(f"Evicting '{path}' ({size / 1024**2:.1f} MB).")
+                os.remove(path)
+                remove_lock(path)
+                if os.path.isfile(_validators_path(path)) and find_file(strip_compression_suffix(path)) is None:
+                    os.remove(_validators_path(path))
+                    evicted_validators.append(_validators_path(path))
+        evicted.append(path)
+        total -= size
+    if total > budget:
+        logger.warning(
+            f"The cache directory ({total / 1024**2:.1f} MB) exceeds its budget"
+            f" ({budget / 1024**2:.1f} MB) with the files in use."
+        )
+    if evicted and not ("dryrun" in kwargs and kwargs["dryrun"]):
+        _update_access_index(evicted=evicted)
+        _update_cache_manifest(removed=evicted + evicted_validators)
+    return evicted
+
+
+@append_kwargs_from_config
+def record_cache_access(paths, **kwargs):
+    """Record the access of cached files and evict least recently used artifacts
+    if the cache directory exceeds its budget (see evict).
+
+    Parameters
+    ----------
+    paths : list
+        Paths of the accessed files (files outside the cache directory are ignored).
+    **kwargs
+        cache_budget_mb : int, optional
+            Size budget of the cache directory in MB (0 for no limit).
+            Defaults to the config value.
+    """
+    cache_dir = os.path.abspath(_dreq_res)
+    paths = [
+        path for path in paths
+        if path and os.path.isfile(path) and os.path.abspath(path).startswith(cache_dir + os.sep)
+    ]
+    if not paths:
+        return
+    _update_access_index(accessed=paths)
+    if kwargs.get("cache_budget_mb", 0) > 0:
+        evict(keep=paths, **{**kwargs, "dryrun": False})
 
 
 @append_kwargs_from_config
@@ -592,6 +1476,27 @@ def load(version="latest_stable", **kwargs):
         force_consolidate : bool, optional
             Whether to force consolidation of the data request dictionary for raw exports
             of versions "<v1.2", where consolidation is not supported. Defaults to False.
+        workers : int, optional
+            Number of worker processes consolidating a raw export in parallel.
+            Defaults to None, ie. serial consolidation.
+        cache_consolidated : bool, optional
+            Whether to cache the consolidated content next to the export and to load
+            it from there while the export, the API version and the mapping table are
+            unchanged. Defaults to True.
+        memory_cache_size : int, optional
+            Number of loaded contents to keep in memory (0 to disable). Every call
+            returns its own copy of the content, so that the cache only pays off when
+            copying is cheaper than loading. Defaults to the config value (disabled).
+        memory_cache_max_mb : int, optional
+            Maximum size (MB) of the contents kept in memory (0 for no limit).
+            Defaults to the config value.
+        tables : list, optional
+            Names of the tables to load (consolidated names if consolidated). The records
+            of the other tables are skipped when reading the export and the tables are
+            kept without records, so that links to them can still be resolved. For raw
+            exports to be consolidated, the tables required by the consolidation of the
+            specified ones are loaded as well. The cached consolidated content is not
+            used. Defaults to None, ie. all tables are loaded.
 
     Returns:
         dict: of the loaded JSON file.
@@ -611,33 +1516,562 @@ def load(version="latest_stable", **kwargs):
 
     _dreq_content_loaded["json_path"] = json_path
 
-    with open(json_path) as f:
-        consolidate_error = (
-            "Consolidation mapping is not supported for raw exports of versions < v1.2."
-            " Set 'export' to \"release\" (recommended), or set 'consolidate' to True"
-            " or set 'force_consolidate' to True to force consolidation regardless."
-        )
-        consolidate_warning = (
-            "Consolidation mapping is not supported for raw exports of versions < v1.2." " Forcing it regardless ..."
-        )
-        if "consolidate" in kwargs:
-            if kwargs["consolidate"]:
-                if "export" in kwargs and kwargs["export"] == "raw":
-                    if _parse_version(version) < _parse_version("v1.2") and version != "dev":
-                        if "force_consolidate" in kwargs and kwargs["force_consolidate"]:
-                            logger.warning(consolidate_warning)
-                        else:
-                            logger.error(consolidate_error)
-                            raise ValueError(consolidate_error)
-                return ce.map_data(json.load(f), mapping_table, next(iter(version_dict.keys())), **kwargs)
+    consolidate_error = (
+        "Consolidation mapping is not supported for raw exports of versions < v1.2."
+        " Set 'export' to \"release\" (recommended), or set 'consolidate' to True"
+        " or set 'force_consolidate' to True to force consolidation regardless."
+    )
+    consolidate_warning = (
+        "Consolidation mapping is not supported for raw exports of versions < v1.2." " Forcing it regardless ..."
+    )
+    version_tag = next(iter(version_dict.keys()))
+    consolidate = kwargs.get("consolidate", True)
+    if consolidate and "export" in kwargs and kwargs["export"] == "raw":
+        if _parse_version(version) < _parse_version("v1.2") and version != "dev":
+            if "force_consolidate" in kwargs and kwargs["force_consolidate"]:
+                logger.warning(consolidate_warning)
             else:
-                return json.load(f)
+                logger.error(consolidate_error)
+                raise ValueError(consolidate_error)
+
+    tables = kwargs.get("tables", None)
+    if tables is not None:
+        tables = tuple(sorted(set(tables)))
+
+    # Look up the content in the in-memory cache
+    memory_cache_size = kwargs.get("memory_cache_size", 0)
+    if memory_cache_size > 0:
+        cache_key = (version_tag, kwargs.get("export", None), consolidate)
+        if tables is not None:
+            cache_key += (tables,)
+        signature = _loaded_signature(json_path, consolidate)
+        content = _get_loaded(cache_key, signature)
+        if content is not None:
+            logger.debug(f"Loaded version '{version_tag}' from the in-memory cache.")
+            return content
+
+    if tables is not None:
+        content = _load_tables(json_path, version_tag, **{**kwargs, "tables": tables})
+        record_cache_access([json_path], **kwargs)
+    elif consolidate:
+        content = _consolidate(json_path, version_tag, **kwargs)
+        record_cache_access([json_path, _consolidated_cache_path(json_path)], **kwargs)
+    else:
+        with open_file(json_path) as f:
+            content = json.load(f)
+
+    if memory_cache_size > 0:
+        _put_loaded(
+            cache_key, signature, content, memory_cache_size, kwargs.get("memory_cache_max_mb", 0)
+        )
+    return content
+
+
+class _JsonStream:
+    """Tokenizer of a JSON document read in chunks from a binary file.
+
+    Values are skipped without being buffered or decoded: strings (and their escapes),
+    objects and arrays are followed to find their end, whatever the layout of the document.
+    Values to decode are buffered alone. Only the unconsumed part of the current chunk is
+    kept otherwise.
+
+    Parameters
+    ----------
+    f : file
+        The binary file, read sequentially.
+    chunk_size : int, optional
+        The size of the chunks read from the file. Defaults to _json_chunk_size.
+    """
+
+    def __init__(self, f, chunk_size=None):
+        self._f = f
+        self._chunk_size = chunk_size or _json_chunk_size
+        self._buffer = b""
+        # Offset of the buffer in the file and position in the buffer
+        self._start = 0
+        self._pos = 0
+        # Start of the value being buffered in the buffer, and its parts from previous chunks
+        self._mark = None
+        self._captured = []
+
+    @property
+    def offset(self):
+        """The offset of the current position in the file."""
+        return self._start + self._pos
+
+    def _fill(self):
+        """Read the next chunk, dropping the consumed part of the buffer. Return False at the end of the file."""
+        # Read at least as much as the unconsumed part, so that a string spanning many
+        #  chunks is not scanned again from its start for each of them
+        chunk = self._f.read(max(self._chunk_size, len(self._buffer) - self._pos))
+        if not chunk:
+            return False
+        if self._mark is not None:
+            self._captured.append(self._buffer[self._mark:self._pos])
+            self._mark = 0
+        self._start += self._pos
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _error(self, message):
+        return ValueError(f"{message} at position {self.offset}.")
+
+    def peek(self):
+        """Skip whitespace and return the next byte (empty at the end of the file)."""
+        while True:
+            self._pos = _json_whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, char):
+        """Skip whitespace and the expected byte."""
+        if self.peek() != char:
+            raise self._error(f"Expecting '{char.decode()}'")
+        self._pos += 1
+
+    def skip_to(self, offset):
+        """Skip to the offset (after the current position) of the file."""
+        while self._start + len(self._buffer) < offset:
+            self._pos = len(self._buffer)
+            if not self._fill():
+                raise self._error("Unexpected end of JSON document")
+        self._pos = offset - self._start
+
+    def _skip_string(self):
+        while True:
+            match = _json_string.match(self._buffer, self._pos)
+            if match.group(1):
+                self._pos = match.end()
+                return
+            # The string continues in the next chunk
+            if not self._fill():
+                raise self._error("Unterminated string")
+
+    def skip_value(self):
+        """Skip the next value. Return its offset in the file.
+
+        The value is tokenized, not validated.
+        """
+        char = self.peek()
+        offset = self.offset
+        if char == b'"':
+            self._skip_string()
+        elif char in [b"{", b"["]:
+            self._pos += 1
+            depth = 1
+            while depth:
+                self._pos = _json_nested.match(self._buffer, self._pos).end()
+                char = self._buffer[self._pos:self._pos + 1]
+                if char in [b"{", b"["]:
+                    depth += 1
+                    self._pos += 1
+                elif char in [b"}", b"]"]:
+                    depth -= 1
+                    self._pos += 1
+                elif not self._fill():
+                    # The end of the file, or of a string, is in the next chunk
+                    raise self._error("Unterminated object or array")
         else:
-            if "export" in kwargs and kwargs["export"] == "raw":
-                if _parse_version(version) < _parse_version("v1.2") and version != "dev":
-                    if "force_consolidate" in kwargs and kwargs["force_consolidate"]:
-                        logger.warning(consolidate_warning)
-                    else:
-                        logger.error(consolidate_error)
-                        raise ValueError(consolidate_error)
-            return ce.map_data(json.load(f), mapping_table, next(iter(version_dict.keys())), **kwargs)
+            while True:
+                self._pos = _json_scalar.match(self._buffer, self._pos).end()
+                if self._pos < len(self._buffer) or not self._fill():
+                    break
+            if self.offset == offset:
+                raise self._error("Expecting value")
+        return offset
+
+    def read_value(self):
+        """Decode the next value."""
+        self.peek()
+        self._mark = self._pos
+        try:
+            self.skip_value()
+            data = b"".join(self._captured + [self._buffer[self._mark:self._pos]])
+        finally:
+            self._mark = None
+            self._captured = []
+        return json.loads(data)
+
+    def read_object(self, decode_member):
+        """Decode the next object.
+
+        Parameters
+        ----------
+        decode_member : callable
+            Called with the key of each member, when the value of the member is next,
+            returns the decoded value.
+
+        Returns
+        -------
+        dict
+            The object.
+
+        Raises
+        ------
+        ValueError
+            If the next value is not a valid JSON object.
+        """
+        self.expect(b"{")
+        result = {}
+        if self.peek() == b"}":
+            self._pos += 1
+            return result
+        while True:
+            if self.peek() != b'"':
+                raise self._error("Expecting property name")
+            key = self.read_value()
+            self.expect(b":")
+            result[key] = decode_member(key)
+            if self.peek() == b"}":
+                self._pos += 1
+                return result
+            self.expect(b",")
+
+
+def _scan_export(f):
+    """Decode the export except for the records of its tables.
+
+    Parameters
+    ----------
+    f : file
+        The export, opened in binary mode.
+
+    Returns
+    -------
+    tuple
+        The export with empty records, and the offset of the records in the file
+        per (base, table).
+    """
+    stream = _JsonStream(f)
+    records_pos = {}
+
+    def decode_table_member(base, table):
+        def decode(key):
+            if key == "records":
+                records_pos[(base, table)] = stream.skip_value()
+                return {}
+            return stream.read_value()
+        return decode
+
+    def decode_base_member(base):
+        def decode(table):
+            if stream.peek() == b"{":
+                return stream.read_object(decode_table_member(base, table))
+            return stream.read_value()
+        return decode
+
+    content = stream.read_object(lambda base: stream.read_object(decode_base_member(base)))
+    if stream.peek():
+        raise ValueError(f"Extra data at position {stream.offset}.")
+    return content, records_pos
+
+
+def _load_tables(json_path, version, **kwargs):
+    """Load (and consolidate) the specified tables of the export (see load).
+
+    The export is read in chunks twice: once for its structure, skipping the records,
+    and once for the records of the required tables.
+
+    Parameters
+    ----------
+    json_path : str
+        The path of the export.
+    version : str
+        The version of the export.
+    **kwargs
+        tables : list
+            Names of the tables to load (consolidated names if consolidated).
+        consolidate : bool, optional
+            Whether to consolidate the content. Defaults to True.
+        Further kwargs are passed on to consolidate_export.map_data.
+
+    Returns
+    -------
+    dict
+        The content, with the records of the specified tables only.
+    """
+    logger = get_logger()
+    tables = kwargs["tables"]
+    consolidate = kwargs.get("consolidate", True)
+    with open_file(json_path, "rb") as f:
+        content, records_pos = _scan_export(f)
+
+    if consolidate and len(content) in [3, 4]:
+        # Raw export: the consolidation of the tables requires further (eg. linked) tables
+        selected = ce.get_required_source_tables(mapping_table, content, tables, version)
+    else:
+        # The consolidation renames tables for consistency across versions
+        names = set(tables)
+        if consolidate:
+            names |= {tfrom for tfrom, tto in ce.version_consistency.items() if tto in names}
+        selected = {(base, table) for (base, table) in records_pos if table in names}
+    selected = sorted((records_pos[key], key) for key in selected if key in records_pos)
+    with open_file(json_path, "rb") as f:
+        stream = _JsonStream(f)
+        for offset, (base, table) in selected:
+            stream.skip_to(offset)
+            content[base][table]["records"] = stream.read_value()
+    logger.debug(f"Loaded the records of {len(selected)} of {len(records_pos)} tables.")
+
+    if consolidate:
+        content = ce.map_data(content, mapping_table, version, **kwargs)
+    found = {table for base in content.values() if isinstance(base, dict) for table in base}
+    missing = [table for table in tables if table not in found]
+    if missing:
+        logger.warning(f"Table(s) not found in version '{version}': {missing}")
+    return content
+
+
+def _loaded_signature(json_path, consolidate):
+    """Return the signature of the loaded content, that changes when the export is updated
+    (or, for consolidated content, when the mapping table is altered)."""
+    stat = os.stat(json_path)
+    signature = (json_path, stat.st_mtime_ns, stat.st_size)
+    if consolidate:
+        signature += (ce.mapping_table_fingerprint(mapping_table),)
+    return signature
+
+
+def _get_loaded(cache_key, signature):
+    """Get a copy of the content from the in-memory cache.
+
+    Parameters
+    ----------
+    cache_key : tuple
+        The version, export type and whether the content is consolidated.
+    signature : tuple
+        The signature of the export (see _loaded_signature).
+
+    Returns
+    -------
+    dict or None
+        A copy of the cached content, or None if not cached or outdated.
+    """
+    if cache_key not in _loaded_content:
+        return None
+    cached_signature, blob = _loaded_content[cache_key]
+    if cached_signature != signature:
+        del _loaded_content[cache_key]
+        return None
+    _loaded_content.move_to_end(cache_key)
+    # Callers may alter the content, so every caller gets its own copy
+    return pickle.loads(blob)
+
+
+def _put_loaded(cache_key, signature, content, size, max_mb):
+    """Add the content to the in-memory cache, evicting the least recently used content.
+
+    Parameters
+    ----------
+    cache_key : tuple
+        The version, export type and whether the content is consolidated.
+    signature : tuple
+        The signature of the export (see _loaded_signature).
+    content : dict
+        The loaded content.
+    size : int
+        The maximum number of contents to keep in memory.
+    max_mb : int
+        The maximum size of the contents kept in memory in MB (0 for no limit).
+    """
+    logger = get_logger()
+    # The content is kept serialized, which both protects it against alteration
+    #   and allows to account for its size
+    blob = pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL)
+    max_bytes = max_mb * 1024**2
+    if max_bytes and len(blob) > max_bytes:
+        logger.debug(f"Content of version '{cache_key[0]}' exceeds the in-memory cache size.")
+        _loaded_content.pop(cache_key, None)
+        return
+    _loaded_content[cache_key] = (signature, blob)
+    _loaded_content.move_to_end(cache_key)
+    while len(_loaded_content) > size or (
+        max_bytes and sum(len(b) for _, b in _loaded_content.values()) > max_bytes
+    ):
+        evicted, _ = _loaded_content.popitem(last=False)
+        logger.debug(f"Evicted version '{evicted[0]}' from the in-memory cache.")
+
+
+def _consolidated_cache_path(json_path):
+    """Return the path of the cached consolidated content of the specified export."""
+    return os.path.splitext(strip_compression_suffix(json_path))[0] + _consolidated_suffix
+
+
+def _read_consolidated_header(cache_path):
+    """Read the header of the cached consolidated content (see _read_consolidated).
+
+    Parameters
+    ----------
+    cache_path : str
+        The path of the cached consolidated content.
+
+    Returns
+    -------
+    dict or None
+        The header, or None if not cached or unreadable.
+    """
+    try:
+        with open(cache_path, "rb") as f:
+            header = json.loads(f.readline())
+    except Exception:
+        return None
+    return header if isinstance(header, dict) else None
+
+
+def _export_info(json_path, previous=None):
+    """Return the size, modification time and sha256 (of the uncompressed content) of an export.
+
+    The sha256 is only computed if the size or the modification time differ from the
+    previous ones.
+
+    Parameters
+    ----------
+    json_path : str
+        The path of the export.
+    previous : dict, optional
+        The info previously returned for this export, if any.
+
+    Returns
+    -------
+    dict
+        The size, modification time (ns) and sha256 of the export.
+    """
+    stat = os.stat(json_path)
+    info = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if isinstance(previous, dict) and "sha256" in previous and all(
+        previous.get(key) == value for (key, value) in info.items()
+    ):
+        info["sha256"] = previous["sha256"]
+    else:
+        sha256 = hashlib.sha256()
+        with open_file(json_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024**2), b""):
+                sha256.update(chunk)
+        info["sha256"] = sha256.hexdigest()
+    return info
+
+
+def _read_consolidated(cache_path, cache_key):
+    """Read the cached consolidated content.
+
+    The cached file holds a header line (the key of the content, the sha256 of the
+    payload and the info of the export, see _export_info, in JSON) followed by the
+    content (JSON). The header is checked before the
+    payload is read, and the payload against its sha256 before it is decoded.
+
+    Parameters
+    ----------
+    cache_path : str
+        The path of the cached consolidated content.
+    cache_key : dict
+        The key the cached content has to match.
+
+    Returns
+    -------
+    dict or None
+        The cached consolidated content, or None if not cached, outdated or corrupt.
+    """
+    logger = get_logger()
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, "rb") as f:
+            header = json.loads(f.readline())
+            if not isinstance(header, dict) or header.get("key") != cache_key:
+                logger.debug(f"Cached consolidated content '{cache_path}' is outdated.")
+                return None
+            payload = f.read()
+        if hashlib.sha256(payload).hexdigest() != header.get("sha256"):
+            logger.warning(f"Cached consolidated content '{cache_path}' does not match its sha256.")
+            return None
+        return json.loads(payload)
+    except Exception as e:
+        logger.warning(f"Could not read cached consolidated content '{cache_path}': {e}")
+        return None
+
+
+def _write_consolidated(cache_path, cache_key, content, export_info=None):
+    """Write the consolidated content to the cache (see _read_consolidated).
+
+    Parameters
+    ----------
+    cache_path : str
+        The path of the cached consolidated content.
+    cache_key : dict
+        The key of the consolidated content.
+    content : dict
+        The consolidated content.
+    export_info : dict, optional
+        The size, modification time and sha256 of the export (see _export_info).
+    """
+    logger = get_logger()
+    cache_path_temp = temp_path(cache_path)
+    try:
+        payload = json.dumps(content).encode()
+        header = {"key": cache_key, "sha256": hashlib.sha256(payload).hexdigest()}
+        if export_info is not None:
+            header["export"] = export_info
+        header = json.dumps(header).encode()
+        with open(cache_path_temp, "wb") as f:
+            f.write(header + b"\n")
+            f.write(payload)
+        os.replace(cache_path_temp, cache_path)
+    except Exception as e:
+        logger.warning(f"Could not cache consolidated content '{cache_path}': {e}")
+        if os.path.exists(cache_path_temp):
+            os.remove(cache_path_temp)
+
+
+def _consolidate(json_path, version, **kwargs):
+    """Load and consolidate the specified export.
+
+    The consolidated content is cached next to the export. The cache is keyed by the
+    sha256 of the export, the API version and the fingerprint of the mapping table,
+    and is replaced as soon as any of these changes. The export is only read and
+    hashed if its size or modification time differ from the ones recorded with the
+    cached content. Concurrent consolidations of the same export wait for the first
+    one and reuse its cached content.
+
+    Parameters
+    ----------
+    json_path : str
+        The path of the export.
+    version : str
+        The version of the export.
+    **kwargs
+        cache_consolidated : bool, optional
+            Whether to use the cache of the consolidated content. Defaults to True.
+        Further kwargs are passed on to consolidate_export.map_data.
+
+    Returns
+    -------
+    dict
+        The consolidated content.
+    """
+    logger = get_logger()
+    if not kwargs.get("cache_consolidated", True):
+        with open_file(json_path) as f:
+            return ce.map_data(json.load(f), mapping_table, version, **kwargs)
+    cache_path = _consolidated_cache_path(json_path)
+    with file_lock(cache_path):
+        previous_info = (_read_consolidated_header(cache_path) or {}).get("export")
+        export_info = _export_info(json_path, previous_info)
+        cache_key = {
+            "format": _consolidated_format,
+            "export_sha256": export_info["sha256"],
+            "api_version": api_version,
+            "mapping_table": ce.mapping_table_fingerprint(mapping_table),
+            "version": version,
+        }
+        content = _read_consolidated(cache_path, cache_key)
+        if content is not None:
+            logger.debug(f"Loaded cached consolidated content '{cache_path}'.")
+            if export_info != previous_info:
+                # Same content, but touched export: record its new info to skip hashing it next time
+                _write_consolidated(cache_path, cache_key, content, export_info)
+            return content
+        with open_file(json_path) as f:
+            content = ce.map_data(json.load(f), mapping_table, version, **kwargs)
+        _write_consolidated(cache_path, cache_key, content, export_info)
+    return content
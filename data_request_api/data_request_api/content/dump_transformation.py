@@ -7,22 +7,39 @@ Script to change the basic airtable export into readable files.
 
 from __future__ import division, print_function, unicode_literals, absolute_import
 
+import contextlib
 import copy
+import functools
+import hashlib
 import json
 import os
 import argparse
 import re
-from collections import defaultdict
+import time
+import tracemalloc
+from collections import Counter, defaultdict
 
+from data_request_api import version as api_version
 from data_request_api.utilities.decorators import append_kwargs_from_config
 from data_request_api.utilities.logger import get_logger
 from data_request_api.utilities.parser import append_arguments_to_parser
-from data_request_api.utilities.tools import read_json_input_file_content, write_json_output_file_content
+from data_request_api.utilities.tools import read_json_input_file_content, write_json_output_file_content, \
+    find_file, get_compression, COMPRESSION_SUFFIXES, file_lock, open_file, strip_compression_suffix
 from data_request_api.content import dreq_content as dc
 
 default_count = 0
 default_template = "default_{:d}"
 
+transform_settings_file = os.sep.join([os.path.dirname(os.path.abspath(__file__)), "transform.json"])
+
+# Format of the manifest of the transformed content (to be increased if the transformation changes
+#  in a way the other entries of its key do not reflect)
+transformed_manifest_format = 1
+
+# Environment variable overriding the profiling of the transformation stages (see TransformProfiler):
+#  "0" or "false" to disable it, "1" or "true" to enable it, any other value enabling it with this JSON report file
+transform_profile_env = "CMIP7_DR_API_TRANSFORM_PROFILE"
+
 
 def correct_key_string(input_string, *to_remove_strings):
     """
@@ -113,7 +130,7 @@ def get_transform_settings(version):
         else:
             return input_dict[target_version]
 
-    transform = read_json_input_file_content(os.sep.join([os.path.dirname(os.path.abspath(__file__)), "transform.json"]))
+    transform = read_json_input_file_content(transform_settings_file)
     common = transform.pop("common", dict())
     if version not in ["default", ]:
         common = update_dict(common["default"], get_config_version(version=version, input_dict=common, default=dict()))
@@ -143,63 +160,6 @@ def distribute_on_entry(func):
     return distribute
 
 
-@distribute_on_entry
-def remove_unused_keys(content, patterns_to_remove=list(), default_patterns_to_remove=list(), default=None):
-    content = content["records"]
-    patterns_to_remove.extend(default_patterns_to_remove)
-    patterns_to_remove = [re.compile(elt) for elt in patterns_to_remove]
-    for record_id in content:
-        list_keys_to_remove = [elt for elt in content[record_id]
-                               if any(patt.match(elt) is not None for patt in patterns_to_remove)]
-        for key in list_keys_to_remove:
-            del content[record_id][key]
-    return content
-
-
-@distribute_on_entry
-def rename_useful_keys(content, patterns_to_rename=dict(), default=None):
-    for record_id in content:
-        for (patt, repl) in patterns_to_rename.items():
-            patt = re.compile(patt)
-            to_rename = [elt for elt in content[record_id] if patt.match(elt) is not None]
-            if len(to_rename) == 1:
-                content[record_id][repl] = content[record_id].pop(to_rename[0])
-            elif len(to_rename) > 1:
-                raise ValueError(f"Several keys ({to_rename}) match pattern {patt}.")
-    return content
-
-
-@distribute_on_entry
-def merge_useful_keys(content, patterns_to_merge=dict(), default=None):
-    for record_id in content:
-        for (patt, repl) in patterns_to_merge.items():
-            patt = re.compile(patt)
-            to_merge = [elt for elt in content[record_id] if patt.match(elt) is not None]
-            if len(to_merge) > 0:
-                content[record_id][repl] = list()
-                for elts in to_merge:
-                    if isinstance(content[record_id][elts], list):
-                        content[record_id][repl].extend(content[record_id].pop(elts))
-                    else:
-                        content[record_id][repl].append(content[record_id].pop(elts))
-    return content
-
-
-@distribute_on_entry
-def copy_useful_keys(content, keys_to_copy=dict(), default=None):
-    logger = get_logger()
-    if default is not None and isinstance(default, dict):
-        default.update(keys_to_copy)
-        keys_to_copy = default
-    for record_id in sorted(list(content)):
-        for (key, val) in keys_to_copy.items():
-            if key in content[record_id]:
-                content[record_id][val] = copy.deepcopy(content[record_id][key])
-            else:
-                logger.warning(f"Key {key} not in found for record id {record_id}.")
-    return content
-
-
 @distribute_on_entry
 def initialize_useful_keys(content, keys_to_initialize=dict(), default=None):
     if default is not None and isinstance(default, dict):
@@ -221,54 +181,205 @@ def initialize_useful_keys(content, keys_to_initialize=dict(), default=None):
     return content
 
 
-@distribute_on_entry
-def sort_useful_keys(content, patterns_to_sort=list(), default=None):
-    patterns_to_sort = [re.compile(elt) for elt in patterns_to_sort]
-    for uid in content:
-        # Sort content of needed keys
-        list_keys_to_sort = [elt for (elt, val) in content[uid].items()
-                             if any(patt.match(elt) is not None and isinstance(val, list) for patt in patterns_to_sort)]
-        for key in list_keys_to_sort:
-            content[uid][key] = sorted(list(set(content[uid][key])))
+def compile_patterns(*patterns):
+    """
+    Compile patterns into a (memoized) function telling whether a key matches one of them.
+    :param str patterns: the patterns to be matched (at the beginning of the keys)
+    :return function: the matching function
+    """
+    patterns = [re.compile(patt) for patt in patterns]
+
+    @functools.lru_cache(maxsize=None)
+    def match(key):
+        return any(patt.match(key) is not None for patt in patterns)
+
+    return match
+
+
+def get_key_actions(tables, settings):
+    """
+    Compile the keys transformations of the settings into a plan of actions for each table.
+    :param list of str tables: the tables the plan is built for
+    :param dict settings: the transformation settings (missing keys transformations are not applied)
+    :return dict: for each table, the dictionary of the (compiled) actions to be applied to its records
+    """
+    default_keys_to_copy = settings.get("keys_to_copy", dict()).get("default")
+    rep = dict()
+    for table in tables:
+        keys_to_copy = settings.get("keys_to_copy", dict()).get(table, dict())
+        if isinstance(default_keys_to_copy, dict):
+            keys_to_copy = {**default_keys_to_copy, **keys_to_copy}
+        rep[table] = dict(
+            remove=compile_patterns(*settings.get("keys_to_delete", dict()).get(table, list()),
+                                    *settings.get("default_keys_to_delete", list())),
+            copy=keys_to_copy,
+            rename=[(patt, compile_patterns(patt), repl)
+                    for (patt, repl) in settings.get("keys_to_rename", dict()).get(table, dict()).items()],
+            merge=[(compile_patterns(patt), repl)
+                   for (patt, repl) in settings.get("keys_to_merge", dict()).get(table, dict()).items()],
+            sort=compile_patterns(*settings.get("keys_to_sort", dict()).get(table, list())),
+            reshape=[(reshape_style, compile_patterns(*patterns.get(table, list())))
+                     for (reshape_style, patterns) in settings.get("keys_to_format", dict()).items()]
+        )
+    return rep
+
+
+def apply_key_actions(content, key_actions, actions):
+    """
+    Apply, in a single pass over the records of each table, several actions of the plan.
+    :param dict content: the content (table -> record id -> record) to be changed in place
+    :param dict key_actions: the plan of actions of each table (see get_key_actions)
+    :param list of str actions: the actions to be applied, in order
+    :return dict: the changed content
+    """
+    actions = [(action, _record_actions[action]) for action in actions]
+    for table in sorted(list(content)):
+        table_actions = key_actions[table]
+        for (record_id, record) in content[table].items():
+            for (action, func) in actions:
+                func(record, record_id, table_actions[action])
     return content
 
 
-@distribute_on_entry
-def reshape_useful_keys(content, patterns_to_reshape=list(), reshape_style=None, default=None):
-    logger = get_logger()
-    patterns_to_reshape = [re.compile(elt) for elt in patterns_to_reshape]
-    for uid in content:
-        list_keys_to_reshape = [elt for elt in content[uid]
-                                if any(patt.match(elt) is not None for patt in patterns_to_reshape)]
-        for key in list_keys_to_reshape:
-            val = content[uid][key]
+def _remove_unused_keys(record, record_id, patterns_to_remove):
+    for key in [elt for elt in record if patterns_to_remove(elt)]:
+        del record[key]
+
+
+def _copy_useful_keys(record, record_id, keys_to_copy):
+    for (key, val) in keys_to_copy.items():
+        if key in record:
+            record[val] = copy.deepcopy(record[key])
+        else:
+            get_logger().warning(f"Key {key} not in found for record id {record_id}.")
+
+
+def _rename_useful_keys(record, record_id, patterns_to_rename):
+    for (patt, match, repl) in patterns_to_rename:
+        to_rename = [elt for elt in record if match(elt)]
+        if len(to_rename) == 1:
+            record[repl] = record.pop(to_rename[0])
+        elif len(to_rename) > 1:
+            raise ValueError(f"Several keys ({to_rename}) match pattern {re.compile(patt)}.")
+
+
+def _merge_useful_keys(record, record_id, patterns_to_merge):
+    for (match, repl) in patterns_to_merge:
+        to_merge = [elt for elt in record if match(elt)]
+        if len(to_merge) > 0:
+            record[repl] = list()
+            for elts in to_merge:
+                if isinstance(record[elts], list):
+                    record[repl].extend(record.pop(elts))
+                else:
+                    record[repl].append(record.pop(elts))
+
+
+def _sort_useful_keys(record, record_id, patterns_to_sort):
+    list_keys_to_sort = [elt for (elt, val) in record.items() if isinstance(val, list) and patterns_to_sort(elt)]
+    for key in list_keys_to_sort:
+        record[key] = sorted(list(set(record[key])))
+
+
+def _reshape_useful_keys(record, uid, patterns_to_reshape):
+    for (reshape_style, match) in patterns_to_reshape:
+        for key in [elt for elt in record if match(elt)]:
+            val = record[key]
             if reshape_style in ["list_to_string", ]:
                 if isinstance(val, list):
                     if len(val) == 1:
-                        content[uid][key] = val[0]
+                        record[key] = val[0]
                     elif len(val) == 0:
-                        logger.warning(f"Remove void key {key} from id {uid}")
-                        del content[uid][key]
+                        get_logger().warning(f"Remove void key {key} from id {uid}")
+                        del record[key]
                     else:
-                        logger.error(f"Could not reshape key {key} from id {uid}: contains several elements")
+                        get_logger().error(f"Could not reshape key {key} from id {uid}: contains several elements")
                         raise ValueError(f"Could not reshape key {key} from id {uid}: contains several elements")
                 elif isinstance(val, str):
-                    logger.warning(f"Could not reshape key {key} from id {uid}: already a string")
+                    get_logger().warning(f"Could not reshape key {key} from id {uid}: already a string")
                 else:
-                    logger.error(f"Could not reshape key {key} from id {uid}: not a list")
+                    get_logger().error(f"Could not reshape key {key} from id {uid}: not a list")
                     raise ValueError(f"Could not reshape key {key} from id {uid}: not a list")
             elif reshape_style in ["string_to_list", ]:
                 if isinstance(val, str):
-                    content[uid][key] = [val, ]
+                    record[key] = [val, ]
                 elif isinstance(val, list):
-                    logger.warning(f"Could not reshape key {key} from id {uid}: already a list")
+                    get_logger().warning(f"Could not reshape key {key} from id {uid}: already a list")
                 else:
-                    logger.error(f"Could not reshape key {key} from id {uid}: not a string")
+                    get_logger().error(f"Could not reshape key {key} from id {uid}: not a string")
                     raise ValueError(f"Could not reshape key {key} from id {uid}: not a string")
             else:
-                logger.error(f"Unknown value for reshaping: {reshape_style}")
+                get_logger().error(f"Unknown value for reshaping: {reshape_style}")
                 raise ValueError(f"Unknown value for reshaping: {reshape_style}")
-    return content
+
+
+_record_actions = dict(remove=_remove_unused_keys, copy=_copy_useful_keys, rename=_rename_useful_keys,
+                       merge=_merge_useful_keys, sort=_sort_useful_keys, reshape=_reshape_useful_keys)
+
+
+def remove_unused_keys(content, per_entry_input, default_patterns_to_remove=list()):
+    """
+    Remove the keys of the records matching the patterns of their table.
+    :param dict content: the content (table -> {"records": record id -> record}) to be changed in place
+    :param dict per_entry_input: the patterns of the keys to be removed for each table
+    :param list of str default_patterns_to_remove: the patterns of the keys to be removed for all tables
+    :return dict: the records of each table (table -> record id -> record)
+    """
+    content = {table: value["records"] for (table, value) in content.items()}
+    settings = dict(keys_to_delete=per_entry_input, default_keys_to_delete=default_patterns_to_remove)
+    return apply_key_actions(content, get_key_actions(list(content), settings), ["remove"])
+
+
+def copy_useful_keys(content, per_entry_input):
+    """
+    Copy keys of the records to other keys.
+    :param dict content: the content (table -> record id -> record) to be changed in place
+    :param dict per_entry_input: the keys to be copied (key -> new key) for each table, and by default
+    :return dict: the changed content
+    """
+    return apply_key_actions(content, get_key_actions(list(content), dict(keys_to_copy=per_entry_input)), ["copy"])
+
+
+def rename_useful_keys(content, per_entry_input):
+    """
+    Rename the keys of the records matching patterns.
+    :param dict content: the content (table -> record id -> record) to be changed in place
+    :param dict per_entry_input: the patterns of the keys to be renamed (pattern -> new key) for each table
+    :return dict: the changed content
+    """
+    return apply_key_actions(content, get_key_actions(list(content), dict(keys_to_rename=per_entry_input)), ["rename"])
+
+
+def merge_useful_keys(content, per_entry_input):
+    """
+    Merge the keys of the records matching patterns into lists.
+    :param dict content: the content (table -> record id -> record) to be changed in place
+    :param dict per_entry_input: the patterns of the keys to be merged (pattern -> new key) for each table
+    :return dict: the changed content
+    """
+    return apply_key_actions(content, get_key_actions(list(content), dict(keys_to_merge=per_entry_input)), ["merge"])
+
+
+def sort_useful_keys(content, per_entry_input):
+    """
+    Sort (and remove the duplicates of) the list values of the keys of the records matching patterns.
+    :param dict content: the content (table -> record id -> record) to be changed in place
+    :param dict per_entry_input: the patterns of the keys to be sorted for each table
+    :return dict: the changed content
+    """
+    return apply_key_actions(content, get_key_actions(list(content), dict(keys_to_sort=per_entry_input)), ["sort"])
+
+
+def reshape_useful_keys(content, per_entry_input, reshape_style=None):
+    """
+    Reshape the values of the keys of the records matching patterns.
+    :param dict content: the content (table -> record id -> record) to be changed in place
+    :param dict per_entry_input: the patterns of the keys to be reshaped for each table
+    :param str reshape_style: the reshaping, "list_to_string" or "string_to_list"
+    :return dict: the changed content
+    """
+    settings = dict(keys_to_format={reshape_style: per_entry_input})
+    return apply_key_actions(content, get_key_actions(list(content), settings), ["reshape"])
 
 
 def add_useful_keys(content):
@@ -341,42 +452,196 @@ def filter_content(content):
     return content
 
 
+def rewrite_links(value, links, uids, used, occurrences):
+    """
+    Rewrite, in a nested content, the strings which are record ids into links to the corresponding uids.
+    :param value: nested content (dict, list or scalar)
+    :param dict links: record id to (element type, link to uid) index
+    :param set uids: uids which occurrences must be counted
+    :param set used: set of the (element type, record id) which are rewritten, updated in place
+    :param Counter occurrences: number of occurrences of each uid (as is or as a link), updated in place
+    :return: the rewritten content
+    """
+    if isinstance(value, str):
+        if value in links:
+            subelt, link = links[value]
+            used.add((subelt, value))
+            value = link
+        if value.startswith("link::") and value[6:] in uids:
+            occurrences[value[6:]] += 1
+        elif value in uids:
+            occurrences[value] += 1
+        return value
+    elif isinstance(value, dict):
+        return {rewrite_links(key, links, uids, used, occurrences): rewrite_links(elt, links, uids, used, occurrences)
+                for (key, elt) in value.items()}
+    elif isinstance(value, list):
+        return [rewrite_links(elt, links, uids, used, occurrences) for elt in value]
+    else:
+        return value
+
+
 def tidy_content(content, record_to_uid_index):
     logger = get_logger()
     # Replace record_id by uid
     logger.debug("Replace record ids by uids")
-    to_remove_entries = defaultdict(lambda: defaultdict(lambda: 0))
-    list_content = list(content)
-    len_list_content = len(list_content)
-    for content_subelt in list_content:
-        content_string = json.dumps(content[content_subelt], indent=0)
-        for subelt in record_to_uid_index:
-            for (record_id, uid) in record_to_uid_index[subelt].items():
-                tmp_content_string = content_string.replace(f'"{record_id}"', f'"link::{uid}"')
-                if content_string == tmp_content_string:
-                    to_remove_entries[subelt][(record_id, uid)] += 1
-                content_string = tmp_content_string
-        content[content_subelt] = json.loads(content_string)
-    for content_subelt in ["opportunities", "coordinates_and_dimensions"]:
-        if content_subelt in to_remove_entries:
-            to_remove = [elt for (elt, nb) in to_remove_entries[content_subelt].items() if nb == len_list_content]
-            for record_id, _ in to_remove:
-                del record_to_uid_index[content_subelt][record_id]
-            del to_remove_entries[content_subelt]
-    for (subelt, to_remove) in to_remove_entries.items():
-        to_remove = [elt for (elt, nb) in to_remove.items() if nb == len_list_content]
+    links = dict()
+    for (subelt, index) in record_to_uid_index.items():
+        for (record_id, uid) in index.items():
+            links.setdefault(record_id, (subelt, f"link::{uid}"))
+    uids = {uid for index in record_to_uid_index.values() for uid in index.values()}
+    used = set()
+    # Occurrences of the uids within each entry, to be able to drop the ones of removed entries
+    entry_occurrences = dict()
+    for content_subelt in content:
+        for (uid, value) in content[content_subelt].items():
+            occurrences = Counter()
+            if uid in uids:
+                occurrences[uid] += 1
+            content[content_subelt][uid] = rewrite_links(value, links, uids, used, occurrences)
+            entry_occurrences[content_subelt, uid] = occurrences
+    for (subelt, index) in record_to_uid_index.items():
+        to_remove = [(record_id, uid) for (record_id, uid) in index.items() if (subelt, record_id) not in used]
         for (record_id, uid) in to_remove:
-            del content[subelt][uid]
-            del record_to_uid_index[subelt][record_id]
-    # Tidy the content once again
-    content_str = json.dumps(content)
-    for subelt in record_to_uid_index:
-        for uid in [uid for uid in record_to_uid_index[subelt].values() if content_str.count(uid) < 3]:
+            if subelt not in ["opportunities", "coordinates_and_dimensions"]:
+                del content[subelt][uid]
+                del entry_occurrences[subelt, uid]
+            del index[record_id]
+    # Tidy the content once again: remove the entries which uid only appears as key and uid (not referenced)
+    occurrences = Counter()
+    for entry in entry_occurrences.values():
+        occurrences.update(entry)
+    for (subelt, index) in record_to_uid_index.items():
+        for uid in [uid for uid in index.values() if occurrences[uid] < 3]:
             del content[subelt][uid]
     return content
 
 
-def transform_content_inner(content, settings, change_tables=False, force_variable_name=False, variable_name=None):
+def replace_linked_ids(value, ids):
+    """
+    Replace, in a nested content, the strings which are old record ids by the new record ids.
+    As the former replacement in the dumped content, all the values and the dictionaries keys are considered,
+    whatever the fields linking to the table the record ids belong to.
+    :param value: nested content (dict, list or scalar)
+    :param dict ids: old record id to new record id index
+    :return: the updated content
+    """
+    if isinstance(value, str):
+        return ids.get(value, value)
+    elif isinstance(value, dict):
+        return {ids.get(key, key) if isinstance(key, str) else key: replace_linked_ids(elt, ids)
+                for (key, elt) in value.items()}
+    elif isinstance(value, list):
+        return [replace_linked_ids(elt, ids) for elt in value]
+    else:
+        return value
+
+
+def count_records(content, depth=1):
+    """
+    Count the records of a content.
+    :param dict content: the content, its tables being dictionaries of records or exported tables (with "records")
+    :param int depth: depth of the tables in the content (1 for table -> records, 2 for base -> table -> records)
+    :return int: the number of records
+    """
+    if not isinstance(content, dict):
+        return 0
+    elif depth > 1:
+        return sum(count_records(value, depth - 1) for value in content.values())
+    else:
+        return sum(len(table["records"]) if isinstance(table.get("records"), dict) else len(table)
+                   for table in content.values() if isinstance(table, dict))
+
+
+class TransformProfiler:
+    """
+    Wall time, peak traced memory and number of records of the stages of a content transformation.
+
+    When disabled, the stages are not measured at all. When enabled, memory allocations are traced
+    (tracemalloc) while the profiler is used as a context manager, and the stages are logged (and written
+    to the report file if any) at its exit.
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether the stages are measured.
+    report : str
+        JSON file the stages are written to (None for none).
+    stages : list of dict
+        Name, duration (s), peak traced memory (MB) and, if counted, number of records after each stage.
+    """
+
+    def __init__(self, enabled=False, report=None):
+        self.enabled = bool(enabled or report)
+        self.report = report or None
+        self.stages = list()
+        self._started_tracing = False
+
+    @classmethod
+    def from_settings(cls, profile=False, report=None):
+        """Create the profiler from the arguments, unless overridden by the environment (see transform_profile_env)."""
+        value = os.environ.get(transform_profile_env, "").strip()
+        if value.lower() in ["0", "false"]:
+            return cls()
+        elif value.lower() in ["1", "true"]:
+            return cls(enabled=True, report=report)
+        elif len(value) > 0:
+            return cls(enabled=True, report=value)
+        else:
+            return cls(enabled=profile, report=report)
+
+    def __enter__(self):
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        if self.enabled and exc_type is None:
+            self.write_stages()
+
+    def stage(self, name, count=None):
+        """
+        Context manager measuring a stage of the transformation.
+        :param str name: name of the stage
+        :param function count: function returning the number of records after the stage (only called if enabled)
+        """
+        if self.enabled:
+            return self._measure(name, count)
+        else:
+            return contextlib.nullcontext()
+
+    @contextlib.contextmanager
+    def _measure(self, name, count):
+        # Peak since the previous stage before python 3.9 (no reset of the peak)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        stage = dict(name=name, duration=time.perf_counter() - start,
+                     peak_memory_mb=tracemalloc.get_traced_memory()[1] / 1024 ** 2)
+        if count is not None:
+            stage["records"] = count()
+        self.stages.append(stage)
+
+    def write_stages(self):
+        """Log the measured stages and write them to the report file if any."""
+        logger = get_logger()
+        for stage in self.stages:
+            records = f", {stage['records']:d} records" if "records" in stage else ""
+            logger.info(f"Transformation stage {stage['name']}: {stage['duration']:.3f} s, "
+                        f"peak memory {stage['peak_memory_mb']:.1f} MB{records}")
+        total = sum(stage["duration"] for stage in self.stages)
+        logger.info(f"Transformation stages: {total:.3f} s")
+        if self.report is not None:
+            write_json_output_file_content(self.report, dict(stages=self.stages, duration=total))
+
+
+def transform_content_inner(content, settings, change_tables=False, force_variable_name=False, variable_name=None,
+                            profiler=None):
     """
     Transform a one base export content to:
     - remove unused keys which could create circle import later
@@ -385,9 +650,12 @@ def transform_content_inner(content, settings, change_tables=False, force_variab
     - remove elements which are not used
     - filter content on status
     :param dict content: one base content export (direct export or created from `transform_content_three_bases`
+    :param TransformProfiler profiler: profiler measuring the stages of the transformation (disabled if None)
     :return dict: the transform content
     """
     logger = get_logger()
+    if profiler is None:
+        profiler = TransformProfiler()
     if isinstance(content, dict) and len(content) == 1 and change_tables:
         logger.error("For one base dict, change_tables must be False.")
         raise ValueError("For one base dict, change_tables must be False.")
@@ -397,60 +665,58 @@ def transform_content_inner(content, settings, change_tables=False, force_variab
     elif isinstance(content, dict):
         # If needed, deal with one base creation
         if change_tables:
-            new_content = dict()
-            for (elt, (base, table)) in settings["tables_provenance"].items():
-                new_content[elt] = content[settings["several_bases_name"][base]][table]
-            logger.info("Harmonise bases content record ids")
-            content_str = json.dumps(new_content)
-            for ((base_old, table_old, key_old), (base_new, table_new, key_new)) in settings["several_bases_link"].values():
-                old_table = content[settings["several_bases_name"][base_old]][table_old]["records"]
-                new_table = content[settings["several_bases_name"][base_new]][table_new]["records"]
-                old_dict = {record_id: value[key_old] for (record_id, value) in old_table.items()}
-                new_dict = {value[key_new]: record_id for (record_id, value) in new_table.items()}
-                for (id, val) in old_dict.items():
-                    content_str = content_str.replace(f'"{id}"', f'"{new_dict[val]}"')
-            content = json.loads(content_str)
+            with profiler.stage("harmonise_bases", lambda: count_records(content)):
+                new_content = dict()
+                for (elt, (base, table)) in settings["tables_provenance"].items():
+                    new_content[elt] = copy.deepcopy(content[settings["several_bases_name"][base]][table])
+                logger.info("Harmonise bases content record ids")
+                for ((base_old, table_old, key_old), (base_new, table_new, key_new)) in \
+                        settings["several_bases_link"].values():
+                    old_table = content[settings["several_bases_name"][base_old]][table_old]
+                    new_table = content[settings["several_bases_name"][base_new]][table_new]["records"]
+                    new_dict = {value[key_new]: record_id for (record_id, value) in new_table.items()}
+                    ids = {record_id: new_dict[value[key_old]] for (record_id, value) in old_table["records"].items()}
+                    new_content = replace_linked_ids(new_content, ids)
+                content = new_content
         else:
             content = content[list(content)[0]]
         # Rename some elements
-        for (patt, repl) in settings["tables_to_rename"].items():
-            for key in [key for key in content if re.compile(patt).match(key) is not None]:
-                content[re.sub(patt, repl, key)] = content.pop(key)
-        for elt in [elt for elt in list(content) if any(re.compile(patt).match(elt) for patt in settings["tables_to_delete"])]:
-            del content[elt]
+        with profiler.stage("rename_tables", lambda: count_records(content)):
+            for (patt, repl) in settings["tables_to_rename"].items():
+                for key in [key for key in content if re.compile(patt).match(key) is not None]:
+                    content[re.sub(patt, repl, key)] = content.pop(key)
+            for elt in [elt for elt in list(content)
+                        if any(re.compile(patt).match(elt) for patt in settings["tables_to_delete"])]:
+                del content[elt]
         # Tidy the content of the export file
-        default_patterns_to_remove = settings["default_keys_to_delete"]
-        to_remove_keys_patterns = settings["keys_to_delete"]
-        to_rename_keys_patterns = settings["keys_to_rename"]
         to_copy_keys_content = settings["keys_to_copy"]
         if force_variable_name:
             for key in list(to_copy_keys_content["variables"]):
                 if to_copy_keys_content["variables"][key] in ["name", ]:
                     del to_copy_keys_content["variables"][key]
             to_copy_keys_content["variables"][correct_key_string(variable_name)] = "name"
-        to_merge_keys_patterns = settings["keys_to_merge"]
-        to_sort_keys_content = settings["keys_to_sort"]
         to_initialize_keys_content = settings["keys_to_initialize"]
-        content = remove_unused_keys(content=content, per_entry_input=to_remove_keys_patterns,
-                                     default_patterns_to_remove=default_patterns_to_remove)
-        content = copy_useful_keys(content=content, per_entry_input=to_copy_keys_content)
-        content = rename_useful_keys(content=content, per_entry_input=to_rename_keys_patterns)
-        content = merge_useful_keys(content=content, per_entry_input=to_merge_keys_patterns)
+        key_actions = get_key_actions(list(content), settings)
+        content = {table: value["records"] for (table, value) in content.items()}
+        with profiler.stage("remove_copy_rename_merge_keys", lambda: count_records(content)):
+            content = apply_key_actions(content, key_actions, ["remove", "copy", "rename", "merge"])
         # Filter on status if needed then remove linked keys
-        content = filter_content(content)
+        with profiler.stage("filter_content", lambda: count_records(content)):
+            content = filter_content(content)
         # Copy some keys to others
         global default_count
         default_count = 0
-        content = initialize_useful_keys(content=content, per_entry_input=to_initialize_keys_content)
+        with profiler.stage("initialize_useful_keys", lambda: count_records(content)):
+            content = initialize_useful_keys(content=content, per_entry_input=to_initialize_keys_content)
         # Add name and uid if needed, build equivalence dict between record_id and uid
-        content, record_to_uid_index = add_useful_keys(content)
+        with profiler.stage("add_useful_keys", lambda: count_records(content)):
+            content, record_to_uid_index = add_useful_keys(content)
         # Tidy the content of the dictionary by removing unused entries
-        content = tidy_content(content, record_to_uid_index)
+        with profiler.stage("tidy_content", lambda: count_records(content)):
+            content = tidy_content(content, record_to_uid_index)
         # Sort content of needed keys
-        content = sort_useful_keys(content, per_entry_input=to_sort_keys_content)
-        for (reshape_style, from_list_to_string_keys_content) in settings["keys_to_format"].items():
-            content = reshape_useful_keys(content, per_entry_input=from_list_to_string_keys_content,
-                                          reshape_style=reshape_style)
+        with profiler.stage("sort_reshape_keys", lambda: count_records(content)):
+            content = apply_key_actions(content, key_actions, ["sort", "reshape"])
         return content
     else:
         logger.error(f"Deal with dict types, not {type(content).__name__}")
@@ -501,7 +767,8 @@ def split_content_one_base(content):
         raise TypeError(f"Deal with dict types, not {type(content).__name__}")
 
 
-def transform_content(content, version, force_variable_name=False, variable_name=None):
+def transform_content(content, version, force_variable_name=False, variable_name=None, profile=False,
+                      profile_report=None):
     """
     Function to transform the export content (single or several base-s- export) to VS and DR dictionaries.
     The key "version" is added to the DR and VS dictionaries.
@@ -509,6 +776,9 @@ def transform_content(content, version, force_variable_name=False, variable_name
     :param str version: string containing the version of the export content
     :param bool force_variable_name: bool whether to force variable name to config one
     :param str variable_name: string containing the variable name to be used
+    :param bool profile: bool whether to log the time, memory and records of the transformation stages
+    :param str profile_report: JSON file the profile of the transformation stages is written to
+    (the environment variable CMIP7_DR_API_TRANSFORM_PROFILE overrides both)
     :return dict, dict: DR and VS dictionaries containing respectively the structure (DR) and the vocabulary (VS)
     """
     logger = get_logger()
@@ -516,21 +786,26 @@ def transform_content(content, version, force_variable_name=False, variable_name
         content["Data Request"].pop("version", None)
     transform_settings = get_transform_settings(version)
     if isinstance(content, dict):
-        # Correct dictionaries
-        content = correct_dictionaries(content)
-        # Get back to one database case if needed
-        if len(content) == 1:
-            logger.info("Single database case - no structure transformation needed")
-            content = transform_content_inner(content, transform_settings["one_to_transform"],
-                                              force_variable_name=force_variable_name, variable_name=variable_name)
-        elif len(content) in [3, 4]:
-            logger.info("Several databases case - structure transformation needed")
-            content = transform_content_inner(content, transform_settings["several_to_transform"], change_tables=True,
-                                              force_variable_name=force_variable_name, variable_name=variable_name)
-        else:
-            raise ValueError(f"Could not manage the {len(content):d} bases export file.")
-        # Separate DR and VS files
-        data_request, vocabulary_server = split_content_one_base(content)
+        with TransformProfiler.from_settings(profile, profile_report) as profiler:
+            # Correct dictionaries
+            with profiler.stage("correct_dictionaries", lambda: count_records(content, depth=2)):
+                content = correct_dictionaries(content)
+            # Get back to one database case if needed
+            if len(content) == 1:
+                logger.info("Single database case - no structure transformation needed")
+                content = transform_content_inner(content, transform_settings["one_to_transform"],
+                                                  force_variable_name=force_variable_name, variable_name=variable_name,
+                                                  profiler=profiler)
+            elif len(content) in [3, 4]:
+                logger.info("Several databases case - structure transformation needed")
+                content = transform_content_inner(content, transform_settings["several_to_transform"],
+                                                  change_tables=True, force_variable_name=force_variable_name,
+                                                  variable_name=variable_name, profiler=profiler)
+            else:
+                raise ValueError(f"Could not manage the {len(content):d} bases export file.")
+            # Separate DR and VS files
+            with profiler.stage("split_content_one_base"):
+                data_request, vocabulary_server = split_content_one_base(content)
         data_request["version"] = version
         vocabulary_server["version"] = version
         return data_request, vocabulary_server
@@ -539,10 +814,70 @@ def transform_content(content, version, force_variable_name=False, variable_name
         raise TypeError(f"Deal with dict types, not {type(content).__name__}")
 
 
+def get_source_info(filename, previous=None):
+    """
+    Get the size, modification time and sha256 (of the uncompressed content) of a file.
+    The sha256 is only computed if the size or the modification time differ from the previous ones.
+    :param str filename: the file
+    :param dict previous: the information previously got for this file, if any
+    :return dict: the size, modification time and sha256 of the file
+    """
+    stat = os.stat(filename)
+    info = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    if isinstance(previous, dict) and "sha256" in previous and all(previous.get(key) == value
+                                                                   for (key, value) in info.items()):
+        info["sha256"] = previous["sha256"]
+    else:
+        sha256 = hashlib.sha256()
+        with open_file(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b""):
+                sha256.update(chunk)
+        info["sha256"] = sha256.hexdigest()
+    return info
+
+
+def get_transformed_key(source_sha256, version, export, consolidate, force_variable_name, variable_name):
+    """
+    Get the key of the transformed content, which changes as soon as the transformation could give another result.
+    :param str source_sha256: sha256 of the transformed export
+    :param str version: version of the export
+    :param str export: export kind (raw or release)
+    :param bool consolidate: whether the export is consolidated before being transformed
+    :param bool force_variable_name: whether the variable name is forced
+    :param str variable_name: the forced variable name (only part of the key if force_variable_name)
+    :return dict: the key of the transformed content
+    """
+    with open(transform_settings_file, "rb") as f:
+        transform_sha256 = hashlib.sha256(f.read()).hexdigest()
+    rep = dict(format=transformed_manifest_format, api_version=api_version, version=version, export=export,
+               consolidate=bool(consolidate), source_sha256=source_sha256, transform_sha256=transform_sha256,
+               force_variable_name=bool(force_variable_name))
+    if force_variable_name:
+        rep["variable_name"] = variable_name
+    return rep
+
+
+def read_transformed_manifest(filename):
+    """
+    Read the manifest of the transformed content.
+    :param str filename: the manifest file
+    :return dict: the content of the manifest (empty if missing or not readable)
+    """
+    if not os.path.isfile(filename):
+        return dict()
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        get_logger().warning(f"Could not read manifest of the transformed content {filename}: {e}")
+        return dict()
+
+
 @append_kwargs_from_config
 def get_transformed_content(version="latest_stable", export="release", consolidate=False,
                             force_retrieve=False, output_dir=None, force_variable_name=False,
                             default_transformed_content_pattern="{kind}_{export_version}_content.json", **kwargs):
+    logger = get_logger()
     if version in ["test", ]:
         DR_content = default_transformed_content_pattern.format(kind="DR", export_version=export)
         VS_content = default_transformed_content_pattern.format(kind="VS", export_version=export)
@@ -563,23 +898,53 @@ def get_transformed_content(version="latest_stable", export="release", consolida
             content = versions[version]
             if output_dir is None:
                 output_dir = os.path.dirname(content)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
             DR_content = default_transformed_content_pattern.format(kind="DR", export_version=export)
             VS_content = default_transformed_content_pattern.format(kind="VS", export_version=export)
             DR_content = os.sep.join([output_dir, DR_content])
             VS_content = os.sep.join([output_dir, VS_content])
-            if force_retrieve or not (all(os.path.exists(filepath) for filepath in [DR_content, VS_content])):
-                if os.path.exists(DR_content):
-                    os.remove(DR_content)
-                if os.path.exists(VS_content):
-                    os.remove(VS_content)
-            if not (all(os.path.exists(filepath) for filepath in [DR_content, VS_content])):
-                content = dc.load(version, export=export, consolidate=consolidate)
-                data_request, vocabulary_server = transform_content(content, version, variable_name=kwargs["variable_name"],
-                                                                    force_variable_name=force_variable_name)
-                write_json_output_file_content(DR_content, data_request)
-                write_json_output_file_content(VS_content, vocabulary_server)
+            # The transformed content is reused as long as the key stored in its manifest matches
+            manifest_content = default_transformed_content_pattern.format(kind="manifest", export_version=export)
+            manifest_content = os.sep.join([output_dir, manifest_content])
+            # Only one process / thread transforms the content at a time, the others wait for it
+            #  and reuse its result (even if force_retrieve, as it was then transformed meanwhile)
+            waiting_since = time.time()
+            with file_lock(DR_content), file_lock(VS_content):
+                cached = [find_file(filepath) for filepath in [DR_content, VS_content]]
+                manifest = read_transformed_manifest(manifest_content)
+                source = get_source_info(content, manifest.get("source"))
+                key = get_transformed_key(source["sha256"], version, export, consolidate, force_variable_name,
+                                          kwargs["variable_name"])
+                # Use the transformed content if cached (uncompressed or compressed) and up to date
+                if all(cached) and manifest.get("key") == key and \
+                        (not force_retrieve or all(os.path.getmtime(filepath) >= waiting_since for filepath in cached)):
+                    DR_content, VS_content = cached
+                    if manifest.get("source") != source:
+                        write_json_output_file_content(manifest_content, dict(manifest, source=source))
+                else:
+                    if all(cached) and not force_retrieve:
+                        logger.info(f"Transformed content of version {version} is outdated, transform it again.")
+                    compression = get_compression(kwargs.get("cache_compression", "none"))
+                    if compression != "none":
+                        DR_content += COMPRESSION_SUFFIXES[compression]
+                        VS_content += COMPRESSION_SUFFIXES[compression]
+                    content = dc.load(version, export=export, consolidate=consolidate, **kwargs)
+                    data_request, vocabulary_server = transform_content(content, version,
+                                                                        variable_name=kwargs["variable_name"],
+                                                                        force_variable_name=force_variable_name,
+                                                                        profile=kwargs["transform_profile"],
+                                                                        profile_report=kwargs["transform_profile_report"])
+                    # The previous content is replaced atomically, and kept if the transformation fails
+                    write_json_output_file_content(DR_content, data_request)
+                    write_json_output_file_content(VS_content, vocabulary_server)
+                    write_json_output_file_content(manifest_content, dict(key=key, source=source))
+                    # Remove the previous content if stored with a different compression
+                    for filepath in [DR_content, VS_content, manifest_content]:
+                        base = strip_compression_suffix(filepath)
+                        for other in [base] + [base + suffix for suffix in COMPRESSION_SUFFIXES.values()]:
+                            if other != filepath and os.path.isfile(other):
+                                os.remove(other)
+            dc.record_cache_access([DR_content, VS_content], **kwargs)
     return dict(DR_input=DR_content, VS_input=VS_content)
 
 
@@ -545,15 +545,18 @@ class DataRequest(object):
         :return DataRequest: instance of the DataRequest object.
         """
         DR_content, VS_content = cls._split_content_from_input_json(json_input, version=version)
-        VS = VocabularyServer(VS_content)
+        # The content is built by the transformation, so owned by the Vocabulary Server
+        VS = VocabularyServer(VS_content, copy_input=False)
         return cls(input_database=DR_content, VS=VS, **kwargs)
 
     @classmethod
-    def from_separated_inputs(cls, DR_input, VS_input, **kwargs):
+    def from_separated_inputs(cls, DR_input, VS_input, copy_inputs=True, **kwargs):
         """
         Method to instanciate the DataRequestObject from two inputs.
         :param str or dict DR_input: dictionary or name of the json file containing the data request structure
         :param str or dict VS_input: dictionary or name of the json file containing the vocabulary server
+        :param bool copy_inputs: whether to copy the dictionary inputs, if False their ownership is transferred to
+                                 the DataRequest and VocabularyServer objects (see VocabularyServer)
         :param dict kwargs: additional parameters
         :return DataRequest: instance of the DataRequest object
         """
@@ -561,14 +564,14 @@ class DataRequest(object):
         if isinstance(DR_input, str) and os.path.isfile(DR_input):
             DR = read_json_file(DR_input)
         elif isinstance(DR_input, dict):
-            DR = copy.deepcopy(DR_input)
+            DR = copy.deepcopy(DR_input) if copy_inputs else DR_input
         else:
             logger.error("DR_input should be either the name of a json file or a dictionary.")
             raise TypeError("DR_input should be either the name of a json file or a dictionary.")
         if isinstance(VS_input, str) and os.path.isfile(VS_input):
             VS = VocabularyServer.from_input(VS_input)
         elif isinstance(VS_input, dict):
-            VS = VocabularyServer(copy.deepcopy(VS_input))
+            VS = VocabularyServer(VS_input, copy_input=copy_inputs)
         else:
             logger.error("VS_input should be either the name of a json file or a dictionary.")
             raise TypeError("VS_input should be either the name of a json file or a dictionary.")
@@ -73,13 +73,17 @@ class DreqRecord:
     Generic class to represent a single record from a table.
     '''
 
-    def __init__(self, record, field_info):
+    def __init__(self, record, field_info, inplace=True):
+        # If inplace is False, the input record is left untouched: lists are copied
+        # and the (immutable) values they contain are shared with the input.
         # Loop over fields in the record
         for field_name, value in record.items():
 
             # Check if the field contains links to records in other tables
             if 'linked_table_id' in field_info[field_name]:
                 assert isinstance(value, list), 'links should be a list of record identifiers'
+                if not inplace:
+                    value = list(value)
                 for m, record_id in enumerate(value):
                     # Change the record_id str into a more informative object representing the link
                     d = {
@@ -89,6 +93,8 @@ class DreqRecord:
                         # 'record_name' : '', # fill this in later if desired (finding it here would require access to whole base)
                     }
                     value[m] = DreqLink(**d)
+            elif not inplace and isinstance(value, list):
+                value = list(value)
 
             # Adjust the field name so that it's accessible as an object attribute using the dot syntax (object.attribute)
             key = field_info[field_name]['attribute_name']
@@ -131,7 +137,10 @@ class DreqTable:
     "attribute" refers to the name of the column converted to the name of a record object attribute.
     '''
 
-    def __init__(self, table, table_id2name):
+    def __init__(self, table, table_id2name, inplace=True):
+        # If inplace is True, the input table dict is altered: its field dicts are
+        # annotated and its record dicts are replaced by record objects.
+        # If inplace is False, the input table dict is left untouched.
 
         # Set attributes that describe the table
         self.table_id = table['id']
@@ -142,7 +151,8 @@ class DreqTable:
 
         # Get info about fields (columns) in the table records, which are used below when creating record objects
         fields = table['fields']  # dict giving info on each field, keyed by field_id (example: 'fld61d8b5mzI45H8F')
-        field_info = {field['name']: field for field in fields.values()}  # as fields dict, but use field name as the key
+        field_info = {field['name']: field if inplace else dict(field)
+                      for field in fields.values()}  # as fields dict, but use field name as the key
         assert len(fields) == len(field_info), 'field names are not unique!'
         # (since field names are keys in record dicts, their names should be unique)
         attr2field = {}
@@ -160,13 +170,17 @@ class DreqTable:
 
         # Loop over records to create a record object representing each one
         records = table['records']  # dict giving info on each record, keyed by record_id (example: 'reczyxsKbAseqCisA')
+        if not inplace:
+            records = dict(records)
         for record_id, record in records.items():
             if len(record) == 0:
                 # don't allow empty records!
                 # print(f'skipping empty record {record_id} in table {self.table_name}')
+                if not inplace:
+                    records[record_id] = {}
                 continue
             # Replace record dict with a record object
-            records[record_id] = DreqRecord(record, field_info)
+            records[record_id] = DreqRecord(record, field_info, inplace=inplace)
 
         # attributes for the collection of records (table rows)
         self.records = records
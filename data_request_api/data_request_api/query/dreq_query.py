@@ -20,7 +20,7 @@ from collections import OrderedDict
 from data_request_api.query.dreq_classes import (
     DreqTable, ExptRequest, PRIORITY_LEVELS, format_attribute_name)
 from data_request_api.utilities.decorators import append_kwargs_from_config
-from data_request_api.utilities.tools import write_csv_output_file_content
+from data_request_api.utilities.tools import open_file, strip_compression_suffix, write_csv_output_file_content
 
 # Version of software (python API):
 from data_request_api import version as api_version
@@ -69,17 +69,29 @@ def get_priority_levels():
 def get_table_id2name(base):
     '''
     Get a mapping from table id to table name
+    (the "version" entry of the base is ignored)
     '''
     table_id2name = {}
-    base.pop("version", None)
-    for table in base.values():
+    tables = [table for table_name, table in base.items() if table_name != "version"]
+    for table in tables:
         table_id2name.update({
             table['id']: table['name']
         })
-    assert len(table_id2name) == len(base), 'table ids are not unique!'
+    assert len(table_id2name) == len(tables), 'table ids are not unique!'
     return table_id2name
 
 
+def _get_base_tables(base, inplace=True):
+    '''
+    Return the tables of the base, i.e. the base without its "version" entry.
+    If inplace is False, a new dict is returned and the input base is left untouched.
+    '''
+    if inplace:
+        base.pop("version", None)
+        return base
+    return {table_name: table for table_name, table in base.items() if table_name != "version"}
+
+
 @append_kwargs_from_config
 def _get_base_dict(content, dreq_version, purpose='request', **kwargs):
     '''
@@ -167,6 +179,10 @@ def create_dreq_tables_for_request(content, dreq_version, **kwargs):
         }
     dreq_version : str
         Version string identifier for Data Request Content
+    inplace : bool, optional
+        If True (default), the tables in 'content' are replaced by DreqTable objects.
+        If False, 'content' is left untouched (and can be reused), and the DreqTable
+        objects share its immutable values.
 
     Returns
     -------
@@ -176,16 +192,18 @@ def create_dreq_tables_for_request(content, dreq_version, **kwargs):
     # base, content_type = _get_base_dict(content, dreq_version)
 
     # Config defaults
-    CONFIG = {'consolidate': True}
+    CONFIG = {'consolidate': True, 'inplace': True}
     # Override with input args, if given
     CONFIG.update(kwargs)
     # consolidate = CONFIG['consolidate']
+    inplace = CONFIG['inplace']
 
     # Create objects representing data request tables
     table_id2name = get_table_id2name(base)
+    base = _get_base_tables(base, inplace=inplace)
     for table_name, table in base.items():
         # print('Creating table object for table: ' + table_name)
-        base[table_name] = DreqTable(table, table_id2name)
+        base[table_name] = DreqTable(table, table_id2name, inplace=inplace)
 
     # Change names of tables if needed
     # (insulates downstream code from upstream name changes that don't affect functionality)
@@ -244,21 +262,23 @@ def create_dreq_tables_for_request(content, dreq_version, **kwargs):
     return base
 
 
-def create_dreq_tables_for_variables(content, dreq_version):
+def create_dreq_tables_for_variables(content, dreq_version, inplace=True):
     '''
     For the "data" part of the data request content (Variables, Cell Methods etc),
     render airtable export content as DreqTable objects.
 
     For the "request" part of the data request, the corresponding function is create_dreq_tables_for_request().
 
+    If inplace is False, 'content' is left untouched (see create_dreq_tables_for_request()).
     '''
     base, content_type = _get_base_dict(content, dreq_version, purpose='variables')
 
     # Create objects representing data request tables
     table_id2name = get_table_id2name(base)
+    base = _get_base_tables(base, inplace=inplace)
     for table_name, table in base.items():
         # print('Creating table object for table: ' + table_name)
-        base[table_name] = DreqTable(table, table_id2name)
+        base[table_name] = DreqTable(table, table_id2name, inplace=inplace)
 
     # Change names of tables if needed
     # (insulates downstream code from upstream name changes that don't affect functionality)
@@ -498,9 +518,10 @@ def _get_base_dreq_tables(content, dreq_version, purpose='request'):
             # tables have already been rendered as DreqTable objects
             base = content
         else:
-            # render tables as DreqTable objects
+            # render tables as DreqTable objects, leaving the content untouched
+            #   so that it can be reused by the caller
             if purpose == 'request':
-                base = create_dreq_tables_for_request(content, dreq_version)
+                base = create_dreq_tables_for_request(content, dreq_version, inplace=False)
             # elif purpose == 'variables':  # only needed for raw export?
             #     base = create_dreq_tables_for_variables(content, dreq_version)
             else:
@@ -1215,11 +1236,11 @@ def write_requested_vars_json(outfile, expt_vars, dreq_version, priority_cutoff,
 
     # Get provenance of content to include in the header
     # content_path = dc._dreq_content_loaded['json_path']
-    with open(content_path, 'rb') as f:
+    with open_file(content_path, 'rb') as f:
         content_hash = hashlib.sha256(f.read()).hexdigest()
     header.update({
         'dreq content version': dreq_version,
-        'dreq content file': os.path.basename(os.path.normpath(content_path)),
+        'dreq content file': os.path.basename(os.path.normpath(strip_compression_suffix(content_path))),
         'dreq content sha256 hash': content_hash,
         'dreq api version': api_version,
     })
@@ -1256,7 +1277,7 @@ def write_variables_metadata(all_var_info, dreq_version, filepath,
 
     if ext == '.json':
         # Get provenance of content to include in the header
-        with open(content_path, 'rb') as f:
+        with open_file(content_path, 'rb') as f:
             content_hash = hashlib.sha256(f.read()).hexdigest()
 
         # Create output dict
@@ -1265,7 +1286,7 @@ def write_variables_metadata(all_var_info, dreq_version, filepath,
                 'Description': 'Metadata attributes that characterize CMOR variables. Each variable is uniquely idenfied by a compound name comprised of a CMIP6-era table name and a short variable name.',
                 'no. of variables': len(all_var_info),
                 'dreq content version': dreq_version,
-                'dreq content file': os.path.basename(os.path.normpath(content_path)),
+                'dreq content file': os.path.basename(os.path.normpath(strip_compression_suffix(content_path))),
                 'dreq content sha256 hash': content_hash,
                 'dreq api version': api_version,
             }),
@@ -7,8 +7,9 @@ Vocabulary server.
 
 from __future__ import division, print_function, unicode_literals, absolute_import
 
-import copy
 from collections import defaultdict
+import copy
+from types import MappingProxyType
 
 from data_request_api.utilities.logger import get_logger
 from data_request_api.utilities.tools import read_json_file
@@ -28,6 +29,18 @@ def is_link_id_or_value(elt):
         return False, elt
 
 
+def is_link_id(elt):
+    """
+    Check if the input value is a link (faster than is_link_id_or_value when the value is not needed)
+    :param elt: element to be checked
+    :return: whether elt is a link
+    """
+    if isinstance(elt, str):
+        return elt.startswith("link::")
+    else:
+        return isinstance(elt, ConstantValueObj) and str(elt).startswith("link::")
+
+
 def build_link_from_id(elt):
     """
     Check if the input value is already a link and transform it if not
@@ -59,14 +72,79 @@ def to_singular(element_type):
     return element_type
 
 
+def find_loops(graph):
+    """
+    Find the loops of a directed graph, ie. its strongly connected components made of several nodes or of a node
+    linked to itself (iterative Tarjan algorithm, linear in the size of the graph).
+    :param graph: dict of the successors of each node
+    :return: list of the sorted nodes of each loop
+    """
+    index = dict()
+    lowlink = dict()
+    stack = list()
+    on_stack = set()
+    loops = list()
+    for root in sorted(graph):
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        to_explore = [(root, iter(graph.get(root, list())))]
+        while len(to_explore) > 0:
+            node, successors = to_explore[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    to_explore.append((successor, iter(graph.get(successor, list()))))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                to_explore.pop()
+                if len(to_explore) > 0:
+                    parent = to_explore[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = list()
+                    while len(component) == 0 or component[-1] != node:
+                        component.append(stack.pop())
+                        on_stack.discard(component[-1])
+                    if len(component) > 1 or node in graph.get(node, list()):
+                        loops.append(sorted(component))
+    return loops
+
+
 class VocabularyServer(object):
     """
     Class to generate a Vocabulary Server from a json file.
     """
 
-    def __init__(self, input_database, **kwargs):
-        self.vocabulary_server = copy.deepcopy(input_database)
-        self.version = self.vocabulary_server.pop("version")
+    def __init__(self, input_database, copy_input=True, **kwargs):
+        """
+        Initialisation of the Vocabulary Server
+        :param input_database: mapping of the elements (per kind and id) and of the version of the content
+        :param copy_input: whether to copy input_database; if False, the ownership of its elements is transferred to the
+                           Vocabulary Server (which annotates them with their id when looked up) and input_database
+                           may be a read-only mapping (eg. types.MappingProxyType)
+        :param kwargs: additional parameters
+        """
+        if copy_input:
+            input_database = copy.deepcopy(dict(input_database))
+        self.version = input_database["version"]
+        self.vocabulary_server = {key: value for (key, value) in input_database.items() if key != "version"}
+        # Sorted ids (and set of the ids, for membership tests) of each element type, and resolved element types
+        self.element_type_ids = {element_type: tuple(sorted(elements))
+                                 for (element_type, elements) in self.vocabulary_server.items()}
+        self.element_type_ids_set = {element_type: frozenset(element_ids)
+                                     for (element_type, element_ids) in self.element_type_ids.items()}
+        self.element_types = dict()
+        # Inverted indexes of the attributes used as id_type, built at first use (see get_attribute_index), and
+        #  values of these attributes shared by several elements
+        self.attribute_indexes = dict()
+        self.attribute_duplicates = dict()
         self.check_infinite_loop()
 
     @classmethod
@@ -77,7 +155,15 @@ class VocabularyServer(object):
         :return:
         """
         content = read_json_file(input_database)
-        return cls(content)
+        return cls(content, copy_input=False)
+
+    @property
+    def view(self):
+        """
+        Read-only view of the content of the Vocabulary Server (elements per kind and id), without copy
+        :return:
+        """
+        return MappingProxyType(self.vocabulary_server)
 
     def alias(self, element_type):
         """
@@ -108,57 +194,82 @@ class VocabularyServer(object):
         Raise an error if at least one is found.
         """
         logger = get_logger()
-        # Build the call dict
+        # Build the call dict: the attributes of each element type which contain links
         call_dict = defaultdict(set)
-        for key in self.vocabulary_server:
-            for id in self.vocabulary_server[key]:
-                for elt in self.vocabulary_server[key][id]:
-                    if isinstance(self.vocabulary_server[key][id][elt], list) and \
-                            any(is_link_id_or_value(subelt)[0] for subelt in self.vocabulary_server[key][id][elt]):
-                        call_dict[key].add(elt)
-                    elif not (isinstance(self.vocabulary_server[key][id][elt], list)) and \
-                            is_link_id_or_value(self.vocabulary_server[key][id][elt])[0]:
-                        call_dict[key].add(elt)
-
-        # Implement the function to be used
-        def follow_loop(current_key, former_keys=list()):
-            logger = get_logger()
-            found = False
-            alias_key, _ = self.get_element_type_ids(current_key)
-            if alias_key in former_keys:
-                logger.error(f"Infinite loop found: {former_keys + [current_key, ]}")
-                found = True
-            else:
-                for next_key in sorted(list(call_dict[alias_key])):
-                    found = found or follow_loop(next_key, former_keys + [alias_key, ])
-            return found
-
-        # Follow the call dict to check if there is infinite loop
-        found = any(follow_loop(key) for key in sorted(list(call_dict)))
-        if found:
+        for (key, elements) in self.vocabulary_server.items():
+            links = call_dict[key]
+            for element in elements.values():
+                for (elt, value) in element.items():
+                    if elt not in links and \
+                            (is_link_id(value) or (isinstance(value, list) and any(is_link_id(subelt)
+                                                                                   for subelt in value))):
+                        links.add(elt)
+
+        # Follow the call graph between element types to check if there is infinite loop
+        graph = {key: sorted({self.get_element_type(elt) for elt in links}) for (key, links) in call_dict.items()}
+        loops = find_loops(graph)
+        for loop in loops:
+            logger.error(f"Infinite loop found: {loop}")
+        if len(loops) > 0:
             logger.critical("Infinite loop found in vocabulary server, see former error messages.")
             raise ValueError("Infinite loop found in vocabulary server, see former error messages.")
 
     def get_element_type(self, element_type):
-        logger = get_logger()
-        element_type = to_singular(element_type)
-        element_type = self.alias(element_type)
-        if element_type not in self.vocabulary_server:
-            element_type = to_plural(element_type)
-        if element_type in self.vocabulary_server:
-            return element_type
-        else:
-            logger.error(f"Could not find element type {element_type} in the vocabulary server.")
-            raise ValueError(f"Could not find element type {element_type} in the vocabulary server.")
+        if element_type not in self.element_types:
+            logger = get_logger()
+            resolved_element_type = to_singular(element_type)
+            resolved_element_type = self.alias(resolved_element_type)
+            if resolved_element_type not in self.vocabulary_server:
+                resolved_element_type = to_plural(resolved_element_type)
+            if resolved_element_type in self.vocabulary_server:
+                self.element_types[element_type] = resolved_element_type
+            else:
+                logger.error(f"Could not find element type {resolved_element_type} in the vocabulary server.")
+                raise ValueError(f"Could not find element type {resolved_element_type} in the vocabulary server.")
+        return self.element_types[element_type]
 
     def get_element_type_ids(self, element_type):
         """
         Get elements corresponding a a specific kind
         :param element_type:
-        :return:
+        :return: the element type, the sorted tuple of the ids of its elements
         """
         element_type = self.get_element_type(element_type)
-        return element_type, sorted(list(self.vocabulary_server[element_type]))
+        return element_type, self.element_type_ids[element_type]
+
+    def get_attribute_index(self, element_type, attribute):
+        """
+        Get the inverted index of an attribute of the elements of a kind, built at first call.
+        Attributes which are lists are indexed on each of their values.
+        The values shared by several elements are recorded in self.attribute_duplicates and reported as a warning.
+        :param element_type: kind of the elements (as in the vocabulary server)
+        :param attribute: attribute to be indexed
+        :return: dict of the ids of the elements per (hashable) value of the attribute
+        """
+        key = (element_type, attribute)
+        if key not in self.attribute_indexes:
+            index = defaultdict(list)
+            for (element_id, element) in self.vocabulary_server[element_type].items():
+                values = element.get(attribute)
+                if not isinstance(values, list):
+                    values = [values, ]
+                for value in values:
+                    try:
+                        element_ids = index[value]
+                    except TypeError:
+                        # Unhashable values can only be equal to unhashable element ids, which are looked for by
+                        #  scanning the elements
+                        continue
+                    if element_id not in element_ids:
+                        element_ids.append(element_id)
+            index = dict(index)
+            duplicates = {value: element_ids for (value, element_ids) in index.items() if len(element_ids) > 1}
+            if len(duplicates) > 0:
+                get_logger().warning(f"Attribute {attribute} is not unique for element type {element_type}: "
+                                     f"{sorted(str(value) for value in duplicates)}")
+            self.attribute_duplicates[key] = duplicates
+            self.attribute_indexes[key] = index
+        return self.attribute_indexes[key]
 
     def get_element(self, element_type, element_id, element_key=None, default=False, id_type="id"):
         """
@@ -175,19 +286,22 @@ class VocabularyServer(object):
         logger = get_logger()
         is_id, element_id = is_link_id_or_value(element_id)
         if is_id or id_type != "id":
-            element_type, element_type_ids = self.get_element_type_ids(element_type)
+            element_type = self.get_element_type(element_type)
             found = False
-            if id_type in ["id", ] and element_id in element_type_ids:
+            if id_type in ["id", ] and element_id in self.element_type_ids_set[element_type]:
                 value = self.vocabulary_server[element_type][element_id]
                 found = True
             elif isinstance(id_type, str):
                 if element_id is None:
                     raise ValueError("None element_id found")
-                value = list()
-                for (key, val) in self.vocabulary_server[element_type].items():
-                    val = val.get(id_type)
-                    if (isinstance(val, list) and element_id in val) or element_id == val:
-                        value.append(key)
+                try:
+                    value = self.get_attribute_index(element_type, id_type).get(element_id, list())
+                except TypeError:
+                    value = list()
+                    for (key, val) in self.vocabulary_server[element_type].items():
+                        val = val.get(id_type)
+                        if (isinstance(val, list) and element_id in val) or element_id == val:
+                            value.append(key)
                 if len(value) == 1:
                     found = True
                     element_id = value[0]
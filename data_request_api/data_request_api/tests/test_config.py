@@ -151,6 +151,20 @@ def test_update_config_update_existing_key(temp_config_file, monkeypatch):
     assert dreqcfg.CONFIG["offline"] is False
 
 
+def test_update_config_int_key(temp_config_file, monkeypatch):
+    monkeypatch.setattr(
+        "data_request_api.utilities.config.CONFIG_FILE", temp_config_file
+    )
+    update_config("memory_cache_size", "5")
+    assert dreqcfg.CONFIG["memory_cache_size"] == 5
+    update_config("memory_cache_max_mb", 0)
+    assert dreqcfg.CONFIG["memory_cache_max_mb"] == 0
+    with pytest.raises(TypeError):
+        update_config("memory_cache_size", "many")
+    with pytest.raises(ValueError):
+        update_config("memory_cache_size", "-1")
+
+
 def test_sanity_checks():
     with pytest.raises(KeyError):
         _sanity_check("invalid_key", "invalid_value")
@@ -164,6 +178,9 @@ def test_sanity_checks():
     with pytest.raises(TypeError):
         _sanity_check("offline", 1)
 
+    with pytest.raises(TypeError):
+        _sanity_check("memory_cache_size", True)
+
     _sanity_check("offline", True)
     _sanity_check("export", "raw")
     _sanity_check("consolidate", True)
@@ -1,15 +1,29 @@
+import concurrent.futures
+import copy
+import json
+import re
+
 import pytest
 
 import data_request_api.utilities.config as dreqcfg
+from data_request_api.content import consolidate_export as ce
 from data_request_api.content import dreq_content as dc
 from data_request_api.content.consolidate_export import (
+    ConsolidationContext,
     _apply_consistency_fixes,
     _filter_references,
+    _build_record_index,
     _map_attribute,
     _map_record_id,
+    _split_quoted,
+    compile_mapping_plan,
     map_data,
 )
-from data_request_api.content.mapping_table import version_consistency_drop_fields, version_consistency_fields
+from data_request_api.content.mapping_table import (
+    mapping_table,
+    version_consistency_drop_fields,
+    version_consistency_fields,
+)
 from data_request_api.tests import filepath
 from data_request_api.utilities.logger import change_log_file, change_log_level
 from data_request_api.utilities.tools import read_json_file, write_json_output_file_content
@@ -59,6 +73,138 @@ def test_map_attribute():
     assert _map_attribute(attr, records, ["name"]) == ["test1"]
 
 
+def test_map_with_record_index():
+    # Read 3-base export
+    several_bases_input = read_json_file(filepath("dreq_raw_export.json"))
+    # Select the list of records to map against
+    records = several_bases_input["Data Request Physical Parameters (Public)"]["CF Standard Name"]["records"]
+    # The index groups the record ids by value, in order of appearance
+    index = _build_record_index(records, "name")
+    assert index["mole_concentration_of_aragonite_expressed_as_carbon_in_sea_water"] == ["rec0ik3QbkrzxJy0n"]
+    assert sum(len(v) for v in index.values()) == len([v for v in records.values() if "name" in v])
+    # Assert the indexed lookup yields the same matches as the full scan
+    index = {}
+    for attr in [v["name"] for v in records.values() if "name" in v] + ["someName"]:
+        assert _map_attribute(attr, records, ["name"], index) == _map_attribute(attr, records, ["name"])
+        assert _map_record_id({"name": attr}, records, ["name"], index) == _map_record_id(
+            {"name": attr}, records, ["name"]
+        )
+    assert set(index.keys()) == {"name"}
+    # Unhashable values fall back to the full scan
+    records["test1"] = {"name": ["a", "list"]}
+    assert _map_attribute(["a", "list"], records, ["name"], {}) == ["test1"]
+
+
+def test_filter_references():
+    # Set up a consolidation context with filtered records
+    context = ConsolidationContext()
+    context.filter_record("Variables", "recA")
+    context.filter_record("Variables", "recB")
+    context.filter_record("Opportunity", "recC")
+    assert context.is_filtered("recA")
+    assert not context.is_filtered("recD")
+    assert not context.is_filtered({"url": "unhashable"})
+    assert context.get_filtered_records() == ["recA", "recB", "recC"]
+    # Lists of references
+    assert _filter_references(["recA", "recD"], "key", "table", "rid", context=context) == ["recD"]
+    assert _filter_references(["recA", "recC"], "key", "table", "rid", context=context) == []
+    # Strings with comma-separated references
+    assert _filter_references("recD, recB,recE", "key", "table", "rid", context=context) == "recD,recE"
+    assert _filter_references("recC ", "key", "table", "rid", context=context) == ""
+    assert _filter_references("recD", "key", "table", "rid", "listofstr", context=context) == ["recD"]
+    assert context.counters["filtered_references"] == 5
+    # Without context nothing is filtered
+    assert _filter_references(["recA", "recD"], "key", "table", "rid") == ["recA", "recD"]
+    # Contexts are independent of each other
+    assert not ConsolidationContext().is_filtered("recA")
+
+
+def test_split_quoted():
+    pattern = r',\s*(?=(?:[^"]|"[^"]*")*$)'
+    for value in [
+        "",
+        "a",
+        "a,b, c,  d",
+        'a, "b, c", d',
+        '"a, b"',
+        'a, "b, c, d',
+        'a,\n\tb, ""',
+        ', a,',
+    ]:
+        assert _split_quoted(value) == [v.strip('"') for v in re.split(pattern, value)]
+
+
+def test_compiled_consolidation():
+    # Read 3-base export
+    several_bases_input = read_json_file(filepath("dreq_raw_export.json"))
+    # The compiled mapping plan is cached per mapping table and export schema
+    plan = compile_mapping_plan(mapping_table, several_bases_input)
+    assert compile_mapping_plan(mapping_table, several_bases_input) is plan
+    altered_mapping_table = copy.deepcopy(mapping_table)
+    altered_mapping_table["Variables"]["drop_keys"].append("Title")
+    assert compile_mapping_plan(altered_mapping_table, several_bases_input) is not plan
+    # Only the most recently used plans are kept
+    for i in range(ce._mapping_plans_size):
+        other_mapping_table = copy.deepcopy(mapping_table)
+        other_mapping_table["Variables"]["drop_keys"].append(f"Other {i}")
+        compile_mapping_plan(other_mapping_table, several_bases_input)
+        assert len(ce._mapping_plans) <= ce._mapping_plans_size
+    assert compile_mapping_plan(mapping_table, several_bases_input) is not plan
+    # Concurrent compilations and lookups keep the cache consistent
+    other_mapping_tables = []
+    for i in range(2 * ce._mapping_plans_size):
+        other_mapping_tables.append(copy.deepcopy(mapping_table))
+        other_mapping_tables[-1]["Variables"]["drop_keys"].append(f"Concurrent {i}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        plans = list(executor.map(lambda mt: compile_mapping_plan(mt, several_bases_input), other_mapping_tables * 4))
+    assert all(isinstance(other_plan, ce.MappingPlan) for other_plan in plans)
+    assert len(ce._mapping_plans) == ce._mapping_plans_size
+    assert [tp.table for tp in plan.tables] == list(mapping_table)
+    assert plan.missing_bases == [] and plan.missing_tables == []
+    # The consolidation yields the output of the consolidation before the compiled mapping plans,
+    #  generated from the same export (raw_output_consolidated.json.gz), except for the order of the
+    #  lists it built from sets, which depended on the hash seed
+    #  (filter "In progress" experiment groups to exercise the filtering of records)
+    filtered_mapping_table = copy.deepcopy(mapping_table)
+    filtered_mapping_table["Experiment Group"]["internal_filters"]["Status"] = {
+        "aliases": [],
+        "operator": "in",
+        "values": ["Done"],
+    }
+    reference = read_json_file(filepath("raw_output_consolidated.json.gz"))
+
+    def normalized(value):
+        if isinstance(value, dict):
+            return {key: normalized(val) for key, val in value.items()}
+        elif isinstance(value, list) and all(isinstance(val, str) for val in value):
+            return sorted(value)
+        elif isinstance(value, list):
+            return [normalized(val) for val in value]
+        return value
+
+    for name, mt in [("default", mapping_table), ("filtered", filtered_mapping_table)]:
+        context = ConsolidationContext()
+        consolidated = map_data(several_bases_input, mt, "v1.2.2", context=context)
+        assert json.dumps(normalized(consolidated)) == json.dumps(normalized(reference[name]["content"]))
+        assert sorted(context.get_filtered_records()) == reference[name]["filtered_records"]
+    assert len(context.filtered_records_per_table["Experiment Group"]) == 2
+    assert context.counters["filtered_references"] > 0
+    # The input data is left untouched
+    assert several_bases_input == read_json_file(filepath("dreq_raw_export.json"))
+
+
+def test_parallel_consolidation():
+    # Read 3-base export
+    several_bases_input = read_json_file(filepath("dreq_raw_export.json"))
+    context_serial = ConsolidationContext()
+    context_parallel = ConsolidationContext()
+    serial = map_data(several_bases_input, mapping_table, "v1.2.2", context=context_serial)
+    parallel = map_data(several_bases_input, mapping_table, "v1.2.2", context=context_parallel, workers=2)
+    # Byte-identical output, including the order of the tables
+    assert json.dumps(parallel) == json.dumps(serial)
+    assert context_parallel.counters == context_serial.counters
+
+
 def test_apply_consistency_fixes():
     # Consistency fixes for Variables table fields
     varfield_renamed = list(version_consistency_fields["Variables"].values())
@@ -718,6 +718,14 @@ class TestDataRequest(unittest.TestCase):
         self.assertEqual(len(obj.get_variable_groups()), 13)
         self.assertEqual(len(obj.get_opportunities()), 4)
 
+        # Without copy, the inputs are owned by the objects
+        obj = DataRequest.from_separated_inputs(DR_input=self.input_database, VS_input=self.vs_dict, copy_inputs=False)
+        self.assertIs(obj.structure, self.input_database)
+        self.assertIs(obj.VS.vocabulary_server["mips"], self.vs_dict["mips"])
+        self.assertEqual(len(obj.get_experiment_groups()), 6)
+        self.assertEqual(len(obj.get_variable_groups()), 13)
+        self.assertEqual(len(obj.get_opportunities()), 4)
+
         obj = DataRequest.from_separated_inputs(DR_input=self.input_database, VS_input=self.vs_file)
         self.assertEqual(len(obj.get_experiment_groups()), 6)
         self.assertEqual(len(obj.get_variable_groups()), 13)
@@ -1,11 +1,26 @@
+import copy
+import filecmp
+import functools
+import gzip
+import hashlib
+import http.server
+import io
+import json
 import os
 import pathlib
+import shutil
+import tarfile
 import tempfile
+import threading
+import time
 
 import pytest
 
 import data_request_api.utilities.config as dreqcfg
 from data_request_api.content import dreq_content as dc
+from data_request_api.query import dreq_query as dq
+from data_request_api.tests import filepath
+from data_request_api.utilities import tools
 from data_request_api.utilities.logger import change_log_file, change_log_level
 
 # Set up temporary config file with default config
@@ -44,6 +59,57 @@ def test_get_versions_list_branches():
     assert "main" not in branches
 
 
+def test_get_versions_index(tmp_path, monkeypatch, caplog):
+    "Test the persisted version index of the get_versions function."
+    dc._dreq_res = str(tmp_path)
+    monkeypatch.setattr(dc, "versions", {"tags": [], "branches": []})
+    monkeypatch.setattr(dc, "_versions_retrieved_last", {"tags": 0, "branches": 0})
+    calls = []
+    responses = {"tags": ["v1.0", "v1.1"], "branches": ["one"]}
+
+    def mock_send_api_request(api_url, page_url="", target="tags"):
+        calls.append(target)
+        return list(responses[target])
+
+    monkeypatch.setattr(dc, "_send_api_request", mock_send_api_request)
+    kwargs = dict(offline=False, check_api_version=False)
+
+    # Retrieved and persisted
+    assert dc.get_versions(**kwargs) == ["v1.0", "v1.1", "dev"]
+    assert dc.get_versions(target="branches", **kwargs) == ["one"]
+    assert calls == ["tags", "branches"]
+    assert os.path.isfile(tmp_path / dc._version_index)
+
+    # A new session uses the persisted version index
+    monkeypatch.setattr(dc, "versions", {"tags": [], "branches": []})
+    monkeypatch.setattr(dc, "_versions_retrieved_last", {"tags": 0, "branches": 0})
+    assert dc.get_versions(**kwargs) == ["v1.0", "v1.1", "dev"]
+    assert calls == ["tags", "branches"]
+
+    # ... unless outdated
+    responses["tags"].append("v1.2")
+    time.sleep(0.01)
+    assert dc.get_versions(version_index_ttl=0, **kwargs) == ["v1.0", "v1.1", "v1.2", "dev"]
+    assert calls == ["tags", "branches", "tags"]
+    # ... which also applies within a session
+    assert dc.get_versions(**kwargs) == ["v1.0", "v1.1", "v1.2", "dev"]
+    assert calls == ["tags", "branches", "tags"]
+    time.sleep(0.01)
+    dc.get_versions(version_index_ttl=0, **kwargs)
+    assert calls == ["tags", "branches", "tags", "tags"]
+
+    # Outdated version index as fallback if the retrieval fails
+    responses["tags"] = []
+    time.sleep(0.01)
+    assert dc.get_versions(version_index_ttl=0, **kwargs) == ["v1.0", "v1.1", "v1.2", "dev"]
+    assert "Using the outdated list of 'tags' of the version index." in caplog.text
+
+    # Corrupt version index is ignored
+    (tmp_path / dc._version_index).write_text("corrupt")
+    responses["tags"] = ["v2.0"]
+    assert dc.get_versions(version_index_ttl=0, **kwargs) == ["v2.0", "dev"]
+
+
 def test_get_latest_version(monkeypatch):
     "Test the _get_latest_version function."
     monkeypatch.setattr(
@@ -107,6 +173,467 @@ def test_retrieve_with_invalid_export(tmp_path):
         dc.retrieve("v1.2.1", export="invalid")
 
 
+@pytest.fixture
+def http_server(tmp_path):
+    "Local HTTP server standing in for the GitHub raw content."
+    server_dir = tmp_path / "server"
+    server_dir.mkdir()
+    status_codes = []
+
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+        def log_request(self, code="-", size="-"):
+            status_codes.append(int(code))
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(server_dir))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server_dir, f"http://127.0.0.1:{server.server_address[1]}", status_codes
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_retrieve_all_concurrently(tmp_path, monkeypatch, http_server, caplog, threads):
+    "Test the retrieval of all versions from a local HTTP server."
+    server_dir, url, _ = http_server
+    dc._dreq_res = str(tmp_path / "dreq_res")
+    tags = ["v1.0", "v1.1", "v1.2", "v1.3", "v1.4", "dev"]
+    missing = ["v1.3", "v1.4"]
+    for tag in tags:
+        target, version = ("heads", dc._dev_branch) if tag == "dev" else ("tags", tag)
+        if tag not in missing:
+            (server_dir / target / version).mkdir(parents=True)
+            shutil.copy(filepath(dc._json_release), server_dir / target / version / dc._json_release)
+    monkeypatch.setattr(dc, "REPO_RAW_URL", url + "/{target}/{version}/{_json_export}")
+    monkeypatch.setattr(dc, "REPO_RAW_URL_DEV", url + "/heads/{version}/{_json_export}")
+    monkeypatch.setattr(dc, "get_versions", lambda target="tags", **kwargs: tags if target == "tags" else [])
+
+    with pytest.warns(UserWarning) as record:
+        json_paths = dc.retrieve("all", threads=threads)
+    # The failed retrievals are reported in a single warning
+    assert len(record) == 1
+    message = str(record[0].message)
+    assert message.startswith("Retrieval failed for 2 version(s):")
+    assert "Could not retrieve version 'v1.3'" in message
+    assert "Could not retrieve version 'v1.4'" in message
+    # The retrieved versions are returned in the order of the requested versions
+    assert list(json_paths) == [tag for tag in tags if tag not in missing]
+    for tag, json_path in json_paths.items():
+        assert filecmp.cmp(json_path, filepath(dc._json_release), shallow=False)
+    if threads > 1:
+        assert "Retrieval 6/6" in caplog.text
+
+    # A single failed version is reported as before
+    with pytest.warns(UserWarning, match="^Could not retrieve version 'v1.3': "):
+        with pytest.raises(ValueError, match="not cached"):
+            dc.retrieve("v1.3", threads=threads)
+
+
+def test_retrieve_conditional(tmp_path, monkeypatch, http_server, caplog):
+    "Test the revalidation of the 'dev' version with conditional requests."
+    server_dir, url, status_codes = http_server
+    dc._dreq_res = str(tmp_path / "dreq_res")
+    served = server_dir / "heads" / dc._dev_branch / dc._json_release
+    served.parent.mkdir(parents=True)
+    shutil.copy(filepath(dc._json_release), served)
+    os.utime(served, (1e9, 1e9))
+    monkeypatch.setattr(dc, "REPO_RAW_URL_DEV", url + "/heads/{version}/{_json_export}")
+
+    # Initial download stores the validators
+    json_path = dc.retrieve("dev", export="release")["dev"]
+    assert status_codes == [200]
+    assert os.path.isfile(dc._validators_path(json_path))
+    assert "Retrieved version 'dev'." in caplog.text
+
+    # Unchanged upstream: not transferred again
+    caplog.clear()
+    dc.retrieve("dev", export="release")
+    assert status_codes == [200, 304]
+    assert "Updated version 'dev'." not in caplog.text
+
+    # Changed upstream: updated
+    served.write_text(served.read_text()[:-1] + " ")
+    os.utime(served, (2e9, 2e9))
+    dc.retrieve("dev", export="release")
+    assert status_codes == [200, 304, 200]
+    assert "Updated version 'dev'." in caplog.text
+    assert filecmp.cmp(json_path, served, shallow=False)
+
+    # Changed locally: downloaded again regardless of the validators
+    caplog.clear()
+    with open(json_path, "a") as f:
+        f.write("\n")
+    dc.retrieve("dev", export="release")
+    assert status_codes == [200, 304, 200, 200]
+    assert "Updated version 'dev'." in caplog.text
+    assert filecmp.cmp(json_path, served, shallow=False)
+
+
+def test_compressed_cache(tmp_path, monkeypatch, http_server, caplog):
+    "Test the compressed storage of the retrieved exports."
+    server_dir, url, status_codes = http_server
+    dc._dreq_res = str(tmp_path / "dreq_res")
+    for target, version in [("tags", "v1.2.2"), ("heads", dc._dev_branch)]:
+        (server_dir / target / version).mkdir(parents=True)
+        shutil.copy(filepath(dc._json_release), server_dir / target / version / dc._json_release)
+    monkeypatch.setattr(dc, "REPO_RAW_URL", url + "/{target}/{version}/{_json_export}")
+    monkeypatch.setattr(dc, "REPO_RAW_URL_DEV", url + "/heads/{version}/{_json_export}")
+    monkeypatch.setattr(dc, "get_versions", lambda target="tags", **kwargs: ["v1.2.2", "dev"] if target == "tags" else [])
+    kwargs = dict(export="release", cache_compression="gzip", memory_cache_size=0)
+
+    # Tag and dev exports are stored compressed
+    json_paths = dc.retrieve("all", **kwargs)
+    for version, json_path in json_paths.items():
+        assert json_path == str(tmp_path / "dreq_res" / version / (dc._json_release + ".gz"))
+        assert not os.path.exists(json_path[:-3])
+        with gzip.open(json_path, "rb") as f, open(filepath(dc._json_release), "rb") as fref:
+            assert f.read() == fref.read()
+    assert set(dc.get_cached(export="release")) == {"v1.2.2", "dev"}
+
+    # ... and revalidated
+    dc.retrieve("dev", **kwargs)
+    assert status_codes[-1] == 304
+
+    # Loading is transparent
+    content = dc.load("v1.2.2", **kwargs)
+    shutil.copy(filepath(dc._json_release), tmp_path / "dreq_res" / "v1.2.2" / dc._json_release)
+    os.remove(json_paths["v1.2.2"])
+    assert dc.load("v1.2.2", **kwargs) == content
+    assert dc.load("v1.2.2", consolidate=False, **kwargs) == dc.load("dev", consolidate=False, **kwargs)
+
+    # Unavailable codec
+    monkeypatch.setattr(tools, "_import_zstandard", lambda: None)
+    assert tools.get_compression("zstd") == "gzip"
+    assert "requires the zstandard package" in caplog.text
+
+    # Deletion of compressed exports
+    dc.delete("dev", export="release")
+    assert not os.path.exists(json_paths["dev"])
+    assert dc.get_cached(export="release") == ["v1.2.2"]
+
+
+def test_retrieve_concurrent_waiters(tmp_path, monkeypatch, http_server):
+    "Test that concurrent retrievals of a version download it once and reuse the result."
+    server_dir, url, status_codes = http_server
+    dc._dreq_res = str(tmp_path / "dreq_res")
+    for target, version in [("tags", "v1.2.2"), ("heads", dc._dev_branch)]:
+        (server_dir / target / version).mkdir(parents=True)
+        shutil.copy(filepath(dc._json_release), server_dir / target / version / dc._json_release)
+    monkeypatch.setattr(dc, "REPO_RAW_URL", url + "/{target}/{version}/{_json_export}")
+    monkeypatch.setattr(dc, "REPO_RAW_URL_DEV", url + "/heads/{version}/{_json_export}")
+
+    barrier = threading.Barrier(8)
+    results = []
+
+    def retrieve(version):
+        barrier.wait()
+        results.append(dc._retrieve_version(version, tags=["v1.2.2"], export="release"))
+
+    for version in ["v1.2.2", "dev"]:
+        status_codes.clear()
+        results.clear()
+        threads = [threading.Thread(target=retrieve, args=(version,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Downloaded once, the waiters reuse the downloaded file without any request
+        assert status_codes == [200]
+        json_path = str(tmp_path / "dreq_res" / version / dc._json_release)
+        assert results == [(json_path, None)] * 8
+        assert filecmp.cmp(json_path, filepath(dc._json_release), shallow=False)
+        assert not [f for f in os.listdir(os.path.dirname(json_path)) if ".tmp" in f]
+
+    # Later retrievals of "dev" are revalidated again
+    dc._retrieve_version("dev", tags=["v1.2.2"], export="release")
+    assert status_codes == [200, 304]
+
+
+def test_evict(tmp_path, caplog):
+    "Test the size-budgeted eviction of cached artifacts."
+    dc._dreq_res = str(tmp_path)
+    artifacts = [
+        tmp_path / "v1.0" / dc._json_release,
+        tmp_path / "dev" / dc._json_raw,
+        tmp_path / "v1.1" / "DR_release_content.json",
+        tmp_path / "v1.1" / "dreq_release_export.consolidated.json",
+    ]
+    for artifact in artifacts:
+        artifact.parent.mkdir(exist_ok=True)
+        artifact.write_bytes(b"x" * 1024**2)
+    validators = pathlib.Path(dc._validators_path(str(artifacts[1])))
+    validators.write_text("{}")
+    # Last access: least recently used first
+    (tmp_path / dc._access_index).write_text(
+        json.dumps({os.path.relpath(artifact, tmp_path): n for n, artifact in enumerate(artifacts)})
+    )
+
+    # No budget
+    assert dc.evict(cache_budget_mb=0) == []
+
+    # Dryrun
+    evicted = dc.evict(cache_budget_mb=2, dryrun=True)
+    assert evicted == [str(artifacts[0]), str(artifacts[1])]
+    assert all(artifact.exists() for artifact in artifacts)
+    assert f"Dryrun: would evict '{artifacts[0]}' (1.0 MB" in caplog.text
+
+    # Files in use are kept
+    evicted = dc.evict(cache_budget_mb=2, keep=[str(artifacts[0])])
+    assert evicted == [str(artifacts[1]), str(artifacts[2])]
+    assert [artifact.exists() for artifact in artifacts] == [True, False, False, True]
+    assert not validators.exists()
+    assert set(json.loads((tmp_path / dc._access_index).read_text())) == {
+        os.path.relpath(artifacts[0], tmp_path), os.path.relpath(artifacts[3], tmp_path)
+    }
+
+    # Access makes the least recently used artifact the most recently used one
+    dc.record_cache_access([str(artifacts[0])], cache_budget_mb=1)
+    assert [artifact.exists() for artifact in artifacts] == [True, False, False, False]
+
+    # Files in use exceeding the budget
+    caplog.clear()
+    dc.record_cache_access([str(artifacts[0])], cache_budget_mb=0)
+    assert dc.evict(cache_budget_mb=1, keep=[str(artifacts[0])]) == []
+    artifacts[0].write_bytes(b"x" * 2 * 1024**2)
+    assert dc.evict(cache_budget_mb=1, keep=[str(artifacts[0])]) == []
+    assert "exceeds its budget" in caplog.text
+
+    # Files locked by another process / thread are kept
+    artifacts[3].write_bytes(b"x" * 1024**2)
+    with tools.file_lock(str(artifacts[3])):
+        assert dc.evict(cache_budget_mb=2, keep=[str(artifacts[0])]) == []
+    assert artifacts[3].exists()
+    assert dc.evict(cache_budget_mb=2, keep=[str(artifacts[0])]) == [str(artifacts[3])]
+    # The lock files of the evicted artifacts are removed
+    assert not pathlib.Path(tools.lock_path(str(artifacts[3]))).exists()
+
+
+def test_file_lock_removal(tmp_path):
+    "Test that removed lock files are not left behind and do not break the lock."
+    path = str(tmp_path / "file.json")
+    pathlib.Path(path).write_text("{}")
+    acquired = threading.Event()
+    order = []
+
+    def waiter():
+        acquired.wait()
+        with tools.file_lock(path):
+            order.append("waiter")
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    with tools.file_lock(path):
+        acquired.set()
+        time.sleep(0.2)
+        # The waiter blocks on the lock file, which is removed along with the file
+        os.remove(path)
+        tools.remove_lock(path)
+        order.append("holder")
+    thread.join()
+    assert order == ["holder", "waiter"]
+    # The waiter took the lock on a new lock file, kept as long as no one removes it
+    assert os.path.isfile(tools.lock_path(path))
+
+    # The lock file is kept while a file sharing it remains
+    pathlib.Path(path + ".gz").write_bytes(b"")
+    with tools.file_lock(path):
+        tools.remove_lock(path)
+    assert os.path.isfile(tools.lock_path(path))
+    os.remove(path + ".gz")
+    with tools.file_lock(path):
+        tools.remove_lock(path)
+    assert not os.path.isfile(tools.lock_path(path))
+
+
+def test_pack_unpack(tmp_path, monkeypatch):
+    "Test the offline bundles of cached versions."
+    dc._dreq_res = str(tmp_path / "cache")
+    monkeypatch.setattr(dc, "versions", {"tags": [], "branches": []})
+    export = (pathlib.Path(filepath(dc._json_release))).read_bytes()
+    raw_export = (pathlib.Path(filepath(dc._json_raw))).read_bytes()
+    files = {
+        "v1.2.2/" + dc._json_release + ".gz": gzip.compress(export),
+        "v1.2.2/DR_release_content.json": b"{}",
+        "dev/" + dc._json_raw: raw_export,
+    }
+    for name, data in files.items():
+        (tmp_path / "cache" / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / "cache" / name).write_bytes(data)
+    # Not packed: consolidated content, HTTP validators, lock and temporary files
+    (tmp_path / "cache" / "v1.2.2" / "dreq_release_export.consolidated.json").write_text("consolidated")
+    (tmp_path / "cache" / "dev" / "dreq_raw_export.http.json").write_text("{}")
+    (tmp_path / "cache" / "dev" / "dreq_raw_export.json.lock").write_text("")
+    (tmp_path / "cache" / "dev" / "dreq_raw_export.json.1.2.tmp").write_text("")
+
+    # Pack
+    archive = str(tmp_path / "bundle.tar.gz")
+    assert dc.pack(archive) == ["dev", "v1.2.2"]
+    with pytest.raises(ValueError, match="Version 'v1.0' not found."):
+        dc.pack(archive, version="v1.0")
+    with tarfile.open(archive) as tar:
+        assert tar.getnames()[-1] == dc._cache_manifest
+        assert sorted(tar.getnames()[:-1]) == sorted(files)
+        manifest = json.load(tar.extractfile(dc._cache_manifest))
+    assert manifest["versions"]["v1.2.2"]["exports"] == {"release": dc._json_release + ".gz"}
+    assert manifest["versions"]["dev"]["exports"] == {"raw": dc._json_raw}
+    assert manifest["versions"]["dev"]["files"][dc._json_raw] == {
+        "sha256": hashlib.sha256(raw_export).hexdigest(), "size": len(raw_export)
+    }
+
+    # Unpack into another cache directory, replacing the export cached uncompressed
+    dc._dreq_res = str(tmp_path / "other")
+    (tmp_path / "other" / "v1.2.2").mkdir(parents=True)
+    (tmp_path / "other" / "v1.2.2" / dc._json_release).write_text("{}")
+    assert dc.unpack(archive) == ["dev", "v1.2.2"]
+    for name, data in files.items():
+        assert (tmp_path / "other" / name).read_bytes() == data
+    assert not (tmp_path / "other" / "v1.2.2" / dc._json_release).exists()
+    # The consolidated content is regenerated locally
+    for name in ["v1.2.2/dreq_release_export.consolidated.json", "dev/dreq_raw_export.consolidated.json"]:
+        with open(tmp_path / "other" / name, "rb") as f:
+            assert json.loads(f.readline())["key"]["api_version"] == dc.api_version
+
+    # Offline retrieval reads the cache manifest
+    def mock_get_cached(**kwargs):
+        raise AssertionError("The cache directory is scanned.")
+
+    with monkeypatch.context() as m:
+        m.setattr(dc, "get_cached", mock_get_cached)
+        assert dc.get_versions(offline=True, export="release") == ["v1.2.2"]
+        assert dc.get_versions(offline=True, export="raw") == ["dev"]
+        assert dc.retrieve("v1.2.2", offline=True, export="release") == {
+            "v1.2.2": str(tmp_path / "other" / "v1.2.2" / (dc._json_release + ".gz"))
+        }
+        assert dc.retrieve("dev", offline=True, export="raw") == {
+            "dev": str(tmp_path / "other" / "dev" / dc._json_raw)
+        }
+
+    # Deleted versions are removed from the cache manifest
+    dc.delete("dev", export="raw")
+    assert dc.get_versions(offline=True, export="raw") == []
+
+    # Corrupt bundle
+    corrupt = str(tmp_path / "corrupt.tar")
+    with tarfile.open(archive) as tar, tarfile.open(corrupt, "w") as tar_corrupt:
+        for member in tar.getmembers():
+            data = tar.extractfile(member).read()
+            if member.name == "dev/" + dc._json_raw:
+                data = data.replace(b"{", b"[", 1)
+            tar_corrupt.addfile(member, io.BytesIO(data))
+    with pytest.raises(ValueError, match="does not match its sha256"):
+        dc.unpack(corrupt, consolidate=False)
+
+    # Files not bundled by pack, eg. pickled content, are not installed
+    crafted = str(tmp_path / "crafted.tar")
+    pickled = b"cos\nsystem\n(S'echo crafted'\ntR."
+    crafted_files = {"v1.2.2/dreq_release_export.consolidated.pkl": pickled, "v1.2.2/" + dc._json_release: export}
+    crafted_manifest = {
+        "format": dc._manifest_format,
+        "versions": {"v1.2.2": {"files": {
+            name.split("/")[1]: {"sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}
+            for name, data in crafted_files.items()
+        }}},
+    }
+    with tarfile.open(crafted, "w") as tar:
+        for name, data in list(crafted_files.items()) + [(dc._cache_manifest, json.dumps(crafted_manifest).encode())]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    dc._dreq_res = str(tmp_path / "crafted")
+    assert dc.unpack(crafted, consolidate=False) == ["v1.2.2"]
+    assert [name for name in os.listdir(tmp_path / "crafted" / "v1.2.2") if not name.endswith(".lock")] == [
+        dc._json_release
+    ]
+    empty = str(tmp_path / "empty.tar")
+    tarfile.open(empty, "w").close()
+    with pytest.raises(ValueError, match="not a valid offline bundle"):
+        dc.unpack(empty)
+
+
+def test_transformed_content_cache(tmp_path, monkeypatch):
+    "Test that the transformed content is reused as long as its key matches."
+    from data_request_api.content import dump_transformation as dt
+
+    dc._dreq_res = str(tmp_path)
+    (tmp_path / "v1.2.2").mkdir()
+    export = tmp_path / "v1.2.2" / dc._json_release
+    shutil.copy(filepath("dreq_release_export.json"), export)
+
+    calls = []
+    transform_content = dt.transform_content
+
+    def counting_transform_content(*args, **kwargs):
+        calls.append(1)
+        return transform_content(*args, **kwargs)
+
+    monkeypatch.setattr(dt, "transform_content", counting_transform_content)
+    kwargs = dict(version="v1.2.2", export="release", consolidate=False, offline=True)
+
+    content = dt.get_transformed_content(**kwargs)
+    assert len(calls) == 1
+    assert os.path.isfile(content["DR_input"]) and os.path.isfile(content["VS_input"])
+    manifest_path = tmp_path / "v1.2.2" / "manifest_release_content.json"
+    manifest = json.loads(manifest_path.read_text())
+    assert manifest["key"]["source_sha256"] == hashlib.sha256(export.read_bytes()).hexdigest()
+
+    # Reused
+    assert dt.get_transformed_content(**kwargs) == content
+    assert len(calls) == 1
+
+    # Reused if the export is only touched, without hashing it again afterwards
+    os.utime(export, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    dt.get_transformed_content(**kwargs)
+    assert len(calls) == 1
+    assert json.loads(manifest_path.read_text())["source"]["mtime_ns"] == os.stat(export).st_mtime_ns
+
+    # Transformed again if the export, the transformation settings or API version change
+    export.write_text(export.read_text().replace("Accepted", "Under review", 1))
+    dt.get_transformed_content(**kwargs)
+    assert len(calls) == 2
+    dt.get_transformed_content(**kwargs, force_variable_name=True, variable_name="CMIP6 Compound Name")
+    assert len(calls) == 3
+    monkeypatch.setattr(dt, "api_version", "0.0.0")
+    dt.get_transformed_content(**kwargs, force_variable_name=True, variable_name="CMIP6 Compound Name")
+    assert len(calls) == 4
+    dt.get_transformed_content(**kwargs, force_variable_name=True, variable_name="CMIP6 Compound Name")
+    assert len(calls) == 4
+
+    # Transformed again if forced, or without manifest
+    dt.get_transformed_content(**kwargs, force_variable_name=True, variable_name="CMIP6 Compound Name",
+                               force_retrieve=True)
+    assert len(calls) == 5
+    manifest_path.unlink()
+    dt.get_transformed_content(**kwargs)
+    assert len(calls) == 6
+    # The variable name is only part of the key if forced
+    dt.get_transformed_content(**kwargs, variable_name="CMIP6 Compound Name")
+    assert len(calls) == 6
+
+    # The previous content is kept if the transformation fails
+    def failing_transform_content(*args, **kwargs):
+        raise RuntimeError("Transformation failed")
+
+    export.write_text(export.read_text().replace("Accepted", "Under review", 1))
+    with monkeypatch.context() as m:
+        m.setattr(dt, "transform_content", failing_transform_content)
+        with pytest.raises(RuntimeError):
+            dt.get_transformed_content(**kwargs)
+    assert os.path.isfile(content["DR_input"]) and os.path.isfile(content["VS_input"]) and manifest_path.exists()
+
+    # The previous content is replaced once transformed with another compression
+    compressed = dt.get_transformed_content(**kwargs, cache_compression="gzip")
+    assert len(calls) == 7
+    assert compressed == {key: value + ".gz" for key, value in content.items()}
+    assert not os.path.exists(content["DR_input"]) and not os.path.exists(content["VS_input"])
+
+
 def test_api_and_html_request(recwarn):
     "Test the _send_api_request and _send_html_request functions."
     tags1 = set(dc._send_api_request(dc.REPO_API_URL, "", "tags"))
@@ -279,6 +806,207 @@ class TestDreqContent:
         with pytest.raises(Exception, match="Network request detected"):
             dc.load("v1.0.0", consolidate=False, offline=False)
 
+    @pytest.mark.parametrize("export", ["raw", "release"])
+    def test_load_tables(self, export):
+        "Test the loading of selected tables."
+        dc._dreq_res = self.dreq_res
+        (self.dreq_res / "v1.2.2").mkdir()
+        shutil.copy(filepath(f"dreq_{export}_export.json"), self.dreq_res / "v1.2.2" / f"dreq_{export}_export.json")
+        tables = ["CMIP7 Frequency", "Experiments", "Variables"]
+        kwargs = dict(export=export, offline=True, memory_cache_size=0, cache_consolidated=False)
+        full = dc.load("v1.2.2", **kwargs)["Data Request"]
+
+        content = dc.load("v1.2.2", tables=tables, **kwargs)["Data Request"]
+        # The selected tables are identical, the others are kept without records
+        assert sorted(content) == sorted(full)
+        for table in content:
+            if table in tables:
+                assert content[table] == full[table]
+            elif table != "version":
+                assert content[table]["records"] == {}
+                assert content[table] == {**full[table], "records": {}}
+        # Links to tables without records can be resolved
+        if export == "release":
+            base = dq.create_dreq_tables_for_variables({"Data Request": content}, "v1.2.2")
+            assert len(base["Variables"].records) == len(full["Variables"]["records"])
+
+        # Not consolidated, eg. pretty-printed with a different indentation or not at all
+        raw = dc.load("v1.2.2", export=export, offline=True, consolidate=False)
+        for indent in [2, None]:
+            with open(self.dreq_res / "v1.2.2" / f"dreq_{export}_export.json", "w") as f:
+                json.dump(raw, f, indent=indent)
+            content = dc.load("v1.2.2", tables=["Variable", "Variables"], consolidate=False, **kwargs)
+            for base_name, base_content in content.items():
+                for table, table_content in base_content.items():
+                    if table in ["Variable", "Variables"]:
+                        assert table_content == raw[base_name][table]
+                    else:
+                        assert table_content == {**raw[base_name][table], "records": {}}
+
+    def test_load_tables_layout(self, monkeypatch):
+        "Test the loading of selected tables of exports with unusual layouts, read in small chunks."
+        dc._dreq_res = self.dreq_res
+        (self.dreq_res / "v1.2.2").mkdir()
+        export = self.dreq_res / "v1.2.2" / dc._json_release
+        monkeypatch.setattr(dc, "_json_chunk_size", 3)
+        # Mixed indentation, closing braces at the start of lines inside records, escaped
+        #  delimiters inside strings, nested arrays, compact and scalar members
+        export.write_text(
+            '{"Data Request":{\n'
+            '\t"A": {"records": {\n  "r1": {"v": "x\\n}\\n{\\"]\\\\", "l": [1, [2.5e3, {}], null]\n},\n'
+            '"r2"  :{"v":"\\u00e9}]"}\n}, "name": "A", "id": 1},\n'
+            '    "B":{"records":{"r3":{"v":"\\"{[","n":-1}},"fields":{"f":{"t":"}"}}},\n'
+            '  "version": "v1.2.2", "flags": [true, false]\n}}\n'
+        )
+        expected = json.loads(export.read_text())
+        kwargs = dict(export="release", offline=True, memory_cache_size=0, consolidate=False)
+        content = dc.load("v1.2.2", tables=["B"], **kwargs)
+        assert content == {"Data Request": {
+            **expected["Data Request"], "A": {**expected["Data Request"]["A"], "records": {}}
+        }}
+        assert dc.load("v1.2.2", tables=["A", "B"], **kwargs) == expected
+
+        # Invalid exports
+        for invalid in ['{"Data Request": {"A": {"records": {"r": "x}}}}', '{"Data Request": {"A": 1} x', "[]"]:
+            export.write_text(invalid)
+            with pytest.raises(ValueError):
+                dc.load("v1.2.2", tables=["A"], **kwargs)
+
+    def test_load_consolidated_cache(self, monkeypatch):
+        "Test the cache of the consolidated content."
+        dc._dreq_res = self.dreq_res
+        version_dir = self.dreq_res / "v1.2.2"
+        version_dir.mkdir()
+        export = version_dir / dc._json_raw
+        shutil.copy(filepath("dreq_raw_export.json"), export)
+        cache_path = pathlib.Path(dc._consolidated_cache_path(str(export)))
+
+        calls = []
+        map_data = dc.ce.map_data
+
+        def counting_map_data(*args, **kwargs):
+            calls.append(args[2])
+            return map_data(*args, **kwargs)
+
+        monkeypatch.setattr(dc.ce, "map_data", counting_map_data)
+
+        # Consolidate and cache (the in-memory cache is disabled)
+        content = dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0)
+        assert calls == ["v1.2.2"]
+        assert cache_path.is_file()
+
+        # Load from cache, without reading the export while its size and modification time are unchanged
+        opened = []
+        open_file = dc.open_file
+
+        def counting_open_file(filename, *args, **kwargs):
+            opened.append(filename)
+            return open_file(filename, *args, **kwargs)
+
+        monkeypatch.setattr(dc, "open_file", counting_open_file)
+        assert dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0) == content
+        assert calls == ["v1.2.2"]
+        assert str(export) not in opened
+
+        # Touched export is hashed once, the cache being kept and its header updated
+        os.utime(export, ns=(export.stat().st_atime_ns, export.stat().st_mtime_ns + 10**9))
+        assert dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0) == content
+        assert opened.count(str(export)) == 1
+        assert json.loads(cache_path.read_bytes().split(b"\n", 1)[0])["export"]["mtime_ns"] == export.stat().st_mtime_ns
+        assert dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0) == content
+        assert opened.count(str(export)) == 1
+        assert calls == ["v1.2.2"]
+
+        # Bypass the cache
+        assert dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0, cache_consolidated=False) == content
+        assert len(calls) == 2
+
+        # Altered export invalidates the cache
+        export.write_text(export.read_text() + "\n")
+        assert dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0) == content
+        assert len(calls) == 3
+
+        # Altered mapping table invalidates the cache
+        altered_mapping_table = copy.deepcopy(dc.mapping_table)
+        altered_mapping_table["Variables"]["internal_filters"] = {}
+        monkeypatch.setattr(dc, "mapping_table", altered_mapping_table)
+        dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0)
+        assert len(calls) == 4
+
+        # Corrupt cache is replaced
+        cache_path.write_bytes(b"corrupt")
+        dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0)
+        assert len(calls) == 5
+        dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0)
+        assert len(calls) == 5
+
+        # The cache is plain JSON, its key is checked from the header and its payload against its sha256
+        header, payload = cache_path.read_bytes().split(b"\n", 1)
+        assert json.loads(header)["sha256"] == hashlib.sha256(payload).hexdigest()
+        assert json.loads(payload) == content
+        cache_path.write_bytes(header + b"\n" + payload.replace(b"Atmosphere", b"Atmosphera", 1))
+        assert dc.load("v1.2.2", export="raw", offline=True, memory_cache_size=0) == content
+        assert len(calls) == 6
+
+        # Deleting the version deletes the cache, and the lock files
+        dc.delete("v1.2.2", export="raw")
+        assert not cache_path.exists()
+        assert not any(path.name.endswith(".lock") for path in version_dir.iterdir())
+
+    def test_load_memory_cache(self, monkeypatch):
+        "Test the in-memory cache of loaded content."
+        dc._dreq_res = self.dreq_res
+        dc._loaded_content.clear()
+        (self.dreq_res / "v1.0.0" / dc._json_release).write_text('{"a": {"b": 1}}')
+
+        calls = []
+        open_file = dc.open_file
+
+        def counting_open_file(*args, **kwargs):
+            calls.append(1)
+            return open_file(*args, **kwargs)
+
+        monkeypatch.setattr(dc, "open_file", counting_open_file)
+        kwargs = dict(consolidate=False, offline=True, memory_cache_size=2, memory_cache_max_mb=0)
+
+        content = dc.load("v1.0.0", **kwargs)
+        assert content == {"a": {"b": 1}}
+        assert len(calls) == 1
+
+        # Cached content is handed out as copies
+        content["a"]["b"] = 2
+        assert dc.load("v1.0.0", **kwargs) == {"a": {"b": 1}}
+        assert len(calls) == 1
+
+        # Updated export invalidates the cached content
+        (self.dreq_res / "v1.0.0" / dc._json_release).write_text('{"a": {"b": 3}}')
+        assert dc.load("v1.0.0", **kwargs) == {"a": {"b": 3}}
+        assert len(calls) == 2
+
+        # Least recently used content is evicted
+        dc.load("1.0.1", **kwargs)
+        dc.load("2.0.1", **kwargs)
+        assert list(dc._loaded_content) == [("1.0.1", "release", False), ("2.0.1", "release", False)]
+        dc.load("1.0.1", **kwargs)
+        assert list(dc._loaded_content) == [("2.0.1", "release", False), ("1.0.1", "release", False)]
+
+        # Memory cap
+        dc._loaded_content.clear()
+        (self.dreq_res / "v1.0.0" / dc._json_release).write_text('{"a": "' + "x" * 1024**2 + '"}')
+        dc.load("v1.0.0", **{**kwargs, "memory_cache_max_mb": 1})
+        assert list(dc._loaded_content) == []
+        dc.load("v1.0.0", **{**kwargs, "memory_cache_max_mb": 2})
+        dc.load("1.0.1", **{**kwargs, "memory_cache_max_mb": 2})
+        assert list(dc._loaded_content) == [("v1.0.0", "release", False), ("1.0.1", "release", False)]
+
+        # Disabled, as by default
+        dc._loaded_content.clear()
+        dc.load("1.0.1", **{**kwargs, "memory_cache_size": 0})
+        assert list(dc._loaded_content) == []
+        monkeypatch.setattr(dreqcfg, "CONFIG", {})
+        dc.load("1.0.1", consolidate=False, offline=True)
+        assert list(dc._loaded_content) == []
+
     # def test_load(self):
     #    dc._dreq_res = self.tmp_dir.name
     #    data = dc.load("1.0.0")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test dreq_query.py
+"""
+from __future__ import print_function, division, unicode_literals, absolute_import
+
+import copy
+import unittest
+
+from data_request_api.content.consolidate_export import map_data
+from data_request_api.content.mapping_table import mapping_table
+from data_request_api.query import dreq_query as dq
+from data_request_api.query.dreq_classes import DreqTable
+from data_request_api.utilities.tools import read_json_file
+from data_request_api.tests import filepath
+
+
+class TestCreateDreqTables(unittest.TestCase):
+    def setUp(self):
+        self.version = "v1.2.2"
+        self.content = map_data(read_json_file(filepath("dreq_release_export.json")), mapping_table, self.version)
+
+    def test_inplace(self):
+        content = copy.deepcopy(self.content)
+        base = dq.create_dreq_tables_for_request(content, self.version)
+        self.assertIs(base, content["Data Request"])
+        self.assertNotIn("version", base)
+        self.assertTrue(all(isinstance(table, DreqTable) for table in base.values()))
+
+    def test_not_inplace(self):
+        content = copy.deepcopy(self.content)
+        base = dq.create_dreq_tables_for_request(content, self.version, inplace=False)
+        # Input left untouched
+        self.assertEqual(content, self.content)
+        self.assertIsNot(base, content["Data Request"])
+        # Same tables as when created in place
+        base_inplace = dq.create_dreq_tables_for_request(copy.deepcopy(self.content), self.version)
+        self.assertEqual(sorted(base), sorted(base_inplace))
+        for table_name, table in base.items():
+            self.assertEqual(table.records, base_inplace[table_name].records)
+            self.assertEqual(table.field_info, base_inplace[table_name].field_info)
+            self.assertEqual(table.links, base_inplace[table_name].links)
+        # Altering the tables leaves the input untouched
+        opp_id = base["Opportunity"].record_ids[0]
+        base["Opportunity"].delete_record(opp_id)
+        self.assertIn(opp_id, content["Data Request"]["Opportunity"]["records"])
+
+    def test_reuse_content(self):
+        content = copy.deepcopy(self.content)
+        metadata = dq.get_variables_metadata(content, self.version, verbose=False)
+        self.assertEqual(content, self.content)
+        self.assertEqual(dq.get_variables_metadata(content, self.version, verbose=False), metadata)
+
+
+if __name__ == '__main__':
+    unittest.main()
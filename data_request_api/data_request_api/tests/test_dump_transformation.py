@@ -7,11 +7,16 @@ Test dump_transformation.py
 from __future__ import print_function, division, unicode_literals, absolute_import
 
 import copy
+import os
+import tempfile
 import unittest
+from unittest import mock
 
 from data_request_api.utilities.tools import read_json_file
 from data_request_api.content.dump_transformation import correct_key_string, correct_dictionaries, \
-    transform_content_inner, transform_content, split_content_one_base, get_transform_settings
+    transform_content_inner, transform_content, split_content_one_base, get_transform_settings, tidy_content, \
+    replace_linked_ids, get_key_actions, apply_key_actions, TransformProfiler, transform_profile_env, \
+    remove_unused_keys, copy_useful_keys, rename_useful_keys, merge_useful_keys, sort_useful_keys, reshape_useful_keys
 from data_request_api.tests import filepath
 
 
@@ -76,6 +81,181 @@ class TestCorrectDictionaries(unittest.TestCase):
             correct_dictionaries("test")
 
 
+class TestKeyActions(unittest.TestCase):
+    def test_correct(self):
+        settings = {
+            "default_keys_to_delete": [".*review.*"],
+            "keys_to_delete": {"variables": ["size"]},
+            "keys_to_copy": {"variables": {"compound_name": "name"}},
+            "keys_to_rename": {"variables": {"^frequency": "cmip7_frequency"}},
+            "keys_to_merge": {"variables": {"mode(l)+ing_realm.*": "modelling_realm"}},
+            "keys_to_sort": {"variables": ["modelling_realm"]},
+            "keys_to_format": {"list_to_string": {"variables": ["cmip7_frequency"]}}
+        }
+        content = {
+            "variables": {
+                "rec1": {"compound_name": "atmos.tas", "size": 3, "author_review": "ok", "frequency": ["mon"],
+                         "modeling_realm_-_primary": "atmos", "modelling_realm_-_secondary": ["land", "atmos"]}
+            },
+            "mips": {
+                "rec2": {"name": "CMIP", "review_status": "ok"}
+            }
+        }
+        key_actions = get_key_actions(list(content), settings)
+        content = apply_key_actions(content, key_actions, ["remove", "copy", "rename", "merge"])
+        self.assertDictEqual(content, {
+            "variables": {
+                "rec1": {"compound_name": "atmos.tas", "name": "atmos.tas", "cmip7_frequency": ["mon"],
+                         "modelling_realm": ["atmos", "land", "atmos"]}
+            },
+            "mips": {
+                "rec2": {"name": "CMIP"}
+            }
+        })
+        content = apply_key_actions(content, key_actions, ["sort", "reshape"])
+        self.assertDictEqual(content["variables"]["rec1"], {
+            "compound_name": "atmos.tas", "name": "atmos.tas", "cmip7_frequency": "mon",
+            "modelling_realm": ["atmos", "land"]
+        })
+
+    def test_content_level(self):
+        content = {
+            "variables": {"records": {
+                "rec1": {"compound_name": "atmos.tas", "size": 3, "author_review": "ok", "frequency": ["mon"],
+                         "modeling_realm_-_primary": "atmos", "modelling_realm_-_secondary": ["land", "atmos"]}
+            }},
+            "mips": {"records": {
+                "rec2": {"name": "CMIP", "review_status": "ok", "frequency": "fx"}
+            }}
+        }
+        content = remove_unused_keys(content, {"variables": ["size"]}, default_patterns_to_remove=[".*review.*"])
+        content = copy_useful_keys(content, {"variables": {"compound_name": "name"}, "default": {"name": "title"}})
+        content = rename_useful_keys(content, {"variables": {"^frequency": "cmip7_frequency"}})
+        content = merge_useful_keys(content, {"variables": {"mode(l)+ing_realm.*": "modelling_realm"}})
+        content = sort_useful_keys(content, {"variables": ["modelling_realm"]})
+        content = reshape_useful_keys(content, {"variables": ["cmip7_frequency"]}, reshape_style="list_to_string")
+        content = reshape_useful_keys(content, {"mips": ["frequency"]}, reshape_style="string_to_list")
+        self.assertDictEqual(content, {
+            "variables": {
+                "rec1": {"compound_name": "atmos.tas", "name": "atmos.tas", "cmip7_frequency": "mon",
+                         "modelling_realm": ["atmos", "land"]}
+            },
+            "mips": {
+                "rec2": {"name": "CMIP", "frequency": ["fx"], "title": "CMIP"}
+            }
+        })
+        with self.assertRaises(ValueError):
+            reshape_useful_keys(content, {"mips": ["frequency"]}, reshape_style="unknown")
+
+
+class TestTidyContent(unittest.TestCase):
+    def test_correct(self):
+        content = {
+            "opportunities": {
+                "op1": {"uid": "op1", "variable_groups": ["recvg1"]},
+                "op2": {"uid": "op2", "variable_groups": []}
+            },
+            "variable_groups": {
+                "vg1": {"uid": "vg1", "variables": ["recvar1"], "comments": {"recvar1": "recvar1 comment"}},
+                "vg2": {"uid": "vg2", "variables": ["recvar2"]}
+            },
+            "variables": {
+                "var1": {"uid": "var1", "name": "var1"},
+                "var2": {"uid": "var2"},
+                "var3": {"uid": "var3"}
+            }
+        }
+        record_to_uid_index = {
+            "opportunities": {"recop1": "op1", "recop2": "op2"},
+            "variable_groups": {"recvg1": "vg1", "recvg2": "vg2"},
+            "variables": {"recvar1": "var1", "recvar2": "var2", "recvar3": "var3"}
+        }
+        new_content = {
+            "opportunities": {
+                "op1": {"uid": "op1", "variable_groups": ["link::vg1"]},
+                "op2": {"uid": "op2", "variable_groups": []}
+            },
+            "variable_groups": {
+                "vg1": {"uid": "vg1", "variables": ["link::var1"], "comments": {"link::var1": "recvar1 comment"}}
+            },
+            "variables": {
+                "var1": {"uid": "var1", "name": "var1"}
+            }
+        }
+        new_record_to_uid_index = {
+            "opportunities": {},
+            "variable_groups": {"recvg1": "vg1"},
+            "variables": {"recvar1": "var1", "recvar2": "var2"}
+        }
+        self.assertDictEqual(tidy_content(content, record_to_uid_index), new_content)
+        self.assertDictEqual(record_to_uid_index, new_record_to_uid_index)
+
+    def test_prefix_uids(self):
+        # Only the exact references are counted: once "vg2" removed, "default_1" is not referenced anymore,
+        #  its uid being only a prefix of "default_10" or a part of a free text
+        content = {
+            "opportunities": {
+                "op1": {"uid": "op1", "variable_groups": ["recvg1"]}
+            },
+            "variable_groups": {
+                "vg1": {"uid": "vg1", "variables": ["recvar10"], "notes": "see default_1"},
+                "vg2": {"uid": "vg2", "variables": ["recvar1"]}
+            },
+            "variables": {
+                "default_1": {"uid": "default_1"},
+                "default_10": {"uid": "default_10"}
+            }
+        }
+        record_to_uid_index = {
+            "opportunities": {"recop1": "op1"},
+            "variable_groups": {"recvg1": "vg1", "recvg2": "vg2"},
+            "variables": {"recvar1": "default_1", "recvar10": "default_10"}
+        }
+        new_content = {
+            "opportunities": {
+                "op1": {"uid": "op1", "variable_groups": ["link::vg1"]}
+            },
+            "variable_groups": {
+                "vg1": {"uid": "vg1", "variables": ["link::default_10"], "notes": "see default_1"}
+            },
+            "variables": {
+                "default_10": {"uid": "default_10"}
+            }
+        }
+        self.assertDictEqual(tidy_content(content, record_to_uid_index), new_content)
+
+
+class TestReplaceLinkedIds(unittest.TestCase):
+    def test_correct(self):
+        content = {
+            "variable_group": {
+                "fields": {
+                    "fld1": {"name": "Variables", "linked_table_id": "tbl1"},
+                    "fld2": {"name": "Notes"}
+                },
+                "records": {
+                    "recvg1": {"variables": ["rec1", "rec2"], "notes": "rec1", "links": {"rec1": 1}},
+                    "recvg2": {"variables": ["rec11"], "notes": "about rec1"},
+                    "rec1": {"variables": [], "notes": None}
+                }
+            }
+        }
+        new_content = {
+            "variable_group": {
+                "fields": {
+                    "fld1": {"name": "Variables", "linked_table_id": "tbl1"},
+                    "fld2": {"name": "Notes"}
+                },
+                "records": {
+                    "recvg1": {"variables": ["recnew1", "rec2"], "notes": "recnew1", "links": {"recnew1": 1}},
+                    "recvg2": {"variables": ["rec11"], "notes": "about rec1"},
+                    "recnew1": {"variables": [], "notes": None}
+                }
+            }
+        }
+        self.assertDictEqual(replace_linked_ids(content, {"rec1": "recnew1"}), new_content)
+
+
 class TestTransformContent(unittest.TestCase):
     def setUp(self):
         self.version = "test"
@@ -127,6 +307,42 @@ class TestTransformContent(unittest.TestCase):
         self.assertDictEqual(DR_output, self.several_bases_DR_output)
         self.assertDictEqual(VS_output, self.several_bases_VS_output)
 
+    def test_all_correct_profiled(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report = os.sep.join([tmpdir, "profile.json"])
+            with self.assertLogs(level="INFO") as logs:
+                DR_output, VS_output = transform_content(self.several_bases_input, version=self.version,
+                                                         profile_report=report)
+            self.assertDictEqual(DR_output, self.several_bases_DR_output)
+            self.assertDictEqual(VS_output, self.several_bases_VS_output)
+            stages = read_json_file(report)["stages"]
+        self.assertListEqual([stage["name"] for stage in stages],
+                             ["correct_dictionaries", "harmonise_bases", "rename_tables",
+                              "remove_copy_rename_merge_keys", "filter_content", "initialize_useful_keys",
+                              "add_useful_keys", "tidy_content", "sort_reshape_keys", "split_content_one_base"])
+        self.assertTrue(all(stage["duration"] >= 0 and stage["peak_memory_mb"] > 0 for stage in stages))
+        self.assertEqual(stages[-2]["records"], sum(len(records)
+                                                    for records in self.several_bases_output_transform.values()))
+        self.assertTrue(any("Transformation stage tidy_content" in line for line in logs.output))
+
+    def test_profiler_settings(self):
+        self.assertFalse(TransformProfiler.from_settings().enabled)
+        self.assertTrue(TransformProfiler.from_settings(profile=True).enabled)
+        self.assertEqual(TransformProfiler.from_settings(report="report.json").report, "report.json")
+        with mock.patch.dict(os.environ, {transform_profile_env: "false"}):
+            self.assertFalse(TransformProfiler.from_settings(profile=True, report="report.json").enabled)
+        with mock.patch.dict(os.environ, {transform_profile_env: "1"}):
+            profiler = TransformProfiler.from_settings()
+            self.assertTrue(profiler.enabled)
+            self.assertIsNone(profiler.report)
+        with mock.patch.dict(os.environ, {transform_profile_env: "other.json"}):
+            self.assertEqual(TransformProfiler.from_settings(report="report.json").report, "other.json")
+        # Disabled profiler measures nothing
+        profiler = TransformProfiler()
+        with profiler, profiler.stage("dummy", lambda: 1 / 0):
+            pass
+        self.assertListEqual(profiler.stages, list())
+
     def test_transform_inner_error(self):
         with self.assertRaises(TypeError):
             transform_content_inner(self.several_bases_input)
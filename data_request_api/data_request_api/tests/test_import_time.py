@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Test the import time of the modules used by the command line tools (python -X importtime).
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Budget (in microseconds) of the cumulative import time of each module - generous, to catch
+#  regressions such as eagerly imported heavy dependencies rather than to benchmark
+IMPORT_TIME_BUDGET = 500000
+
+# Modules to be imported on the online code paths only
+ONLINE_MODULES = ["requests", "urllib3", "bs4", "pooch"]
+
+
+def import_times(module, tmp_path):
+    """Return the cumulative import time (in microseconds) per imported module."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    env["CMIP7_DR_API_CONFIGFILE"] = str(tmp_path / ".CMIP7_data_request_api_config")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    times = dict()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("module", [
+    "data_request_api.content.dreq_content",
+    "data_request_api.command_line.export_dreq_lists_json",
+    "data_request_api.command_line.get_variables_metadata",
+    "data_request_api.command_line.estimate_dreq_volume",
+])
+def test_import_time(module, tmp_path):
+    times = import_times(module, tmp_path)
+    assert module in times
+    # The network and HTML parsing dependencies are not imported
+    assert [name for name in ONLINE_MODULES if name in times] == []
+    assert times[module] < IMPORT_TIME_BUDGET
@@ -7,11 +7,12 @@ Test vocabulary_server.py
 from __future__ import print_function, division, unicode_literals, absolute_import
 
 import copy
+import types
 import unittest
 
 from data_request_api.utilities.tools import read_json_input_file_content
 from data_request_api.query.vocabulary_server import VocabularyServer, is_link_id_or_value, build_link_from_id, \
-    to_plural, to_singular
+    to_plural, to_singular, is_link_id, find_loops
 from data_request_api.tests import filepath
 
 
@@ -23,6 +24,12 @@ class TestLinks(unittest.TestCase):
         self.assertEqual(is_link_id_or_value(5), (False, 5))
         self.assertEqual(is_link_id_or_value("link::test"), (True, "test"))
 
+    def test_is_link_id(self):
+        self.assertFalse(is_link_id("test"))
+        self.assertFalse(is_link_id(None))
+        self.assertFalse(is_link_id(["link::test", ]))
+        self.assertTrue(is_link_id("link::test"))
+
     def test_build_link_from_id(self):
         self.assertEqual(build_link_from_id(None), None)
         self.assertEqual(build_link_from_id(6), 6)
@@ -30,6 +37,20 @@ class TestLinks(unittest.TestCase):
         self.assertEqual(build_link_from_id("link::test"), "link::test")
 
 
+class TestFindLoops(unittest.TestCase):
+    def test_find_loops(self):
+        self.assertListEqual(find_loops(dict()), list())
+        self.assertListEqual(find_loops(dict(a=["b", "c"], b=["c"], c=list())), list())
+        self.assertListEqual(find_loops(dict(a=["a"], b=["a"])), [["a"], ])
+        self.assertListEqual(find_loops(dict(a=["b"], b=["c"], c=["a", "d"], d=["e"], e=["d"], f=["a"])),
+                             [["d", "e"], ["a", "b", "c"]])
+        # Deep graphs do not hit the recursion limit
+        graph = {i: [i + 1, ] for i in range(10000)}
+        self.assertListEqual(find_loops(graph), list())
+        graph[10000] = [0, ]
+        self.assertListEqual(find_loops(graph), [list(range(10001)), ])
+
+
 class TestChangeNumber(unittest.TestCase):
     def setUp(self):
         self.vs_file = filepath("VS_release_content.json")
@@ -74,6 +95,30 @@ class TestVocabularyServer(unittest.TestCase):
 
         obj = VocabularyServer.from_input(self.vs_file)
 
+    def test_init_without_copy(self):
+        obj = VocabularyServer(self.vs_content)
+        self.assertIsNot(obj.vocabulary_server["mips"], self.vs_content["mips"])
+
+        obj = VocabularyServer(self.vs_content, copy_input=False)
+        self.assertIn("version", self.vs_content)
+        self.assertEqual(obj.version, self.vs_content["version"])
+        self.assertIs(obj.vocabulary_server["mips"], self.vs_content["mips"])
+        self.assertEqual(obj.get_element(element_type="mips", element_id="TIPMIP", id_type="name", element_key="uid"),
+                         "527f5c6c-8c97-11ef-944e-41a8eb05f654")
+
+        obj = VocabularyServer(types.MappingProxyType(self.vs_content), copy_input=False)
+        self.assertIs(obj.vocabulary_server["mips"], self.vs_content["mips"])
+        obj = VocabularyServer(types.MappingProxyType(self.vs_content))
+        self.assertIsNot(obj.vocabulary_server["mips"], self.vs_content["mips"])
+
+        with self.assertRaises(ValueError):
+            VocabularyServer(self.vs_content_infinite_loop, copy_input=False)
+
+        view = obj.view
+        self.assertIs(view["mips"], obj.vocabulary_server["mips"])
+        with self.assertRaises(TypeError):
+            view["mips"] = dict()
+
     def test_get_element(self):
         vs = VocabularyServer.from_input(self.vs_file)
 
@@ -166,3 +211,45 @@ class TestVocabularyServer(unittest.TestCase):
 
         with self.assertRaises(ValueError):
             obj = vs.get_element(element_type="mips", element_id="link::527f5c6c-8c97-11ef-944e-41a8eb05f654", element_key="long_name")
+
+    def test_get_element_from_attribute_index(self):
+        content = dict(version="test", mips={
+            "mip1": dict(name="MIP1", aliases=["M1", "First"], uid="mip1"),
+            "mip2": dict(name="MIP2", aliases=["M2", "First"], uid="mip2"),
+            "mip3": dict(name="MIP3", aliases=[["M3", ], ], uid="mip3")
+        })
+        vs = VocabularyServer(content)
+        self.assertEqual(vs.get_element(element_type="mips", element_id="MIP2", id_type="name", element_key="uid"),
+                         "mip2")
+        self.assertDictEqual(vs.get_attribute_index("mips", "name"), {"MIP1": ["mip1"], "MIP2": ["mip2"],
+                                                                      "MIP3": ["mip3"]})
+        # The values shared by several elements are reported and recorded when building the index
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(vs.get_element(element_type="mip", element_id="M1", id_type="aliases",
+                                            element_key="uid"), "mip1")
+        self.assertEqual(logs.output, ["WARNING:root:Attribute aliases is not unique for element type mips: "
+                                       "['First']", ])
+        self.assertDictEqual(vs.attribute_duplicates, {("mips", "name"): dict(),
+                                                       ("mips", "aliases"): {"First": ["mip1", "mip2"]}})
+        self.assertIsNone(vs.get_element(element_type="mips", element_id="M4", id_type="aliases", default=None))
+        with self.assertRaises(ValueError):
+            vs.get_element(element_type="mips", element_id="First", id_type="aliases")
+        # Unhashable values are found by scanning the elements
+        self.assertEqual(vs.get_element(element_type="mips", element_id=["M3", ], id_type="aliases",
+                                        element_key="uid"), "mip3")
+        # The index is only built once
+        index = vs.get_attribute_index("mips", "aliases")
+        vs.get_element(element_type="mips", element_id="M2", id_type="aliases")
+        self.assertIs(vs.get_attribute_index("mips", "aliases"), index)
+
+    def test_get_element_type_ids(self):
+        vs = VocabularyServer(self.vs_content)
+        self.assertEqual(vs.get_element_type("mip"), "mips")
+        self.assertEqual(vs.get_element_type("theme"), "data_request_themes")
+        self.assertEqual(vs.get_element_type("opportunity"), "opportunities")
+        with self.assertRaises(ValueError):
+            vs.get_element_type("my_type")
+        element_type, element_ids = vs.get_element_type_ids("mips")
+        self.assertEqual(element_type, "mips")
+        self.assertEqual(element_ids, tuple(sorted(self.vs_content["mips"])))
+        self.assertIs(vs.get_element_type_ids("mip")[1], element_ids)
@@ -1,9 +1,7 @@
 #!/usr/bin/env python
 
-from importlib.metadata import version, PackageNotFoundError
 import os
 from pathlib import Path
-import requests
 import yaml
 
 # Config file location in the user's home directory
@@ -21,7 +19,14 @@ DEFAULT_CONFIG = {
     "log_file": "default",
     "cache_dir": str(Path.home() / f".{PACKAGE_NAME}_cache"),
     "check_api_version": True,
-    "variable_name": "CMIP7 Compound Name"
+    "variable_name": "CMIP7 Compound Name",
+    "memory_cache_size": 0,
+    "memory_cache_max_mb": 1024,
+    "version_index_ttl": 3600,
+    "cache_compression": "none",
+    "cache_budget_mb": 0,
+    "transform_profile": False,
+    "transform_profile_report": "",
 }
 
 # Valid types and values for each key
@@ -34,6 +39,13 @@ DEFAULT_CONFIG_TYPES = {
     "cache_dir": str,
     "check_api_version": bool,
     "variable_name": str,
+    "memory_cache_size": int,
+    "memory_cache_max_mb": int,
+    "version_index_ttl": int,
+    "cache_compression": str,
+    "cache_budget_mb": int,
+    "transform_profile": bool,
+    "transform_profile_report": str,
 }
 
 # Valid types and values for each key
@@ -45,12 +57,20 @@ DEFAULT_CONFIG_HELP = {
     "log_file": "Log file to use",
     "cache_dir": "Cache directory to use",
     "check_api_version": "Check pypi for the latest API version?",
-    "variable_name": "Unique identifier to use for requested variables"
+    "variable_name": "Unique identifier to use for requested variables",
+    "memory_cache_size": "Number of loaded data request contents to keep in memory (0 to disable)",
+    "memory_cache_max_mb": "Maximum size (MB) of the loaded data request contents kept in memory (0 for no limit)",
+    "version_index_ttl": "Time (s) during which the cached list of available versions is used without a new request",
+    "cache_compression": "Compression of the cached content (zstd requires the zstandard package)",
+    "cache_budget_mb": "Size budget (MB) of the cache directory, least recently used files are evicted (0 for no limit)",
+    "transform_profile": "Log time, peak memory and record counts of the content transformation stages?",
+    "transform_profile_report": "JSON file the content transformation stages profile is written to (empty for none)",
 }
 
 DEFAULT_CONFIG_VALID_VALUES = {
     "export": ["release", "raw"],
     "log_level": ["debug", "info", "warning", "error", "critical"],
+    "cache_compression": ["none", "gzip", "zstd"],
 }
 
 # Global variable to hold the loaded config
@@ -63,8 +83,12 @@ def _sanity_check(key, value):
         raise KeyError(
             f"Invalid config key: {key}. Valid keys: {sorted(list(DEFAULT_CONFIG.keys()))}"
         )
-    if not isinstance(value, DEFAULT_CONFIG_TYPES[key]):
+    if not isinstance(value, DEFAULT_CONFIG_TYPES[key]) or (
+        DEFAULT_CONFIG_TYPES[key] is int and isinstance(value, bool)
+    ):
         raise TypeError(f"Invalid type for config key {key}: {type(value)}")
+    if DEFAULT_CONFIG_TYPES[key] is int and value < 0:
+        raise ValueError(f"Invalid value for config key {key}: {value}. Must not be negative.")
     if (
         key in DEFAULT_CONFIG_VALID_VALUES
         and value not in DEFAULT_CONFIG_VALID_VALUES[key]
@@ -127,7 +151,8 @@ def update_config(key, value):
     Args:
         key (str): The configuration key to update.
         value (Any): The new value for the configuration key. Boolean-like strings
-                     ("true", "false") will be converted to actual booleans.
+                     ("true", "false") will be converted to actual booleans, integer
+                     strings to integers for integer keys.
 
     Raises:
         KeyError: If the key is not in the DEFAULT_CONFIG.
@@ -146,6 +171,8 @@ def update_config(key, value):
     value = str(value)
     if value.lower() in {"true", "false"}:
         value = value.lower() == "true"
+    elif DEFAULT_CONFIG_TYPES.get(key) is int and value.lstrip("-").isdigit():
+        value = int(value)
     _sanity_check(key, value)
 
     # Overwrite / set the value
@@ -167,6 +194,10 @@ def check_api_version():
         installed_version = '1.2.1.dev8+g6aa6222.d20250515' ==> warn user
         installed_version = '1.2.2.dev8+g6aa6222.d20250515' ==> don't warn user
     """
+    # Imported here, as only needed when checking (saves import time)
+    from importlib.metadata import version, PackageNotFoundError
+    import requests
+
     try:
         installed_version = version(PACKAGE_NAME)
     except PackageNotFoundError:
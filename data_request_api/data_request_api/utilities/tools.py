@@ -6,17 +6,208 @@ Tools for data request.
 """
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+import contextlib
+import gzip
 import json
 import os
 import csv
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 from data_request_api.utilities.logger import get_logger
 
+# Suffixes of the files compressed with the supported codecs
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def _import_zstandard():
+    """Return the optional zstandard module, or None if it is not installed."""
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def get_compression(compression):
+    """
+    Return the codec to use for the specified compression ("none", "gzip" or "zstd"),
+    falling back to "gzip" if "zstd" is requested but the zstandard package is not installed.
+    """
+    if compression == "zstd" and _import_zstandard() is None:
+        logger = get_logger()
+        logger.warning("Compression 'zstd' requires the zstandard package, using 'gzip' instead.")
+        return "gzip"
+    return compression
+
+
+def strip_compression_suffix(filename):
+    """Return the filename without the suffix of a compression codec."""
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+
+def find_file(filename):
+    """
+    Return the path of the file, either uncompressed or compressed with one of the
+    supported codecs (filename + suffix), or None if none of them exists.
+    """
+    for path in [filename] + [filename + suffix for suffix in COMPRESSION_SUFFIXES.values()]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def open_file(filename, mode="r"):
+    """
+    Open the file, transparently (de)compressing it according to its suffix
+    (see COMPRESSION_SUFFIXES). The (de)compression is streamed.
+    """
+    if filename.endswith(COMPRESSION_SUFFIXES["gzip"]):
+        if "b" not in mode and "t" not in mode:
+            mode += "t"
+        return gzip.open(filename, mode)
+    elif filename.endswith(COMPRESSION_SUFFIXES["zstd"]):
+        zstandard = _import_zstandard()
+        if zstandard is None:
+            raise OSError(f"Reading/writing {filename} requires the zstandard package")
+        return zstandard.open(filename, mode)
+    return open(filename, mode)
+
+
+def compress_file(filename, compression):
+    """
+    Compress the file with the specified codec ("none", "gzip" or "zstd"), replacing it.
+    Returns the path of the compressed file (the input path if compression is "none").
+    """
+    if compression in [None, "none"]:
+        return filename
+    compressed = filename + COMPRESSION_SUFFIXES[compression]
+    compressed_temp = temp_path(compressed)
+    with open(filename, "rb") as fin, open_file(compressed_temp, "wb") as fout:
+        shutil.copyfileobj(fin, fout, 1024**2)
+    os.replace(compressed_temp, compressed)
+    os.remove(filename)
+    return compressed
+
+
+def _read_chunk(fic, size):
+    """Read size bytes from the (decompressing) stream, fewer only at its end."""
+    chunk = b""
+    while len(chunk) < size:
+        data = fic.read(size - len(chunk))
+        if not data:
+            break
+        chunk += data
+    return chunk
+
+
+def files_equal(filename1, filename2):
+    """Compare the (decompressed) content of two files."""
+    with open_file(filename1, "rb") as f1, open_file(filename2, "rb") as f2:
+        while True:
+            chunk1 = _read_chunk(f1, 1024**2)
+            chunk2 = _read_chunk(f2, 1024**2)
+            if chunk1 != chunk2:
+                return False
+            if not chunk1:
+                return True
+
+
+def lock_path(filename):
+    """Return the path of the lock file of the specified file (see file_lock)."""
+    return strip_compression_suffix(filename) + ".lock"
+
+
+@contextlib.contextmanager
+def file_lock(filename, blocking=True):
+    """
+    Advisory lock of the file (plain or compressed) across processes and threads.
+
+    The lock is held on a separate lock file (see lock_path), which is kept so that
+    all processes lock the same file, until removed along with the file (see remove_lock).
+    Yields whether the lock was acquired, which is always the case if blocking.
+    """
+    path = lock_path(filename)
+    while True:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "a+") as fic:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fic, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(fic.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            yield False
+                            return
+                        time.sleep(0.1)
+            try:
+                # The lock file may have been removed by the previous holder of the lock,
+                #  in which case the lock is taken again on the new lock file
+                if _is_same_file(fic, path):
+                    yield True
+                    return
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fic, fcntl.LOCK_UN)
+                else:
+                    fic.seek(0)
+                    msvcrt.locking(fic.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _is_same_file(fic, path):
+    """Whether the open file is (still) the file at path."""
+    try:
+        return os.path.samestat(os.fstat(fic.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def remove_lock(filename):
+    """
+    Remove the lock file of the file (see file_lock), once the file is removed.
+    To be called while holding the lock. The lock file is kept if another file
+    sharing it (compressed with another codec) remains.
+    """
+    if find_file(strip_compression_suffix(filename)) is not None:
+        return
+    try:
+        os.remove(lock_path(filename))
+    except OSError:
+        # Already removed, or still open by another process on Windows
+        pass
+
+
+def temp_path(filename):
+    """
+    Return a path for a temporary file to be renamed to filename, that is unique per process
+    and thread. The suffix of the compression codec is kept (see open_file).
+    """
+    base = strip_compression_suffix(filename)
+    return f"{base}.{os.getpid()}.{threading.get_ident()}.tmp{filename[len(base):]}"
+
 
 def read_json_file(filename):
     logger = get_logger()
-    if os.path.isfile(filename):
-        with open(filename, "r") as fic:
+    path = find_file(filename)
+    if path is not None:
+        with open_file(path, "r") as fic:
             content = json.load(fic)
     else:
         logger.error(f"Filename {filename} is not readable")
@@ -35,11 +226,18 @@ def write_json_output_file_content(filename, content, **kwargs):
     dirname = os.path.dirname(filename)
     if len(dirname) > 0 and not os.path.isdir(dirname):
         logger.warning(f"Create directory {dirname}")
-        os.makedirs(dirname)
-    with open(filename, "w") as fic:
-        defaults = dict(indent=4, allow_nan=True, sort_keys=True)
-        defaults.update(kwargs)
-        json.dump(content, fic, **defaults)
+        os.makedirs(dirname, exist_ok=True)
+    # Write to a temporary file first, so that readers never see a partially written file
+    filename_temp = temp_path(filename)
+    try:
+        with open_file(filename_temp, "w") as fic:
+            defaults = dict(indent=4, allow_nan=True, sort_keys=True)
+            defaults.update(kwargs)
+            json.dump(content, fic, **defaults)
+        os.replace(filename_temp, filename)
+    finally:
+        if os.path.exists(filename_temp):
+            os.remove(filename_temp)
 
 
 def write_csv_output_file_content(filename, content, **kwargs):
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the consolidation of a raw (three-base) export: compilation of the mapping plan,
+serial and parallel consolidation with the cached plan.
+
+By default the raw export bundled with the tests is consolidated:
+    python benchmark_consolidation.py --repeat 5
+The output can be checked against a reference consolidated content (JSON), eg. written by a
+previous version with --output:
+    python benchmark_consolidation.py --reference consolidated.json
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_request_api.content.consolidate_export as ce
+from data_request_api.content.mapping_table import mapping_table
+from data_request_api.utilities.logger import change_log_file, change_log_level
+from data_request_api.utilities.tools import read_json_file, write_json_output_file_content
+
+
+default_export_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_request_api",
+                                   "data_request_api", "tests", "test_datasets", "dreq_raw_export.json")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--export_file", default=default_export_file, help="Raw export (three-base) to consolidate")
+parser.add_argument("--version", default="v1.2.2", help="Version of the export")
+parser.add_argument("--repeat", default=3, type=int, help="Number of consolidations per mode")
+parser.add_argument("--workers", default=2, type=int, help="Number of worker processes of the parallel mode")
+parser.add_argument("--reference", default=None, help="Consolidated content the output is compared to")
+parser.add_argument("--output", default=None, help="File the consolidated content is written to")
+args = parser.parse_args()
+
+change_log_file(default=True)
+change_log_level("critical")
+
+data = read_json_file(args.export_file)
+
+
+def run(**kwargs):
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = ce.map_data(data, mapping_table, args.version, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+# The first run includes the compilation of the plan, later runs reuse the cached plan
+ce._mapping_plans.clear()
+start = time.perf_counter()
+ce.compile_mapping_plan(mapping_table, data)
+compile_time = time.perf_counter() - start
+
+results = dict()
+for (label, kwargs) in [("serial", dict()), ("parallel", dict(workers=args.workers))]:
+    timings, results[label] = run(**kwargs)
+    print(f"{label:>12}: min {min(timings):.3f}s, mean {sum(timings) / len(timings):.3f}s"
+          f" ({args.repeat} runs)")
+print(f"{'compilation':>12}: {compile_time:.3f}s (once per mapping table and export schema)")
+
+identical = json.dumps(results["serial"]) == json.dumps(results["parallel"])
+print(f"Identical serial and parallel output: {identical}")
+if args.output is not None:
+    write_json_output_file_content(args.output, results["serial"], indent=None, sort_keys=False)
+if args.reference is not None:
+    reference = read_json_file(args.reference)
+    identical_reference = json.dumps(results["serial"], sort_keys=True) == json.dumps(reference, sort_keys=True)
+    print(f"Identical to the reference output: {identical_reference}")
+    identical = identical and identical_reference
+if not identical:
+    sys.exit(1)